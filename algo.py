@@ -1,4 +1,6 @@
-from typing import List, Optional
+import re
+import numpy as np
+from typing import List, Optional, Iterable, Union, TextIO
 
 
 """
@@ -20,17 +22,291 @@ Can detect syntax error in the list expression like
     - Group [ the anagrams in this list ["aff\nx", "a", "ab", "ba", "nnx", "xnn", "cde", "edc", "dce", "xffa"]
     - Group [ the anagrams ] in this list ["aff  x", "a", "ab", "ba", "nnx", "xnn", "cde", "edc", "dce", "xffa"]
     - Group the anagrams in this list ["affx", "a", "ab', "ba", "nnx", "xnn", "cde', "edc", "dce", "xffa"]
+
+See AnagramListParser, extract_anagram_list_from_stream and extract_anagram_list_from_file parse
+an input that doesn't fit in one string
     
 Analysis:
 
-    - runtime: Make one pass across the input string, O(n)
-        - the while loops help locate the correct [ and ] indicating the correct list expressions
-        - since it's scanning from left to right, runtime is still O(n)
+    - runtime: one pass across the input string, O(n), see AnagramListParser
     - space  : 
         - keep track of building the current word
         - store the output anagram list O(n)
 """
 def extract_anagram_list_from_input(input : str) -> Optional[List[str]]:
+    parser = AnagramListParser()
+    parser.feed(input)
+    return parser.close()
+
+
+def extract_anagram_list_from_stream(chunks : Iterable[str]) -> Optional[List[str]]:
+    parser = AnagramListParser()
+    for chunk in chunks:
+        if parser.feed(chunk):
+            break
+    return parser.close()
+
+
+"""
+Extract the anagram list from a text file (path or open file), read chunk_size characters at a time.
+Reading stops at the end of the list
+"""
+def extract_anagram_list_from_file(file : Union[str, TextIO], chunk_size : int = 1 << 20) -> Optional[List[str]]:
+    if isinstance(file, str):
+        with open(file, "r", encoding="utf-8") as f:
+            return extract_anagram_list_from_file(f, chunk_size)
+    return extract_anagram_list_from_stream(iter(lambda: file.read(chunk_size), ""))
+
+
+_SANITIZE = str.maketrans({"\n" : " ", "\t" : " ", "“" : "\"", "”" : "\"", "‘" : "'", "’" : "'"})
+_BRACKETS = re.compile(r"[\[\]]")
+_LETTERS = re.compile(r"[a-z]+")
+# A whole quoted word and what may follow it, the common case lexed in one match
+_ITEM = re.compile(r"""(["'])([a-z]*)\1 *(?:(,) *)?""")
+
+
+"""
+Single pass state machine behind extract_anagram_list_from_input, fed the input in chunks of any size
+
+It accepts and rejects exactly what the bracket search of the previous version (kept as
+extract_anagram_list_from_input_legacy) did, without going back over the input:
+    - the list expression is lexed from the last [ before a ], the first one that lexes to a non empty list wins
+    - the ] to close a candidate lags behind: after a ] closed a candidate, every next [ moves it to the next ]
+      (one step per [, not straight to the first ] after the [), and the [ only starts a candidate once
+      it has caught up. A [ while it still lags is a failed candidate
+    - an unclosed candidate at the end of the input (no ] after it) is no list, None
+    - otherwise the result is the last candidate's: None for a syntax error, [] for an empty list
+
+While no candidate is being lexed the chunk is searched for the next bracket with a regex,
+and quoted words and runs of letters are consumed with one regex match each, so the per character python work is small
+
+Analysis:
+    - runtime: O(n), every character is looked at once
+    - space  : the words of the current candidate, chunks are not kept
+"""
+class AnagramListParser:
+    def __init__(self):
+        self.result : Optional[List[str]] = None
+        self.done = False
+        # Result of the last closed candidate, returned if no candidate gives a non empty list
+        self._last : Optional[List[str]] = None
+        self._seen_open = False
+        # Number of ] seen, and the index among them of the ] that closes the current candidate
+        self._closes = 0
+        self._close_index = 0
+        self._active = False
+        self._start_candidate()
+
+    def _start_candidate(self):
+        self._failed = False
+        self._open_quote = ""
+        self._new_word_found = False
+        self._word : List[str] = []
+        self._words : List[str] = []
+
+    def _open_bracket(self):
+        if not self._seen_open:
+            self._seen_open = True
+            self._close_index = self._closes
+        elif self._active:
+            # A [ inside the candidate is a syntax error, the same ] closes the new one
+            pass
+        else:
+            self._close_index += 1
+            if self._close_index < self._closes:
+                self._last = None
+                return
+        self._active = True
+        self._start_candidate()
+
+    def _close_bracket(self):
+        self._closes += 1
+        if not self._active:
+            return
+        self._active = False
+        words = None if self._failed else self._words
+        if words:
+            self.result, self.done = words, True
+        self._last = words
+
+    def _lex(self, char : str):
+        if self._new_word_found:
+            # the next character allowed after a word was identified must be ',' or ' '
+            if char not in [",", " "]:
+                self._failed = True # Syntax error
+                return
+            elif char == ",":
+                self._new_word_found = False
+                return
+
+        if char in ["'", "\""]:
+            if self._open_quote == '':
+                self._open_quote = char
+            else:
+                if char != self._open_quote:
+                    self._failed = True # word open and close quote must be the same
+                    return
+                self._open_quote = ''
+                self._words.append("".join(self._word))
+                self._word = []
+                self._new_word_found = True
+        elif char == " ":
+            if self._open_quote:
+                self._failed = True # Can not have empty space in word
+        else:
+            self._failed = True # Syntax error
+
+    """
+    Returns True once the list is found, the rest of the input doesn't need to be fed
+    """
+    def feed(self, chunk : str) -> bool:
+        if self.done:
+            return True
+        chunk = chunk.translate(_SANITIZE)
+        i, size = 0, len(chunk)
+        while i < size:
+            if not self._active or self._failed:
+                match = _BRACKETS.search(chunk, i)
+                if match is None:
+                    break
+                i = match.start()
+            char = chunk[i]
+            if char == "[":
+                self._open_bracket()
+            elif char == "]":
+                self._close_bracket()
+                if self.done:
+                    return True
+            elif char in "\"'" and not self._open_quote and not self._new_word_found and _ITEM.match(chunk, i):
+                # Consecutive items of a well formed list, without going back through the dispatch above
+                match = _ITEM.match(chunk, i)
+                self._words.append("".join(self._word) + match.group(2))
+                self._word = []
+                while match.group(3):
+                    next_match = _ITEM.match(chunk, match.end())
+                    if next_match is None:
+                        break
+                    match = next_match
+                    self._words.append(match.group(2))
+                self._new_word_found = not match.group(3)
+                i = match.end()
+                continue
+            elif "a" <= char <= "z" and not self._new_word_found:
+                match = _LETTERS.match(chunk, i)
+                self._word.append(match.group())
+                i = match.end()
+                continue
+            else:
+                self._lex(char)
+            i += 1
+        return False
+
+    def close(self) -> Optional[List[str]]:
+        if self.done:
+            return self.result
+        if not self._seen_open or self._active:
+            return None
+        return self._last
+
+
+"""
+Letter counts of every word, one row of 26 columns per word, for words of lowercase letters only
+
+All the words are encoded in one pass: their letters are concatenated into one byte array, and every letter adds
+one to the cell (word, letter) through a single bincount. The count type is the smallest unsigned type that holds
+the longest word, uint8 for anything shorter than 256 letters, so a million words take 26MB
+
+Raises ValueError if a word has a character other than a-z
+"""
+def encode_anagram_counts(words : List[str], chunk_size : int = 1 << 16) -> np.ndarray:
+    lengths = np.fromiter(map(len, words), dtype=np.int64, count=len(words))
+    longest = int(lengths.max()) if len(words) else 0
+    dtype = np.uint8 if longest < 2 ** 8 else np.uint16 if longest < 2 ** 16 else np.uint32
+    counts = np.empty((len(words), 26), dtype=dtype)
+    # In chunks of words, so the temporary int64 arrays stay small whatever the number of words
+    for start in range(0, len(words), chunk_size):
+        end = min(start + chunk_size, len(words))
+        letters = np.frombuffer("".join(words[start : end]).encode("ascii"), dtype=np.uint8).astype(np.int64) - 97
+        if letters.size and (letters.min() < 0 or letters.max() > 25):
+            raise ValueError("Anagram words can only have lowercase letters a-z")
+        cells = np.repeat(np.arange(end - start, dtype=np.int64) * 26, lengths[start : end]) + letters
+        counts[start : end] = np.bincount(cells, minlength=(end - start) * 26).reshape(end - start, 26)
+    return counts
+
+
+# Random odd multipliers of the row hash, fixed so groups come out the same in every run
+_ROW_HASH_WEIGHTS = np.random.default_rng(26).integers(1, 2 ** 63, size=26, dtype=np.uint64) | np.uint64(1)
+
+
+"""
+Group anagrams from a list (or any iterable) of words, the batch engine behind group_anagrams
+
+Two words are anagrams if their rows of letter counts are equal. Rows are hashed to one uint64 (a dot product
+with random weights, wrapping around), and a stable sort by hash puts the words of a group next to each other,
+in input order. Rows are compared with their neighbour to check no two groups share a hash, if they do
+(odds around n^2 / 2^64) the words are sorted by the rows themselves instead.
+Groups come out in the order of their first word, like the dict based version
+
+Analysis:
+    Runtime: O(n log n) in numpy for n words, the only per word python work is building the output lists
+    Space: 26 bytes per word of up to 255 letters, plus the output
+"""
+def group_anagram_words(words : Iterable[str]) -> List[List[str]]:
+    words = words if isinstance(words, list) else list(words)
+    if not words:
+        return []
+    counts = encode_anagram_counts(words)
+    hashes = counts.astype(np.uint64) @ _ROW_HASH_WEIGHTS
+    order = np.argsort(hashes, kind="stable")
+    sorted_counts = counts[order]
+    new_group = np.any(sorted_counts[1:] != sorted_counts[:-1], axis=1)
+    if not np.array_equal(new_group, hashes[order][1:] != hashes[order][:-1]):
+        order = np.lexsort(counts.T[::-1])
+        sorted_counts = counts[order]
+        new_group = np.any(sorted_counts[1:] != sorted_counts[:-1], axis=1)
+
+    starts = np.concatenate(([0], np.flatnonzero(new_group) + 1))
+    ends = np.append(starts[1:], len(words))
+    # Groups ordered by the position of their first word
+    by_first = np.argsort(order[starts], kind="stable")
+    grouped = np.empty(len(words), dtype=object)
+    grouped[:] = words
+    grouped = grouped[order].tolist()
+    return [grouped[start : end] for start, end in zip(starts[by_first].tolist(), ends[by_first].tolist())]
+
+
+"""
+Given an arbitrary input string from the user, extract the list of anagram strings, and group them together
+
+
+Input:
+    Please group the anagrams in this list ["affx", "a", "ab", "ba", "nnx", "xnn", "cde", "edc", "dce", "xffa"]
+    
+Output:
+    [["affx", "xffa"], ["a"], ["ab", "ba"], ["nnx", "xnn"], ["cde", "edc", "dce"]]
+
+A list (or iterable) of words is grouped directly, without parsing
+    
+Analysis:
+    Runtime: O(n) to extract the anagram list from the string, then see group_anagram_words
+    Space: O(n)
+        - extract anagram list from string : O(n)
+        - letter counts, a fixed width row per word, so counts above 9 can't make two keys collide
+"""
+def group_anagrams(input : Union[str, Iterable[str]]) -> Optional[List[List[str]]]:
+    anagram_list : List[str] = extract_anagram_list_from_input(input) if isinstance(input, str) else list(input)
+    
+    if anagram_list:
+        return group_anagram_words(anagram_list)
+
+    return None
+
+
+"""
+Previous version of extract_anagram_list_from_input, it searches the [ and ] by slicing the input again
+for every candidate, which is quadratic with many brackets. Kept to check the new parser against
+"""
+def extract_anagram_list_from_input_legacy(input : str) -> Optional[List[str]]:
     def evaluate_list_string(input : str, list_open_bracket_offset, list_close_bracket_offset) -> Optional[List[str]]:
         if list_open_bracket_offset >= list_close_bracket_offset:
             return None
@@ -92,43 +368,3 @@ def extract_anagram_list_from_input(input : str) -> Optional[List[str]]:
         out = evaluate_list_string(input, list_open_bracket_offset, list_close_bracket_offset)
 
     return out
-
-
-"""
-Given an arbitrary input string from the user, extract the list of anagram strings, and group them together
-
-
-Input:
-    Please group the anagrams in this list ["affx", "a", "ab", "ba", "nnx", "xnn", "cde", "edc", "dce", "xffa"]
-    
-Output:
-    [["a"], ["ab", "ba"], ["nnx", "xnn"], ["cde", "edc", "dce"], ["xffa", "affx"]]
-    
-Analysis:
-    Runtime: O(n + n) = O(n)
-        - extract anagram list from string : O(n)
-        - for each word in anagram list, loop through each character : O(n)
-            - dictionary lookup is constant time
-    Space: O(n + n) = O(n)
-        - extract anagram list from string : O(n)
-        - dictionary to store constant length key that represents each group of anagram : O(n)
-        - the key though can grow arbitrarily if some characters can appear more than 10 times in a word
-"""
-def group_anagrams(input : str) -> Optional[List[List[str]]]:
-    anagram_list : List[str] = extract_anagram_list_from_input(input)
-    
-    if anagram_list:
-        table = {}
-        for word in anagram_list:
-            key = ["0"] * 26
-            for char in word:
-                key[ord(char)-97] = str(int(key[ord(char)-97]) + 1)
-
-            key_str = "".join(key)
-            if key_str in table:
-                table[key_str].append(word)
-            else:
-                table[key_str] = [word]
-        return list(table.values())
-
-    return None
\ No newline at end of file
@@ -0,0 +1,86 @@
+import time
+import random
+import argparse
+from typing import List, Dict
+from algo import group_anagrams, group_anagram_words, extract_anagram_list_from_input, extract_anagram_list_from_input_legacy
+
+
+"""
+Throughput of group_anagrams on millions of words, against the string key version it replaced,
+and scaling of extract_anagram_list_from_input against the version that searched brackets by slicing
+
+Usage:
+    python algo_bench.py [--words 1000000,3000000] [--max-length 12] [--letters 8] [--parse-sizes 1000,10000,100000]
+
+Words are random, over the first --letters letters of the alphabet so many of them are anagrams of each other.
+Both versions get a plain list of words, parsing the input string is not part of the timings.
+Parsing is timed on a valid list of words and on text full of unmatched brackets, the worst case of the old version
+"""
+def group_anagrams_string_key(anagram_list : List[str]) -> List[List[str]]:
+    table : Dict[str, List[str]] = {}
+    for word in anagram_list:
+        key = ["0"] * 26
+        for char in word:
+            key[ord(char)-97] = str(int(key[ord(char)-97]) + 1)
+        key_str = "".join(key)
+        if key_str in table:
+            table[key_str].append(word)
+        else:
+            table[key_str] = [word]
+    return list(table.values())
+
+
+def random_words(count : int, max_length : int, letters : int) -> List[str]:
+    rng = random.Random(0)
+    alphabet = "abcdefghijklmnopqrstuvwxyz"[:letters]
+    return ["".join(rng.choices(alphabet, k=rng.randint(1, max_length))) for _ in range(count)]
+
+
+def parse_inputs(size : int) -> Dict[str, str]:
+    words = random_words(size // 8, 6, 8)
+    return {"list" : "Please group the anagrams in this list [" + ", ".join(f'"{word}"' for word in words) + "]",
+            "brackets" : "Please group [ the" + " [ anagrams" * (size // 11) + ' ] in this list ["ab", "ba"]'}
+
+
+def run_parse(sizes : List[int]):
+    print("extract_anagram_list_from_input")
+    for size in sizes:
+        for kind, text in parse_inputs(size).items():
+            timings = {}
+            for label, parse in (("legacy", extract_anagram_list_from_input_legacy), ("parser", extract_anagram_list_from_input)):
+                start = time.perf_counter()
+                out = parse(text)
+                timings[label] = time.perf_counter() - start
+            print(f"    {len(text):9d} chars {kind:<9} legacy {timings['legacy']:8.3f}s  parser {timings['parser']:8.3f}s "
+                  f"{len(text) / timings['parser'] / 1e6:6.1f}M chars/s  {len(out or [])} words")
+
+
+def run(label : str, words : List[str], group) -> List[List[str]]:
+    start = time.perf_counter()
+    groups = group(words)
+    elapsed = time.perf_counter() - start
+    print(f"    {label:<12} {elapsed:8.2f}s {len(words) / elapsed / 1e6:8.2f}M words/s {len(groups):10d} groups")
+    return groups
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--words", default="1000000,3000000")
+    parser.add_argument("--max-length", type=int, default=12)
+    parser.add_argument("--letters", type=int, default=8)
+    parser.add_argument("--parse-sizes", default="1000,10000,100000")
+    args = parser.parse_args()
+
+    run_parse(list(map(int, args.parse_sizes.split(","))))
+    for count in map(int, args.words.split(",")):
+        words = random_words(count, args.max_length, args.letters)
+        print(f"{count} words, up to {args.max_length} letters over {args.letters} letters")
+        string_key = run("string key", words, group_anagrams_string_key)
+        engine = run("numpy", words, group_anagram_words)
+        # Same groups in the same order, as long as no letter is repeated 10 times (the string key collides then)
+        if args.max_length < 10:
+            assert engine == string_key
+
+    # The string key is ambiguous once a letter count reaches 10: "1" + "11" and "11" + "1" are the same key
+    words = ["a" + "b" * 11, "a" * 11 + "b"]
+    print(f"{words}: string key {group_anagrams_string_key(words)}, numpy {group_anagrams(words)}")
@@ -0,0 +1,93 @@
+import json
+import time
+import random
+import argparse
+import threading
+import requests
+from collections import defaultdict
+from typing import List, Dict
+from algo_service import AnagramService
+from algo_bench import random_words
+
+
+"""
+Load test of the anagram service: concurrent clients sending a mix of small and big requests
+
+Usage:
+    python algo_loadtest.py [--url http://127.0.0.1:8001] [--clients 16] [--duration 10] [--big-ratio 0.05] [--big-words 200000]
+
+Without --url a service is started in this process. Every client keeps one connection open and sends requests
+back to back, a --big-ratio share of them with --big-words words, the rest a sentence with a 10 word list.
+Reports req/s and p50/p95/p99 latency for small and big requests separately: small requests should stay fast
+while big ones are being grouped in the worker processes
+"""
+def percentile(samples : List[float], q : float) -> float:
+    samples = sorted(samples)
+    return samples[min(int(q * len(samples)), len(samples) - 1)] * 1000 if samples else 0.
+
+
+def client(url : str, deadline : float, big_ratio : float, big_body : bytes, seed : int,
+           latencies : Dict[str, List[float]], errors : Dict[str, int], lock : threading.Lock):
+    rng = random.Random(seed)
+    session = requests.Session()
+    while time.time() < deadline:
+        big = rng.random() < big_ratio
+        if big:
+            body = big_body
+        else:
+            words = random_words(10, 6, 4)
+            body = json.dumps({"input" : "Please group the anagrams in this list [" + ", ".join(f'"{word}"' for word in words) + "]"}).encode()
+        start = time.perf_counter()
+        try:
+            response = session.post(url + "/group", data=body, timeout=120)
+            ok = response.status_code == 200
+        except requests.RequestException:
+            ok = False
+        elapsed = time.perf_counter() - start
+        kind = "big" if big else "small"
+        with lock:
+            if ok:
+                latencies[kind].append(elapsed)
+            else:
+                errors[kind] += 1
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--url", default=None)
+    parser.add_argument("--clients", type=int, default=16)
+    parser.add_argument("--duration", type=float, default=10.)
+    parser.add_argument("--big-ratio", type=float, default=0.05)
+    parser.add_argument("--big-words", type=int, default=200000)
+    parser.add_argument("--workers", type=int, default=None, help="worker processes of the in process service")
+    args = parser.parse_args()
+
+    service = None
+    url = args.url
+    if url is None:
+        service = AnagramService(port=0, **({"workers" : args.workers} if args.workers is not None else {})).start()
+        url = service.url
+
+    big_body = json.dumps({"words" : random_words(args.big_words, 12, 8)}).encode()
+    latencies : Dict[str, List[float]] = defaultdict(list)
+    errors : Dict[str, int] = defaultdict(int)
+    lock = threading.Lock()
+    deadline = time.time() + args.duration
+    threads = [threading.Thread(target=client, args=(url, deadline, args.big_ratio, big_body, i, latencies, errors, lock))
+               for i in range(args.clients)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+    if service:
+        service.stop()
+
+    total = sum(len(samples) for samples in latencies.values())
+    print(f"{url}: {args.clients} clients, {elapsed:.1f}s, {total / elapsed:.1f} req/s, "
+          f"{sum(errors.values())} errors")
+    for kind in ("small", "big"):
+        samples = latencies[kind]
+        print(f"    {kind:<6} {len(samples):7d} requests {len(samples) / elapsed:8.1f} req/s  "
+              f"p50 {percentile(samples, 0.5):8.1f}ms  p95 {percentile(samples, 0.95):8.1f}ms  p99 {percentile(samples, 0.99):8.1f}ms")
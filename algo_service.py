@@ -0,0 +1,226 @@
+import os
+import json
+import time
+import logging
+import argparse
+import threading
+from concurrent.futures import ProcessPoolExecutor, Future
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import List, Optional, Dict, Any, Tuple
+from algo import group_anagram_words, extract_anagram_list_from_input
+
+
+ALGO_SERVICE_HOST = os.environ.get("ALGO_SERVICE_HOST", "127.0.0.1")
+ALGO_SERVICE_PORT = int(os.environ.get("ALGO_SERVICE_PORT", "8001"))
+# Processes for big requests, small ones are answered in the request thread
+ALGO_WORKERS = int(os.environ.get("ALGO_WORKERS", str(os.cpu_count() or 1)))
+# Requests up to this many characters of input (or of words) are small
+ALGO_INLINE_MAX_CHARS = int(os.environ.get("ALGO_INLINE_MAX_CHARS", "20000"))
+# Limits, larger requests get a 413
+ALGO_MAX_REQUEST_BYTES = int(os.environ.get("ALGO_MAX_REQUEST_BYTES", str(32 * 1024 * 1024)))
+ALGO_MAX_WORDS = int(os.environ.get("ALGO_MAX_WORDS", "2000000"))
+ALGO_MAX_BATCH = int(os.environ.get("ALGO_MAX_BATCH", "256"))
+
+logger = logging.getLogger(__name__)
+
+
+class RequestError(Exception):
+    def __init__(self, status : int, message : str):
+        super().__init__(message)
+        self.status = status
+
+
+"""
+Group one request: {"input" : free text with a list in it} or {"words" : [...]}
+Returns the groups (None if no list was found in the input) and the seconds spent parsing and grouping.
+Runs in the request thread or in a worker process
+"""
+def run_group_request(request : Dict[str, Any]) -> Tuple[Optional[List[List[str]]], Dict[str, float]]:
+    start = time.perf_counter()
+    words = request["words"] if "words" in request else extract_anagram_list_from_input(request["input"])
+    parsed = time.perf_counter()
+    groups = group_anagram_words(words) if words else None
+    return groups, {"parse" : parsed - start, "group" : time.perf_counter() - parsed}
+
+
+"""
+Characters of input of a request, checks it is well formed and within the limits
+"""
+def request_size(request : Any) -> int:
+    if not isinstance(request, dict) or ("input" in request) == ("words" in request):
+        raise RequestError(400, 'A request needs either "input" (text) or "words" (list of strings)')
+    if "input" in request:
+        if not isinstance(request["input"], str):
+            raise RequestError(400, '"input" must be a string')
+        return len(request["input"])
+    words = request["words"]
+    if not isinstance(words, list) or not all(isinstance(word, str) for word in words):
+        raise RequestError(400, '"words" must be a list of strings')
+    if len(words) > ALGO_MAX_WORDS:
+        raise RequestError(413, f"At most {ALGO_MAX_WORDS} words per request")
+    return sum(map(len, words)) + len(words)
+
+
+"""
+HTTP service around group_anagrams
+
+    POST /group         {"input" : "group [\"ab\", \"ba\"]"} or {"words" : ["ab", "ba"]}
+                        -> {"groups" : [["ab", "ba"]], "timing" : {...}}
+    POST /group/batch   {"requests" : [request, ...]} -> {"results" : [response, ...], "timing" : {...}}
+    GET  /health
+
+Small requests are answered in the request thread (one per connection), requests over ALGO_INLINE_MAX_CHARS
+go to a process pool, so a big batch uses other cores and doesn't hold up small requests behind the GIL.
+Items of a batch are dispatched one by one, the big ones in parallel.
+Every response has its timing in ms: parse, group, queue (waiting for a worker process) and total,
+and where it ran ("inline" or "process")
+
+Errors: 400 malformed request or words with other characters than a-z, 413 over the size limits,
+a list that can't be found in the input is not an error, its groups are null
+"""
+class AnagramService:
+    def __init__(self, host : str = ALGO_SERVICE_HOST, port : int = ALGO_SERVICE_PORT, workers : int = ALGO_WORKERS):
+        self.host = host
+        self.port = port
+        self.workers = workers
+        self._executor : Optional[ProcessPoolExecutor] = None
+        self._server : Optional[ThreadingHTTPServer] = None
+        self._thread : Optional[threading.Thread] = None
+
+    @property
+    def url(self) -> str:
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def _submit(self, request : Dict[str, Any]) -> Tuple[Optional[Future], Dict[str, Any]]:
+        size = request_size(request)
+        if size <= ALGO_INLINE_MAX_CHARS or self.workers <= 0:
+            return None, request
+        return self._executor.submit(run_group_request, request), request
+
+    def _result(self, pending : Tuple[Optional[Future], Dict[str, Any]], start : float) -> Dict[str, Any]:
+        future, request = pending
+        try:
+            if future is None:
+                groups, timing = run_group_request(request)
+            else:
+                groups, timing = future.result()
+        except ValueError as e:
+            raise RequestError(400, str(e))
+        total = time.perf_counter() - start
+        timing = {name : round(seconds * 1000, 3) for name, seconds in timing.items()}
+        timing["queue"] = round(max(total * 1000 - timing["parse"] - timing["group"], 0.), 3) if future else 0.
+        timing["total"] = round(total * 1000, 3)
+        return {"groups" : groups, "timing" : {**timing, "worker" : "process" if future else "inline"}}
+
+    def group(self, request : Dict[str, Any]) -> Dict[str, Any]:
+        start = time.perf_counter()
+        return self._result(self._submit(request), start)
+
+    def group_batch(self, requests : Any) -> Dict[str, Any]:
+        start = time.perf_counter()
+        if not isinstance(requests, list):
+            raise RequestError(400, '"requests" must be a list')
+        if len(requests) > ALGO_MAX_BATCH:
+            raise RequestError(413, f"At most {ALGO_MAX_BATCH} requests per batch")
+        # Big items start in the pool first, then the small ones run here while they do.
+        # A bad item gets an error in its result, the others are still answered
+        pending = []
+        for request in requests:
+            try:
+                pending.append(self._submit(request))
+            except RequestError as e:
+                pending.append(e)
+        results = []
+        for item in pending:
+            try:
+                if isinstance(item, RequestError):
+                    raise item
+                results.append(self._result(item, start))
+            except RequestError as e:
+                results.append({"groups" : None, "error" : str(e)})
+        return {"results" : results, "timing" : {"total" : round((time.perf_counter() - start) * 1000, 3)}}
+
+    def start(self) -> "AnagramService":
+        service = self
+        if self.workers > 0:
+            self._executor = ProcessPoolExecutor(max_workers=self.workers)
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                if self.path == "/health":
+                    self._send(200, {"status" : "ok", "workers" : service.workers})
+                else:
+                    self._send(404, {"error" : f"Unknown path {self.path}"})
+
+            def do_POST(self):
+                try:
+                    length = int(self.headers.get("Content-Length", 0))
+                    if length > ALGO_MAX_REQUEST_BYTES:
+                        self.close_connection = True
+                        raise RequestError(413, f"At most {ALGO_MAX_REQUEST_BYTES} bytes per request")
+                    try:
+                        body = json.loads(self.rfile.read(length) or b"{}")
+                    except ValueError:
+                        raise RequestError(400, "Request body is not valid json")
+                    if self.path == "/group":
+                        self._send(200, service.group(body))
+                    elif self.path == "/group/batch":
+                        self._send(200, service.group_batch(body.get("requests") if isinstance(body, dict) else None))
+                    else:
+                        raise RequestError(404, f"Unknown path {self.path}")
+                except RequestError as e:
+                    self._send(e.status, {"error" : str(e)})
+                except Exception as e:
+                    logger.exception("Anagram request failed")
+                    self._send(500, {"error" : str(e)})
+
+            def _send(self, status : int, payload : dict):
+                data = json.dumps(payload).encode()
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+        self._server = ThreadingHTTPServer((self.host, self.port), Handler)
+        self._server.daemon_threads = True
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        if self._server:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+        if self._executor:
+            self._executor.shutdown(cancel_futures=True)
+            self._executor = None
+
+    def __enter__(self) -> "AnagramService":
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Serve group_anagrams over http")
+    parser.add_argument("--host", default=ALGO_SERVICE_HOST)
+    parser.add_argument("--port", type=int, default=ALGO_SERVICE_PORT)
+    parser.add_argument("--workers", type=int, default=ALGO_WORKERS)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    service = AnagramService(args.host, args.port, args.workers).start()
+    print(f"Serving anagram grouping on {service.url} with {args.workers} worker processes")
+    try:
+        service._thread.join()
+    except KeyboardInterrupt:
+        service.stop()
@@ -0,0 +1,64 @@
+import json
+import unittest
+import requests
+import algo_service
+from algo_service import AnagramService
+
+
+class TestAnagramService(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.inline_max_chars, algo_service.ALGO_INLINE_MAX_CHARS = algo_service.ALGO_INLINE_MAX_CHARS, 100
+        cls.service = AnagramService(port=0, workers=2).start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.service.stop()
+        algo_service.ALGO_INLINE_MAX_CHARS = cls.inline_max_chars
+
+    def post(self, path, body):
+        return requests.post(self.service.url + path, data=json.dumps(body), timeout=30)
+
+
+    def test_group(self):
+        response = self.post("/group", {"input" : 'Please group the anagrams in this list ["ab", "a", "ba"]'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()["groups"], [["ab", "ba"], ["a"]])
+        self.assertEqual(response.json()["timing"]["worker"], "inline")
+        self.assertIn("total", response.json()["timing"])
+
+        words = ["ab", "ba", "c"] * 100
+        response = self.post("/group", {"words" : words})
+        self.assertEqual(response.json()["groups"], [["ab", "ba"] * 100, ["c"] * 100])
+        self.assertEqual(response.json()["timing"]["worker"], "process")
+
+        self.assertIsNone(self.post("/group", {"input" : "no list here"}).json()["groups"])
+
+
+    def test_batch(self):
+        response = self.post("/group/batch", {"requests" : [{"words" : ["ab", "ba"]}, 
+                                                            {"words" : ["xyz", "zyx"] * 100},
+                                                            {"words" : ["A"]}, 
+                                                            {"input" : '["c"]'}]})
+        self.assertEqual(response.status_code, 200)
+        results = response.json()["results"]
+        self.assertEqual([result["groups"] for result in results], [[["ab", "ba"]], [["xyz", "zyx"] * 100], None, [["c"]]])
+        self.assertIn("error", results[2])
+        self.assertEqual([result["timing"]["worker"] for result in results if "timing" in result], ["inline", "process", "inline"])
+
+
+    def test_errors(self):
+        self.assertEqual(self.post("/group", {"words" : ["ab", "B"]}).status_code, 400)
+        self.assertEqual(self.post("/group", {"text" : "ab"}).status_code, 400)
+        self.assertEqual(requests.post(self.service.url + "/group", data=b"{", timeout=30).status_code, 400)
+        max_batch, algo_service.ALGO_MAX_BATCH = algo_service.ALGO_MAX_BATCH, 2
+        try:
+            self.assertEqual(self.post("/group/batch", {"requests" : [{"words" : []}] * 3}).status_code, 413)
+        finally:
+            algo_service.ALGO_MAX_BATCH = max_batch
+        self.assertEqual(requests.get(self.service.url + "/health", timeout=30).json()["status"], "ok")
+
+
+if __name__ == '__main__':
+    unittest.main()
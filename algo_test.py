@@ -1,5 +1,10 @@
+import io
+import random
 import unittest
-from algo import extract_anagram_list_from_input, group_anagrams
+import numpy as np
+import algo
+from algo import extract_anagram_list_from_input, group_anagrams, group_anagram_words, encode_anagram_counts
+from algo import extract_anagram_list_from_input_legacy, extract_anagram_list_from_stream, extract_anagram_list_from_file
 from typing import List
 
 
@@ -64,5 +69,52 @@ class TestAlgo(unittest.TestCase):
             self.assertTrue(validate_grouped_anagrams(case, grouped_anagrams))
 
 
+    def test_group_anagram_words(self):
+        words = ["affx", "a", "ab", "ba", "nnx", "xnn", "cde", "edc", "dce", "xffa"]
+        expected = [["affx", "xffa"], ["a"], ["ab", "ba"], ["nnx", "xnn"], ["cde", "edc", "dce"]]
+        self.assertEqual(group_anagram_words(words), expected)
+        self.assertEqual(group_anagram_words(iter(words)), expected)
+        self.assertEqual(group_anagrams(words), expected)
+        self.assertEqual(group_anagram_words([]), [])
+        # Counts above 9 used to make "1" + "11" and "11" + "1" the same key
+        self.assertEqual(group_anagram_words(["a" + "b" * 11, "a" * 11 + "b", "b" * 11 + "a"]), 
+                         [["a" + "b" * 11, "b" * 11 + "a"], ["a" * 11 + "b"]])
+        self.assertEqual(encode_anagram_counts(["z" * 300]).dtype, np.uint16)
+        with self.assertRaises(ValueError):
+            group_anagram_words(["ab", "Ab"])
+
+
+    def test_group_anagram_words_hash_collision(self):
+        weights, algo._ROW_HASH_WEIGHTS = algo._ROW_HASH_WEIGHTS, np.zeros(26, dtype=np.uint64)
+        try:
+            self.assertEqual(group_anagram_words(["ab", "c", "ba", "cc", "c"]), [["ab", "ba"], ["c", "c"], ["cc"]])
+        finally:
+            algo._ROW_HASH_WEIGHTS = weights
+
+
+
+    def test_parser_matches_legacy(self):
+        rng = random.Random(0)
+        chars = ['[', ']', '"', "'", ',', ' ', 'a', 'b', '\n', '\t', '1', '“', '”', '’', 'A']
+        weights = [3, 3, 3, 2, 3, 3, 4, 2, 1, 1, 1, 1, 1, 1, 1]
+        for _ in range(20000):
+            case = "".join(rng.choices(chars, weights, k=rng.randint(0, 30)))
+            expected = extract_anagram_list_from_input_legacy(case)
+            self.assertEqual(extract_anagram_list_from_input(case), expected, case)
+            cut = rng.randint(0, len(case))
+            self.assertEqual(extract_anagram_list_from_stream([case[:cut], case[cut:]]), expected, case)
+
+
+    def test_parse_stream_and_file(self):
+        case = """Please group [] the ] anagrams [ in this list [\n\n"affx", "a", 'ab', "ba", "nnx", "xnn", "cde", "edc", "dce", "xffa"\n\n]"""
+        expected = ['affx', 'a', 'ab', 'ba', 'nnx', 'xnn', 'cde', 'edc', 'dce', 'xffa']
+        self.assertEqual(extract_anagram_list_from_stream(case), expected)
+        self.assertEqual(extract_anagram_list_from_file(io.StringIO(case), chunk_size=7), expected)
+        # Nothing after the list is read
+        chunks = iter([case, "never read"])
+        self.assertEqual(extract_anagram_list_from_stream(chunks), expected)
+        self.assertEqual(next(chunks), "never read")
+
+
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file
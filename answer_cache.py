@@ -0,0 +1,176 @@
+import os
+import re
+import json
+import time
+import logging
+import tempfile
+import threading
+import numpy as np
+from collections import OrderedDict, Counter
+from typing import Optional, Dict
+
+
+logger = logging.getLogger(__name__)
+
+"""
+Lowercase, drop punctuation and collapse whitespace, so "Delete document?" and "delete  document" share an entry
+"""
+def normalize_question(question : str) -> str:
+    return " ".join(re.sub(r"[^\w\s]", " ", question.lower()).split())
+
+
+"""
+Cache of finished answers, looked up by exact normalized question first, then by nearest question embedding
+
+Entries belong to the index version they were generated from. A lookup with another version drops every entry,
+so rebuilding the index invalidates the cache without any explicit call. An insert for another version than
+the current one comes from a request that started before the rebuild, it is ignored.
+Size is bounded with LRU eviction, entries older than ttl seconds are dropped on access.
+If path is given the cache is loaded from it and saved back at most every save_interval seconds, on a background
+thread so a put never waits for the file (nor fails with it)
+
+Analysis:
+    - exact lookup is a dict lookup, O(1), no embedding needed
+    - semantic lookup is one matrix-vector product over at most max_entries vectors
+"""
+class AnswerCache:
+    def __init__(self,
+                 max_entries : int = 256,
+                 ttl : float = 24 * 3600,
+                 similarity_threshold : float = 0.98,
+                 path : Optional[str] = None,
+                 save_interval : float = 60.):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.similarity_threshold = similarity_threshold
+        self.path = path
+        self.save_interval = save_interval
+        self.stats : Counter = Counter()
+        self._version : Optional[str] = None
+        # normalized question -> {"answer", "vector", "created"}
+        self._entries : "OrderedDict[str, dict]" = OrderedDict()
+        self._lock = threading.Lock()
+        # One save at a time, they all write the same file
+        self._save_lock = threading.Lock()
+        self._saver : Optional[threading.Thread] = None
+        self._last_save = time.time()
+        if path and os.path.isfile(path):
+            self.load()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def _use_version(self, version : str):
+        if version != self._version:
+            self._entries.clear()
+            self._version = version
+
+    def _expired(self, entry : dict, now : float) -> bool:
+        return now - entry["created"] > self.ttl
+
+    """
+    Exact match on the normalized question, no embedding needed
+    """
+    def get_exact(self, question : str, version : str) -> Optional[str]:
+        key = normalize_question(question)
+        now = time.time()
+        with self._lock:
+            self._use_version(version)
+            entry = self._entries.get(key)
+            if entry is not None and self._expired(entry, now):
+                del self._entries[key]
+                self.stats["expired"] += 1
+                entry = None
+            if entry is None:
+                return None
+            self._entries.move_to_end(key)
+            self.stats["exact_hits"] += 1
+            return entry["answer"]
+
+    """
+    Nearest cached question by cosine similarity, if it is at least similarity_threshold
+    """
+    def get_similar(self, vector : np.ndarray, version : str) -> Optional[str]:
+        now = time.time()
+        with self._lock:
+            self._use_version(version)
+            for key in [key for key, entry in self._entries.items() if self._expired(entry, now)]:
+                del self._entries[key]
+                self.stats["expired"] += 1
+            keys = [key for key, entry in self._entries.items() if entry["vector"] is not None]
+            if keys:
+                matrix = np.stack([self._entries[key]["vector"] for key in keys])
+                scores = matrix @ (vector / np.linalg.norm(vector))
+                best = int(np.argmax(scores))
+                if scores[best] >= self.similarity_threshold:
+                    self._entries.move_to_end(keys[best])
+                    self.stats["semantic_hits"] += 1
+                    return self._entries[keys[best]]["answer"]
+            self.stats["misses"] += 1
+            return None
+
+    def put(self, question : str, answer : str, version : str, vector : Optional[np.ndarray] = None):
+        key = normalize_question(question)
+        if vector is not None:
+            vector = np.asarray(vector, dtype=np.float32)
+            vector = vector / np.linalg.norm(vector)
+        with self._lock:
+            if self._version is not None and version != self._version:
+                return
+            self._version = version
+            self._entries[key] = {"answer" : answer, "vector" : vector, "created" : time.time()}
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.stats["evictions"] += 1
+            if not self.path or time.time() - self._last_save < self.save_interval or self._saver is not None:
+                return
+            self._last_save = time.time()
+            saver = self._saver = threading.Thread(target=self._save_in_background, name="answer-cache-save", daemon=True)
+        saver.start()
+
+    def get_stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {**self.stats, "size" : len(self._entries)}
+
+    def _save_in_background(self):
+        try:
+            self.save()
+        except Exception:
+            logger.exception("Saving the answer cache to %s failed", self.path)
+        finally:
+            with self._lock:
+                self._saver = None
+
+    def save(self):
+        with self._save_lock:
+            # Only the copy is made under the lock, the entries' vectors are never changed in place
+            with self._lock:
+                version = self._version
+                entries = [(key, dict(entry)) for key, entry in self._entries.items()]
+                self._last_save = time.time()
+            data = {"version" : version,
+                    "entries" : [{"question" : key,
+                                  "answer" : entry["answer"],
+                                  "vector" : entry["vector"].tolist() if entry["vector"] is not None else None,
+                                  "created" : entry["created"]} for key, entry in entries]}
+            # Write then rename, so a crash mid write never leaves a truncated cache file behind
+            f = tempfile.NamedTemporaryFile("w", dir=os.path.dirname(os.path.abspath(self.path)),
+                                            prefix=f"{os.path.basename(self.path)}.", suffix=".tmp", delete=False)
+            try:
+                with f:
+                    json.dump(data, f)
+                os.replace(f.name, self.path)
+            except BaseException:
+                os.unlink(f.name)
+                raise
+
+    def load(self):
+        with open(self.path, "r") as f:
+            data = json.load(f)
+        with self._lock:
+            self._version = data["version"]
+            self._entries.clear()
+            for entry in data["entries"][-self.max_entries:]:
+                vector = np.asarray(entry["vector"], dtype=np.float32) if entry["vector"] is not None else None
+                self._entries[entry["question"]] = {"answer" : entry["answer"], "vector" : vector, "created" : entry["created"]}
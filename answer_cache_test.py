@@ -0,0 +1,105 @@
+import os
+import time
+import threading
+import tempfile
+import unittest
+import numpy as np
+from answer_cache import AnswerCache, normalize_question
+
+
+class TestAnswerCache(unittest.TestCase):
+
+    def test_exact_and_semantic_lookup(self):
+        cache = AnswerCache(similarity_threshold=0.9)
+        cache.put("Delete document?", "answer", "v1", np.array([1., 0., 0.]))
+        self.assertEqual(normalize_question("  delete   DOCUMENT "), "delete document")
+        self.assertEqual(cache.get_exact("delete document", "v1"), "answer")
+        self.assertEqual(cache.get_similar(np.array([0.95, 0.1, 0.]), "v1"), "answer")
+        self.assertIsNone(cache.get_similar(np.array([0., 1., 0.]), "v1"))
+        stats = cache.get_stats()
+        self.assertEqual((stats["exact_hits"], stats["semantic_hits"], stats["misses"]), (1, 1, 1))
+
+
+    def test_near_duplicates_are_distinct(self):
+        # "delete document" and "get document": close, but different operations
+        cache = AnswerCache()
+        cache.put("delete document", "delete answer", "v1", np.array([1., 0.2, 0.]))
+        self.assertIsNone(cache.get_similar(np.array([1., 0., 0.2]), "v1"))
+        # A rewording of the same question still hits
+        self.assertEqual(cache.get_similar(np.array([1., 0.19, 0.02]), "v1"), "delete answer")
+
+
+    def test_index_version_invalidates(self):
+        cache = AnswerCache()
+        cache.put("delete document", "old answer", "v1")
+        self.assertIsNone(cache.get_exact("delete document", "v2"))
+        # Request started before the rebuild, its answer must not come back
+        cache.put("delete document", "old answer", "v1")
+        self.assertIsNone(cache.get_exact("delete document", "v2"))
+        self.assertEqual(len(cache), 0)
+
+
+    def test_lru_and_ttl_eviction(self):
+        cache = AnswerCache(max_entries=2, ttl=0.05)
+        cache.put("a", "1", "v1")
+        cache.put("b", "2", "v1")
+        cache.get_exact("a", "v1")
+        cache.put("c", "3", "v1")
+        self.assertIsNone(cache.get_exact("b", "v1"))
+        self.assertEqual(cache.get_exact("a", "v1"), "1")
+        time.sleep(0.1)
+        self.assertIsNone(cache.get_exact("c", "v1"))
+        self.assertEqual(cache.get_stats()["evictions"], 1)
+
+
+    def test_persistence(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "answer_cache.json")
+            cache = AnswerCache(path=path)
+            cache.put("delete document", "answer", "v1", np.array([0., 1.]))
+            cache.save()
+            restored = AnswerCache(path=path)
+            self.assertEqual(restored.get_exact("delete document", "v1"), "answer")
+            self.assertEqual(restored.get_similar(np.array([0., 2.]), "v1"), "answer")
+
+
+    def wait_for_save(self, cache):
+        saver = cache._saver
+        if saver is not None:
+            saver.join(5)
+
+
+    def test_concurrent_puts_save_in_background(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "answer_cache.json")
+            cache = AnswerCache(path=path, save_interval=0)
+            errors = []
+            def run(i):
+                try:
+                    for j in range(20):
+                        cache.put(f"question {i} {j}", "answer", "v1", np.random.rand(64))
+                except Exception as e:
+                    errors.append(e)
+            threads = [threading.Thread(target=run, args=(i,)) for i in range(8)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            self.wait_for_save(cache)
+            cache.save()
+            self.assertEqual(errors, [])
+            self.assertEqual(os.listdir(tmp), ["answer_cache.json"])
+            self.assertEqual(len(AnswerCache(path=path)), 160)
+
+
+    def test_failed_save_doesnt_raise(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            cache = AnswerCache(path=os.path.join(tmp, "missing", "answer_cache.json"), save_interval=0)
+            with self.assertLogs("answer_cache", level="ERROR"):
+                cache.put("delete document", "answer", "v1")
+                self.wait_for_save(cache)
+            self.assertEqual(cache.get_exact("delete document", "v1"), "answer")
+
+
+if __name__ == '__main__':
+    unittest.main()
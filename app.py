@@ -1,9 +1,36 @@
+import sys
+import os
 import dotenv
 dotenv.load_dotenv()
-from predict import generate_code_suggestion, is_veryfi_python_help_intent, update_index
+if not os.environ.get("OPENAI_API_KEY"):
+    print("Please set OpenAI API key environment variable and then run the app")
+    sys.exit()
+from predict import answer_question_async, answer_question_stream_async, request_index_rebuild, get_rebuild_status, start_index_warmup
+from predict import registry, route_question
+from conversation import Conversation
+from metrics import traced, annotate, start_metrics_server, METRICS_ENABLED, METRICS_PORT
+from resilience import UpstreamUnavailableError
+# The index loads while gradio is imported and the UI is built
+start_index_warmup()
 import gradio as gr
 import random
-from typing import Optional, List, Tuple
+import logging
+from typing import Optional, List, Tuple, AsyncIterator
+
+
+# Show the answer token by token instead of waiting for the whole completion
+STREAM_RESPONSES = os.environ.get("STREAM_RESPONSES", "1") == "1"
+# Questions answered at the same time. bot is async, waiting on openai doesn't hold a thread,
+# so this can be well above the thread count. Questions over it wait in the queue (up to GRADIO_QUEUE_SIZE, 0 for no limit)
+GRADIO_CONCURRENCY = int(os.environ.get("GRADIO_CONCURRENCY", "32"))
+GRADIO_QUEUE_SIZE = int(os.environ.get("GRADIO_QUEUE_SIZE", "0"))
+# Messages shown in the chat, older ones are dropped. The whole chat goes to the server and back with every question
+CHAT_HISTORY_TURNS = int(os.environ.get("CHAT_HISTORY_TURNS", "20"))
+AUTO_INDEX = "Any (picked from the question)"
+# Package picked in the UI -> index name, None lets predict route the question
+INDEX_CHOICES = {AUTO_INDEX : None, **{spec.title : spec.name for spec in registry.specs.values()}}
+
+logger = logging.getLogger(__name__)
 
 
 greeting = \
@@ -16,39 +43,80 @@ Feel free to try me out. Cheers 🤖
 
 with gr.Blocks() as demo:
     chatbot = gr.Chatbot([(None, greeting)])
+    # The session's questions and answers as text for follow ups, the chat only has their html
+    conversation = gr.State(Conversation())
+    # Only there when the registry serves more than one package
+    index_choice = gr.Dropdown(list(INDEX_CHOICES), value=AUTO_INDEX, label="Package", visible=len(INDEX_CHOICES) > 2)
     user_input = gr.Textbox(label="Input")
     examples = gr.Examples(["Update index db (will pull in the latest code and re-build the search index)", 
                             "use veryfi-python package to delete document", 
                             "process document with url and extract fields",
                             "process w9 document"], inputs=user_input)
     clear = gr.Button("Clear")
+    # Not shown, exposes the rebuild status for polling through the api (/run/index_status)
+    index_status = gr.JSON(visible=False)
+    index_status_button = gr.Button("Index status", visible=False)
 
 
     def user(user_message, history) -> Tuple[Optional[str], List[Tuple[Optional[str], Optional[str]]]]:
-        return "", history + [[user_message, None]]
+        return "", history[max(len(history) - CHAT_HISTORY_TURNS + 1, 0):] + [[user_message, None]]
 
 
-    def bot(history) -> Optional[List[str]]:
+    # One trace per question, the answer_question_* call inside is part of it.
+    # session is the Conversation of the user (none for a one off question), gradio fails on Optional annotations
+    @traced("bot")
+    async def bot(history, choice=AUTO_INDEX, session=None) -> AsyncIterator[List[List[Optional[str]]]]:
         user_question = history[-1][0]
+        index = INDEX_CHOICES.get(choice)
         if "update index db" in user_question.lower():
-            update_index()
-            bot_message = "Index updated with the latest code changes 😎"
-        elif is_veryfi_python_help_intent(user_question):
-            bot_message : str = generate_code_suggestion(user_question.strip())
-            if not bot_message:
-                bot_message = "Sorry there was an error in my system. Diagnosing 🩺 ..."
+            status = request_index_rebuild(route_question(user_question, index))
+            annotate(outcome="rebuild")
+            if status["coalesced"]:
+                bot_message = "The index is already being updated, I'll keep answering from the current one until it's ready ⏳"
+            else:
+                bot_message = "Updating the index with the latest code changes in the background 😎 I'll keep answering from the current one until it's ready"
         else:
-            bot_message = "Sorry I wasn't trained to answer this question 😔"
+            is_intent, bot_message = True, None
+            try:
+                if STREAM_RESPONSES:
+                    async for is_intent, bot_message in answer_question_stream_async(user_question.strip(), index=index, 
+                                                                                    conversation=session):
+                        if is_intent and bot_message:
+                            history[-1][1] = bot_message
+                            yield history
+                else:
+                    is_intent, bot_message, _ = await answer_question_async(user_question.strip(), index=index, conversation=session)
+            # openai kept failing or is failing fast (see llm.chat_caller), the error stays in the chat instead of gradio's
+            except UpstreamUnavailableError as e:
+                logger.warning("Question not answered: %s", e)
+                annotate(outcome="unavailable")
+                is_intent, bot_message = True, "Sorry ChatGPT isn't responding right now, please try again in a bit 🙏"
+            except Exception:
+                logger.exception("Question not answered")
+                annotate(outcome="error")
+                is_intent, bot_message = True, None
+            if not is_intent:
+                bot_message = "Sorry I wasn't trained to answer this question 😔"
+            elif not bot_message:
+                bot_message = "Sorry there was an error in my system. Diagnosing 🩺 ..."
         history[-1][1] = bot_message
-        return history
+        yield history
 
 
     user_input.submit(fn=user, inputs=[user_input, chatbot], 
                                 outputs=[user_input, chatbot])\
-              .then(bot, inputs=[chatbot], outputs=[chatbot])
-    clear.click(fn = lambda: None, inputs=None, outputs=[chatbot])
+              .then(bot, inputs=[chatbot, index_choice, conversation], outputs=[chatbot])
+    clear.click(fn = lambda: (None, Conversation()), inputs=None, outputs=[chatbot, conversation])
+    index_status_button.click(fn=lambda choice: get_rebuild_status(INDEX_CHOICES.get(choice)), inputs=[index_choice], 
+                              outputs=[index_status], api_name="index_status")
 
 
-# Only run with share on an EC2 instance for testing
-# demo.launch(share=True)
-demo.launch()
+# Importing the app builds the UI without serving it, predict_bench drives bot directly
+if __name__ == "__main__":
+    if METRICS_ENABLED and METRICS_PORT:
+        start_metrics_server()
+    # Queue is required for bot to stream its updates
+    demo.queue(concurrency_count=GRADIO_CONCURRENCY, max_size=GRADIO_QUEUE_SIZE or None)
+    # Only run with share on an EC2 instance for testing
+    # demo.launch(share=True)
+    demo.launch()
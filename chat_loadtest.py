@@ -0,0 +1,126 @@
+import os
+import sys
+import time
+import asyncio
+import argparse
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Tuple
+from fake_openai import FakeOpenAIServer
+
+
+"""
+Load test of the chat path against the local openai stand-in: answers/s and latency as concurrent users go up
+
+Usage:
+    python chat_loadtest.py [--users 1,4,16,32] [--questions 4] [--chunk-latency 0.02] [--mode async|sync|both]
+
+Every user asks --questions questions one after the other, each answered by answer_question_stream_async
+(what app.bot does), or by answer_question_stream on a thread per user for --mode sync, the path the app used
+before. The stand-in streams a ~40 chunk answer with --chunk-latency seconds between chunks, so most of a
+question is spent waiting on the completion, like with openai. Throughput should grow with the users as long as
+waiting doesn't hold a thread; the sync path is capped by PREDICT_WORKERS threads running the speculative streams.
+
+Runs in a temporary directory, with an index built from data/veryfi_python_client_doc.jsonl with the stand-in
+embeddings, so the app's index isn't touched. The answer cache is off, every question would hit it otherwise.
+The local intent gate is off too, the stand-in's bag of words embeddings would score every question off topic,
+so intent is a (fast) completion and every question is answered
+"""
+REPLY = "yes\n```python\nfrom veryfi import Client\n\nclient = Client(client_id, client_secret, username, api_key)\n" \
+        "response = client.delete_document(document_id)\n```"
+
+
+def percentile(samples : List[float], q : float) -> float:
+    samples = sorted(samples)
+    return samples[min(int(q * len(samples)), len(samples) - 1)] if samples else 0.
+
+
+async def run_async(users : int, questions : int) -> Tuple[List[float], List[float]]:
+    import predict
+    from llm import close_aiosession
+    latencies, first_updates = [], []
+
+    async def user(u : int):
+        for i in range(questions):
+            start = time.perf_counter()
+            first = None
+            async for is_intent, answer in predict.answer_question_stream_async(f"use veryfi to delete document {u} {i}"):
+                if first is None:
+                    first = time.perf_counter() - start
+            latencies.append(time.perf_counter() - start)
+            first_updates.append(first)
+
+    try:
+        await asyncio.gather(*[user(u) for u in range(users)])
+    finally:
+        await close_aiosession()
+    return latencies, first_updates
+
+
+def run_sync(users : int, questions : int) -> Tuple[List[float], List[float]]:
+    import predict
+    latencies, first_updates = [], []
+    lock = threading.Lock()
+
+    def user(u : int):
+        for i in range(questions):
+            start = time.perf_counter()
+            first = None
+            for is_intent, answer in predict.answer_question_stream(f"use veryfi to delete document {u} {i}"):
+                if first is None:
+                    first = time.perf_counter() - start
+            with lock:
+                latencies.append(time.perf_counter() - start)
+                first_updates.append(first)
+
+    with ThreadPoolExecutor(max_workers=users) as pool:
+        list(pool.map(user, range(users)))
+    return latencies, first_updates
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--users", default="1,4,16,32")
+    parser.add_argument("--questions", type=int, default=4)
+    parser.add_argument("--chunk-latency", type=float, default=0.02)
+    parser.add_argument("--mode", choices=["async", "sync", "both"], default="both")
+    args = parser.parse_args()
+
+    data = os.path.abspath("data")
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    os.chdir(tempfile.mkdtemp(prefix="chat_loadtest"))
+    os.symlink(data, "data")
+    os.environ.setdefault("OPENAI_API_KEY", "test")
+    os.environ["ANSWER_CACHE_ENABLED"] = "0"
+    os.environ["INTENT_GATE_ENABLED"] = "0"
+    os.environ["INDEX_WARMUP"] = "lazy"
+
+    import openai
+    server = FakeOpenAIServer(reply=REPLY, chunk_size=4, chunk_latency=args.chunk_latency).start()
+    openai.api_base = server.api_base
+    openai.api_key = os.environ["OPENAI_API_KEY"]
+
+    import predict
+    from indexing import build_index_db, set_current_version, to_document, set_embeddings
+    from pipeline import read_docs
+    set_embeddings(server.embeddings())
+    version, _ = build_index_db([to_document(doc) for doc in read_docs(predict.INDEX_NAME)], predict.INDEX_NAME)
+    set_current_version(predict.INDEX_NAME, version)
+    predict.get_index_state()
+
+    modes = ["async", "sync"] if args.mode == "both" else [args.mode]
+    print(f"{args.questions} questions per user, {len(REPLY) // 4 + 1} chunks {args.chunk_latency * 1000:.0f}ms apart, "
+          f"PREDICT_WORKERS={predict.PREDICT_WORKERS}")
+    for mode in modes:
+        for users in map(int, args.users.split(",")):
+            start = time.perf_counter()
+            if mode == "async":
+                latencies, first_updates = asyncio.run(run_async(users, args.questions))
+            else:
+                latencies, first_updates = run_sync(users, args.questions)
+            elapsed = time.perf_counter() - start
+            print(f"    {mode:<5} {users:4d} users  {len(latencies) / elapsed:7.2f} answers/s  "
+                  f"p50 {percentile(latencies, 0.5) * 1000:7.0f}ms  p99 {percentile(latencies, 0.99) * 1000:7.0f}ms  "
+                  f"first update p50 {percentile(first_updates, 0.5) * 1000:7.0f}ms")
+    server.stop()
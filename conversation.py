@@ -0,0 +1,120 @@
+import os
+import re
+from collections import deque
+from typing import List, Optional, Tuple
+from prompt_budget import count_tokens, count_message_tokens, truncate_tokens, TOKENS_PER_MESSAGE, TOKENS_PER_REPLY
+
+
+# Tokens of earlier turns put in a code prompt, on top of CODE_PROMPT_TOKEN_BUDGET. 0 answers every question on its own
+CONVERSATION_TOKEN_BUDGET = int(os.environ.get("CONVERSATION_TOKEN_BUDGET", "800"))
+# The newest turns are kept word for word, older ones only as a summary line (see summarize_turn)
+CONVERSATION_FULL_TURNS = int(os.environ.get("CONVERSATION_FULL_TURNS", "2"))
+# Turns remembered per session, the oldest is forgotten past it
+CONVERSATION_MAX_TURNS = int(os.environ.get("CONVERSATION_MAX_TURNS", "20"))
+# Earlier questions put before a follow up ("now do the same with a url") to route it and retrieve its doc.
+# Its intent is checked on its own, an off topic follow up doesn't inherit the previous question's functions
+CONVERSATION_QUERY_TURNS = int(os.environ.get("CONVERSATION_QUERY_TURNS", "1"))
+# A question of at most this many words can't stand on its own ("with a url"), it is a follow up unless it clearly
+# matches the index by itself. Longer ones are only follow ups if they refer back (see refers_back)
+CONVERSATION_FOLLOW_UP_WORDS = int(os.environ.get("CONVERSATION_FOLLOW_UP_WORDS", "5"))
+# Words said of something from an earlier turn ("now delete it", "do the same with a url")
+FOLLOW_UP_WORDS = frozenset(["it", "its", "they", "them", "these", "those", "same", "again", "instead", "also", "too",
+                             "another", "previous", "above", "else"])
+# The question of a summarized turn is cut to this many tokens
+SUMMARY_QUESTION_TOKENS = 40
+SUMMARY_HEADER = "Earlier in this conversation I asked (and the functions your answer used):"
+
+# Methods called in the code of an answer, e.g. veryfi_client.process_document_url(...)
+_CALL_PATTERN = re.compile(r"\.(\w+)\(")
+
+
+"""
+Whether question refers to an earlier turn, rather than standing on its own
+"""
+def refers_back(question : str) -> bool:
+    return not FOLLOW_UP_WORDS.isdisjoint(re.findall(r"[a-z]+", question.lower()))
+
+
+"""
+One line standing for a turn once it's out of the full turns: its question, cut, and the functions its answer called
+"""
+def summarize_turn(question : str, answer : str) -> str:
+    out = f"- {truncate_tokens(question.strip(), SUMMARY_QUESTION_TOKENS)}"
+    calls = list(dict.fromkeys(_CALL_PATTERN.findall(answer)))[:3]
+    if calls:
+        out += f" -> {', '.join(calls)}"
+    return out
+
+
+"""
+A question and its answer as text (markdown, not the html shown in the chat). The answer is dropped by compact(),
+only the summary is left
+"""
+class Turn:
+    def __init__(self, question : str, answer : str):
+        self.question = question
+        self.answer : Optional[str] = answer
+        self.summary = summarize_turn(question, answer)
+
+    def compact(self):
+        self.answer = None
+
+
+"""
+What a chat session said so far, to answer follow up questions
+
+Holds at most max_turns turns, only the last full_turns of them with their answer, so a session's memory doesn't grow
+with its length. messages packs them into a prompt within a fixed token window. Kept in the app's per session state,
+no lock: it is deep copied for every new session and a session asks one question at a time
+"""
+class Conversation:
+    def __init__(self, max_turns : int = CONVERSATION_MAX_TURNS, full_turns : int = CONVERSATION_FULL_TURNS):
+        self.turns : deque = deque(maxlen=max_turns)
+        self.full_turns = full_turns
+
+    def __len__(self) -> int:
+        return len(self.turns)
+
+    def add(self, question : str, answer : str):
+        self.turns.append(Turn(question, answer))
+        turns = list(self.turns)
+        for turn in turns[:max(len(turns) - self.full_turns, 0)]:
+            turn.compact()
+
+    """
+    question with the last turns questions before it, what a follow up is routed and retrieved by. question itself on a new conversation
+    """
+    def query(self, question : str, turns : int = CONVERSATION_QUERY_TURNS) -> str:
+        earlier = [turn.question.strip() for turn in list(self.turns)[-turns:]] if turns > 0 else []
+        return "\n".join(earlier + [question])
+
+    """
+    Earlier turns as chat messages to go before the question, within budget tokens
+
+    Newest first: full turns as user and assistant messages while they fit, then older turns (and a full one that
+    doesn't fit) as summary lines in one system message before them, up to the oldest that still fits.
+    Returns the messages, in order, and their token count
+    """
+    def messages(self, budget : int = CONVERSATION_TOKEN_BUDGET) -> Tuple[List[dict], int]:
+        full : List[dict] = []
+        summaries : List[str] = []
+        used = 0
+        for turn in reversed(list(self.turns)):
+            if turn.answer is not None and not summaries:
+                pair = [{"role" : "user", "content" : turn.question}, {"role" : "assistant", "content" : turn.answer}]
+                cost = count_message_tokens(pair) - TOKENS_PER_REPLY
+                if used + cost <= budget:
+                    full[:0] = pair
+                    used += cost
+                    continue
+            # A line and its newline, the first one also pays for the message
+            cost = count_tokens(turn.summary) + 1
+            if not summaries:
+                cost += TOKENS_PER_MESSAGE + count_tokens("system") + count_tokens(SUMMARY_HEADER)
+            if used + cost > budget:
+                break
+            summaries.insert(0, turn.summary)
+            used += cost
+        if summaries:
+            return [{"role" : "system", "content" : "\n".join([SUMMARY_HEADER] + summaries)}] + full, used
+        return full, used
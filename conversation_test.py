@@ -0,0 +1,85 @@
+import copy
+import unittest
+from conversation import Conversation, summarize_turn, refers_back, SUMMARY_HEADER
+from prompt_budget import count_message_tokens, TOKENS_PER_REPLY
+
+
+CODE = "```python\nclient = Client(client_id, client_secret, username, api_key)\nresponse = client.{}(document_id)\n```"
+
+
+class TestConversation(unittest.TestCase):
+
+    def ask(self, conversation, turns):
+        for i in range(turns):
+            conversation.add(f"question {i} about document_{i}", CODE.format(f"method_{i}"))
+
+
+    def test_summarize_turn(self):
+        self.assertEqual(summarize_turn("  use veryfi to delete a document ", CODE.format("delete_document")),
+                         "- use veryfi to delete a document -> delete_document")
+        self.assertEqual(summarize_turn("what can it do?", "Sorry"), "- what can it do?")
+        self.assertLess(len(summarize_turn("word " * 500, "")), 500)
+
+
+    def test_bounded_memory(self):
+        conversation = Conversation(max_turns=5, full_turns=2)
+        self.ask(conversation, 12)
+        self.assertEqual(len(conversation), 5)
+        self.assertEqual([turn.question for turn in conversation.turns][0], "question 7 about document_7")
+        # Only the last two keep their answer
+        self.assertEqual([turn.answer is not None for turn in conversation.turns], [False, False, False, True, True])
+        # What the app keeps per session, a new session starts empty
+        self.assertEqual(len(copy.deepcopy(Conversation())), 0)
+
+
+    def test_messages(self):
+        conversation = Conversation(full_turns=2)
+        self.assertEqual(conversation.messages(), ([], 0))
+        self.ask(conversation, 4)
+        messages, tokens = conversation.messages(budget=10000)
+        self.assertEqual([message["role"] for message in messages], ["system", "user", "assistant", "user", "assistant"])
+        self.assertEqual(messages[0]["content"].split("\n"),
+                         [SUMMARY_HEADER, "- question 0 about document_0 -> method_0", "- question 1 about document_1 -> method_1"])
+        self.assertEqual(messages[-1]["content"], CODE.format("method_3"))
+        self.assertAlmostEqual(tokens, count_message_tokens(messages) - TOKENS_PER_REPLY, delta=3)
+
+        # The newest turn whole, the one before it no longer fits and is summarized, the oldest ones are left out
+        summary = {"role" : "system", "content" : f"{SUMMARY_HEADER}\n- question 2 about document_2 -> method_2"}
+        budget = count_message_tokens(messages[-2:] + [summary]) - TOKENS_PER_REPLY + 2
+        messages, tokens = conversation.messages(budget=budget)
+        self.assertEqual(messages[0], summary)
+        self.assertEqual(messages[1:], [{"role" : "user", "content" : "question 3 about document_3"},
+                                        {"role" : "assistant", "content" : CODE.format("method_3")}])
+        self.assertLessEqual(tokens, budget)
+        self.assertEqual(conversation.messages(budget=0), ([], 0))
+
+
+    def test_flat_prompt(self):
+        conversation = Conversation()
+        sizes = []
+        for _ in range(30):
+            self.ask(conversation, 1)
+            sizes.append(conversation.messages(budget=300)[1])
+        self.assertTrue(all(size <= 300 for size in sizes), sizes)
+        self.assertEqual(sizes[-1], sizes[-10])
+
+
+    def test_query(self):
+        conversation = Conversation()
+        self.assertEqual(conversation.query("process a document"), "process a document")
+        conversation.add(" process a document ", CODE.format("process_document"))
+        conversation.add("now delete it", CODE.format("delete_document"))
+        self.assertEqual(conversation.query("with a url"), "now delete it\nwith a url")
+        self.assertEqual(conversation.query("with a url", turns=2), "process a document\nnow delete it\nwith a url")
+        self.assertEqual(conversation.query("with a url", turns=0), "with a url")
+
+
+    def test_refers_back(self):
+        for question in ["now delete it", "Do the same with a url", "and them?", "process it again"]:
+            self.assertTrue(refers_back(question), question)
+        for question in ["delete document", "how do I process a document from a url", "Get the items of a receipt"]:
+            self.assertFalse(refers_back(question), question)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,161 @@
+from __future__ import annotations
+import os
+import time
+import threading
+from collections import OrderedDict, Counter
+from concurrent.futures import ThreadPoolExecutor, Future
+from typing import List, Dict, Tuple, Optional
+from langchain.embeddings.base import Embeddings
+from metrics import record_embedding_batch, count_embedding_query
+from prompt_budget import count_tokens
+from scheduler import RateLimitScheduler, embedding_scheduler
+
+
+# Query embeddings are batched across concurrent questions (see BatchingEmbeddings), 0 sends every query on its own
+QUERY_EMBEDDING_BATCHING = os.environ.get("QUERY_EMBEDDING_BATCHING", "1") == "1"
+# Seconds the first query of a batch waits for others to join it, and the most queries sent in one request
+QUERY_EMBEDDING_WINDOW = float(os.environ.get("QUERY_EMBEDDING_WINDOW", "0.005"))
+QUERY_EMBEDDING_MAX_BATCH = int(os.environ.get("QUERY_EMBEDDING_MAX_BATCH", "64"))
+# Batches sent to openai at once, and the number of recent query embeddings kept
+QUERY_EMBEDDING_CONCURRENCY = int(os.environ.get("QUERY_EMBEDDING_CONCURRENCY", "4"))
+QUERY_EMBEDDING_CACHE_SIZE = int(os.environ.get("QUERY_EMBEDDING_CACHE_SIZE", "1024"))
+
+
+"""
+Embeddings wrapper that sends the embed_query calls of concurrent callers as one embed_documents request
+
+A query first looks in an LRU of the last cache_size query embeddings, then joins the request of the same text
+if one is already waiting or in flight, and otherwise waits in the pending batch. The batch is sent window
+seconds after its first query, or as soon as it holds max_batch queries, from a pool of at most concurrency
+requests, and every caller gets its own vector back (or the request's exception)
+
+embed_documents (index builds, the intent gate) is passed through as is, those are batched already.
+Queries are embedded with the document model, the same as the query model for openai's embeddings
+
+Analysis:
+    - n concurrent questions cost ceil(n / max_batch) requests instead of n, for at most window seconds more latency
+    - a question asked again within the last cache_size queries costs no request at all
+"""
+class BatchingEmbeddings(Embeddings):
+    def __init__(self,
+                 embeddings : Embeddings,
+                 window : float = QUERY_EMBEDDING_WINDOW,
+                 max_batch : int = QUERY_EMBEDDING_MAX_BATCH,
+                 cache_size : int = QUERY_EMBEDDING_CACHE_SIZE,
+                 concurrency : int = QUERY_EMBEDDING_CONCURRENCY):
+        self.embeddings = embeddings
+        self.window = window
+        self.max_batch = max_batch
+        self.cache_size = cache_size
+        self.stats : Counter = Counter()
+        # (text, future, time it was queued) waiting for the next batch
+        self._pending : List[Tuple[str, Future, float]] = []
+        # Text -> future of every query waiting or in flight, callers asking for the same text share it
+        self._in_flight : Dict[str, Future] = {}
+        self._cache : "OrderedDict[str, List[float]]" = OrderedDict()
+        self._condition = threading.Condition()
+        self._dispatcher : Optional[threading.Thread] = None
+        self._executor = ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="embed")
+
+    def embed_documents(self, texts : List[str]) -> List[List[float]]:
+        return self.embeddings.embed_documents(texts)
+
+    def embed_query(self, text : str) -> List[float]:
+        with self._condition:
+            self.stats["queries"] += 1
+            vector = self._cache.get(text)
+            if vector is not None:
+                self._cache.move_to_end(text)
+                self._count("cache_hit")
+                return list(vector)
+            future = self._in_flight.get(text)
+            if future is not None:
+                self._count("coalesced")
+            else:
+                self._count("sent")
+                future = Future()
+                self._in_flight[text] = future
+                self._pending.append((text, future, time.perf_counter()))
+                if self._dispatcher is None:
+                    self._dispatcher = threading.Thread(target=self._dispatch, name="embedding-batcher", daemon=True)
+                    self._dispatcher.start()
+                self._condition.notify()
+        return list(future.result())
+
+    def get_stats(self) -> Dict[str, int]:
+        with self._condition:
+            stats = dict(self.stats)
+        stats["saved"] = stats.get("queries", 0) - stats.get("requests", 0)
+        return stats
+
+    def _count(self, result : str):
+        self.stats[result] += 1
+        count_embedding_query(result)
+
+    def _dispatch(self):
+        while True:
+            with self._condition:
+                while not self._pending:
+                    self._condition.wait()
+                deadline = self._pending[0][2] + self.window
+                while len(self._pending) < self.max_batch:
+                    remaining = deadline - time.perf_counter()
+                    if remaining <= 0:
+                        break
+                    self._condition.wait(remaining)
+                batch = self._pending[:self.max_batch]
+                del self._pending[:self.max_batch]
+                self.stats["requests"] += 1
+            self._executor.submit(self._send, batch)
+
+    def _send(self, batch : List[Tuple[str, Future, float]]):
+        texts = [text for text, _, _ in batch]
+        now = time.perf_counter()
+        record_embedding_batch(len(batch), [now - queued for _, _, queued in batch])
+        try:
+            vectors = self.embeddings.embed_documents(texts)
+        except Exception as e:
+            with self._condition:
+                for text in texts:
+                    self._in_flight.pop(text, None)
+            for _, future, _ in batch:
+                future.set_exception(e)
+            return
+        with self._condition:
+            for text, vector in zip(texts, vectors):
+                self._in_flight.pop(text, None)
+                if self.cache_size > 0:
+                    self._cache[text] = vector
+                    self._cache.move_to_end(text)
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        for (_, future, _), vector in zip(batch, vectors):
+            future.set_result(vector)
+
+
+"""
+Embeddings wrapper that waits for a turn at the scheduler (see RateLimitScheduler) before every request, one
+per call, with the priority of the caller (an index rebuild is background). A 429 that gets through openai's
+client retries holds all embedding requests for a while
+"""
+class RateLimitedEmbeddings(Embeddings):
+    def __init__(self, embeddings : Embeddings, scheduler : Optional[RateLimitScheduler] = None, backoff : float = 1.):
+        self.embeddings = embeddings
+        self.scheduler = scheduler or embedding_scheduler
+        self.backoff = backoff
+
+    def embed_documents(self, texts : List[str]) -> List[List[float]]:
+        self.scheduler.acquire(sum(count_tokens(text) for text in texts))
+        return self._call(self.embeddings.embed_documents, texts)
+
+    def embed_query(self, text : str) -> List[float]:
+        self.scheduler.acquire(count_tokens(text))
+        return self._call(self.embeddings.embed_query, text)
+
+    def _call(self, fn, *args):
+        import openai
+        try:
+            return fn(*args)
+        except openai.error.RateLimitError:
+            self.scheduler.backoff(self.backoff)
+            raise
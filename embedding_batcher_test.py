@@ -0,0 +1,98 @@
+import time
+import threading
+import unittest
+from typing import List
+from langchain.embeddings.base import Embeddings
+from embedding_batcher import BatchingEmbeddings, RateLimitedEmbeddings
+from scheduler import RateLimitScheduler
+
+
+class CountingEmbeddings(Embeddings):
+    def __init__(self, fail : bool = False):
+        self.calls : List[List[str]] = []
+        self.fail = fail
+
+    def embed_documents(self, texts):
+        self.calls.append(list(texts))
+        time.sleep(0.02)
+        if self.fail:
+            raise ConnectionError("embeddings are down")
+        return [[float(len(text)), 1.] for text in texts]
+
+    def embed_query(self, text):
+        return self.embed_documents([text])[0]
+
+
+class TestBatchingEmbeddings(unittest.TestCase):
+
+    def embed_concurrently(self, embeddings, texts):
+        out = [None] * len(texts)
+
+        def run(i):
+            try:
+                out[i] = embeddings.embed_query(texts[i])
+            except Exception as e:
+                out[i] = e
+
+        threads = [threading.Thread(target=run, args=(i,)) for i in range(len(texts))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return out
+
+
+    def test_batches_concurrent_queries(self):
+        inner = CountingEmbeddings()
+        embeddings = BatchingEmbeddings(inner, window=0.05, max_batch=4)
+        texts = [f"question {'?' * i}" for i in range(10)]
+        vectors = self.embed_concurrently(embeddings, texts)
+        self.assertEqual(vectors, [[float(len(text)), 1.] for text in texts])
+        # 10 queries in batches of at most 4
+        self.assertEqual(sorted(len(call) for call in inner.calls), [2, 4, 4])
+        self.assertEqual(embeddings.get_stats(), {"queries" : 10, "sent" : 10, "requests" : 3, "saved" : 7})
+
+
+    def test_dedup_and_cache(self):
+        inner = CountingEmbeddings()
+        embeddings = BatchingEmbeddings(inner, window=0.05, cache_size=2)
+        vectors = self.embed_concurrently(embeddings, ["a", "a", "bb", "a"])
+        self.assertEqual(vectors, [[1., 1.], [1., 1.], [2., 1.], [1., 1.]])
+        self.assertEqual(inner.calls, [["a", "bb"]])
+
+        # Served from the LRU, then "a" is pushed out by "ccc" ("bb" was used last)
+        self.assertEqual(embeddings.embed_query("bb"), [2., 1.])
+        embeddings.embed_query("ccc")
+        embeddings.embed_query("a")
+        self.assertEqual(inner.calls[1:], [["ccc"], ["a"]])
+        stats = embeddings.get_stats()
+        self.assertEqual((stats["cache_hit"], stats["coalesced"], stats["sent"], stats["saved"]), (1, 2, 4, 4))
+
+
+    def test_errors_fan_out(self):
+        inner = CountingEmbeddings(fail=True)
+        embeddings = BatchingEmbeddings(inner, window=0.05)
+        errors = self.embed_concurrently(embeddings, ["a", "b", "a"])
+        self.assertTrue(all(isinstance(error, ConnectionError) for error in errors), errors)
+        self.assertEqual(len(inner.calls), 1)
+        # Failures aren't cached, the next query tries again
+        inner.fail = False
+        self.assertEqual(embeddings.embed_query("a"), [1., 1.])
+        self.assertEqual(len(inner.calls), 2)
+
+
+    def test_rate_limited(self):
+        inner = CountingEmbeddings()
+        scheduler = RateLimitScheduler("test", requests_per_minute=2, period=0.2, reserve=0.)
+        embeddings = RateLimitedEmbeddings(inner, scheduler)
+        self.assertEqual(embeddings.embed_documents(["a b c", "d"]), [[5., 1.], [1., 1.]])
+        # A request per call, the third one waits for the bucket
+        start = time.perf_counter()
+        embeddings.embed_query("a")
+        embeddings.embed_query("b")
+        self.assertGreater(time.perf_counter() - start, 0.05)
+        self.assertEqual(len(inner.calls), 3)
+
+
+if __name__ == '__main__':
+    unittest.main()
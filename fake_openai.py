@@ -0,0 +1,239 @@
+import json
+import time
+import hashlib
+import threading
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, List, Optional, Union, Sequence, Dict, TYPE_CHECKING
+if TYPE_CHECKING:
+    from langchain.embeddings.base import Embeddings
+
+
+# The default listen backlog of 5 drops connections (retried a second later) when many clients connect at once
+class _Server(ThreadingHTTPServer):
+    request_queue_size = 128
+
+
+"""
+Local stand-in for the openai REST API, so tests and benchmarks run without network access or an API key
+
+Serves:
+    POST /v1/chat/completions   (plain and stream=True)
+    POST /v1/embeddings
+
+Usage:
+    with FakeOpenAIServer(reply="```python\\nprint(1)\\n```") as server:
+        openai.api_base = server.api_base
+        ...
+
+latency is waited before answering any request, embedding_latency (if set) replaces it for embeddings,
+chunk_latency is waited between the chunks of a stream
+
+A flaky openai is scripted per chat completion request, in the order they arrive: errors[i] is the http status
+the i-th one fails with (0, or past the end of the list, to answer it), delays[i] the extra seconds it waits.
+For example errors=[503, 429] fails the first two requests and answers the rest
+
+rpm and tpm enforce rate limits like openai's, per api (chat completions and embeddings apart): up to rpm requests
+and tpm tokens (words, plus max_tokens for chat) at once, given back continuously over rate_period seconds. A request
+over what is left is answered 429, with the seconds until it would fit in Retry-After. rate_limited counts them per api
+"""
+class FakeOpenAIServer:
+    def __init__(self,
+                 reply : Union[str, Callable[[List[dict]], str]] = "yes",
+                 chunk_size : int = 4,
+                 latency : float = 0.,
+                 chunk_latency : float = 0.,
+                 embedding_dim : int = 64,
+                 embedding_latency : Optional[float] = None,
+                 errors : Sequence[int] = (),
+                 delays : Sequence[float] = (),
+                 rpm : int = 0,
+                 tpm : int = 0,
+                 rate_period : float = 60.):
+        self.reply = reply
+        self.chunk_size = chunk_size
+        self.latency = latency
+        self.embedding_latency = embedding_latency
+        self.chunk_latency = chunk_latency
+        self.embedding_dim = embedding_dim
+        self.errors = list(errors)
+        self.delays = list(delays)
+        self._chat_count = 0
+        self._chat_count_lock = threading.Lock()
+        self.rpm = rpm
+        self.tpm = tpm
+        self.rate_period = rate_period
+        self.rate_limited : Counter = Counter()
+        # api -> requests and tokens left, and when they were last given back
+        self._limits : Dict[str, Dict[str, float]] = {}
+        self._usage_lock = threading.Lock()
+        # (path, request body) of every request received, in order
+        self.requests : List[tuple] = []
+        self._server : Optional[ThreadingHTTPServer] = None
+        self._thread : Optional[threading.Thread] = None
+
+    @property
+    def api_base(self) -> str:
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}/v1"
+
+    def start(self) -> "FakeOpenAIServer":
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def do_POST(self):
+                body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+                fake.requests.append((self.path, body))
+                latency = fake.embedding_latency if fake.embedding_latency is not None and self.path.endswith("/embeddings") else fake.latency
+                if latency:
+                    time.sleep(latency)
+                api = "chat" if self.path.endswith("/chat/completions") else "embeddings"
+                retry_after = fake._over_limit(api, fake._request_tokens(api, body))
+                if retry_after is not None:
+                    fake._error(self, 429, retry_after)
+                    return
+                if self.path.endswith("/chat/completions"):
+                    with fake._chat_count_lock:
+                        i = fake._chat_count
+                        fake._chat_count += 1
+                    if i < len(fake.delays) and fake.delays[i]:
+                        time.sleep(fake.delays[i])
+                    if i < len(fake.errors) and fake.errors[i]:
+                        fake._error(self, fake.errors[i])
+                    else:
+                        fake._chat(self, body)
+                elif self.path.endswith("/embeddings"):
+                    fake._embeddings(self, body)
+                else:
+                    fake._send_json(self, 404, {"error" : {"message" : f"Unknown path {self.path}", "type" : "invalid_request_error"}})
+
+        self._server = _Server(("127.0.0.1", 0), Handler)
+        self._server.daemon_threads = True
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        if self._server:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+
+    def __enter__(self) -> "FakeOpenAIServer":
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
+
+    """
+    langchain embeddings client for this server (with openai.api_base set to api_base). It sends text instead of
+    tiktoken ids, tiktoken downloads its encoding on first use and wouldn't work offline
+    """
+    def embeddings(self) -> "Embeddings":
+        from langchain.embeddings import OpenAIEmbeddings
+        return OpenAIEmbeddings(embedding_ctx_length=0, openai_api_key="test")
+
+    """
+    Deterministic bag of words embedding, texts sharing words get similar vectors
+    """
+    def embed(self, text : str) -> List[float]:
+        vector = [0.] * self.embedding_dim
+        for word in text.lower().split():
+            digest = hashlib.md5(word.encode()).digest()
+            vector[int.from_bytes(digest[:4], "little") % self.embedding_dim] += 1.
+        norm = sum(v * v for v in vector) ** 0.5 or 1.
+        return [v / norm for v in vector]
+
+    def _request_tokens(self, api : str, body : dict) -> int:
+        if api == "chat":
+            return sum(len(message.get("content", "").split()) for message in body.get("messages", [])) + body.get("max_tokens", 0)
+        texts = body.get("input", [])
+        texts = [texts] if isinstance(texts, str) else texts
+        return sum(len(text.split()) if isinstance(text, str) else len(text) for text in texts)
+
+    """
+    Seconds until a request of tokens fits in the limits, None if it does now (it is counted then)
+    """
+    def _over_limit(self, api : str, tokens : int) -> Optional[float]:
+        if not self.rpm and not self.tpm:
+            return None
+        with self._usage_lock:
+            now = time.monotonic()
+            usage = self._limits.setdefault(api, {"requests" : self.rpm, "tokens" : self.tpm, "updated" : now})
+            wait = 0.
+            for kind, limit, amount in (("requests", self.rpm, 1), ("tokens", self.tpm, min(tokens, self.tpm))):
+                if limit:
+                    usage[kind] = min(limit, usage[kind] + (now - usage["updated"]) * limit / self.rate_period)
+                    wait = max(wait, (amount - usage[kind]) * self.rate_period / limit)
+            usage["updated"] = now
+            if wait > 1e-6:
+                self.rate_limited[api] += 1
+                return wait
+            usage["requests"] -= 1
+            usage["tokens"] -= min(tokens, self.tpm)
+            return None
+
+    def _reply_text(self, messages : List[dict]) -> str:
+        return self.reply(messages) if callable(self.reply) else self.reply
+
+    def _chat(self, handler : BaseHTTPRequestHandler, body : dict):
+        text = self._reply_text(body.get("messages", []))
+        created = int(time.time())
+        if not body.get("stream"):
+            self._send_json(handler, 200, {
+                "id" : "chatcmpl-fake", "object" : "chat.completion", "created" : created, "model" : body.get("model"),
+                "choices" : [{"index" : 0, "message" : {"role" : "assistant", "content" : text}, "finish_reason" : "stop"}],
+                "usage" : self._usage(body.get("messages", []), text),
+            })
+            return
+
+        handler.send_response(200)
+        handler.send_header("Content-Type", "text/event-stream")
+        handler.end_headers()
+        deltas = [{"role" : "assistant"}] + \
+                 [{"content" : text[i : i + self.chunk_size]} for i in range(0, len(text), self.chunk_size)]
+        for i, delta in enumerate(deltas):
+            if i > 0 and self.chunk_latency:
+                time.sleep(self.chunk_latency)
+            chunk = {"id" : "chatcmpl-fake", "object" : "chat.completion.chunk", "created" : created, "model" : body.get("model"),
+                     "choices" : [{"index" : 0, "delta" : delta, "finish_reason" : None}]}
+            handler.wfile.write(f"data: {json.dumps(chunk)}\n\n".encode())
+            handler.wfile.flush()
+        handler.wfile.write(b"data: [DONE]\n\n")
+        handler.wfile.flush()
+
+    # Words stand in for tokens
+    def _usage(self, messages : List[dict], text : str) -> dict:
+        prompt_tokens = sum(len(message.get("content", "").split()) for message in messages)
+        completion_tokens = len(text.split())
+        return {"prompt_tokens" : prompt_tokens, "completion_tokens" : completion_tokens, "total_tokens" : prompt_tokens + completion_tokens}
+
+    def _embeddings(self, handler : BaseHTTPRequestHandler, body : dict):
+        texts = body.get("input", [])
+        if isinstance(texts, str) or (texts and isinstance(texts[0], int)):
+            texts = [texts]
+        # langchain sends tiktoken ids instead of text for long inputs, treat each id as a word
+        texts = [text if isinstance(text, str) else " ".join(map(str, text)) for text in texts]
+        self._send_json(handler, 200, {
+            "object" : "list", "model" : body.get("model"),
+            "data" : [{"object" : "embedding", "index" : i, "embedding" : self.embed(text)} for i, text in enumerate(texts)],
+            "usage" : {"prompt_tokens" : 0, "total_tokens" : 0},
+        })
+
+    def _error(self, handler : BaseHTTPRequestHandler, status : int, retry_after : float = 0.):
+        kind = {429 : "rate_limit_error", 503 : "server_overloaded"}.get(status, "server_error" if status >= 500 else "invalid_request_error")
+        self._send_json(handler, status, {"error" : {"message" : f"Scripted {status}", "type" : kind}},
+                        {"Retry-After" : f"{retry_after:.3f}"} if status == 429 else {})
+
+    def _send_json(self, handler : BaseHTTPRequestHandler, status : int, payload : dict, headers : Optional[dict] = None):
+        data = json.dumps(payload).encode()
+        handler.send_response(status)
+        handler.send_header("Content-Type", "application/json")
+        handler.send_header("Content-Length", str(len(data)))
+        for name, value in (headers or {}).items():
+            handler.send_header(name, value)
+        handler.end_headers()
+        handler.wfile.write(data)
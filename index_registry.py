@@ -0,0 +1,180 @@
+from __future__ import annotations
+import os
+import json
+import logging
+import threading
+import jsonlines
+from collections import OrderedDict, Counter
+from pydantic import BaseModel
+from typing import List, Dict, Optional, Callable, TYPE_CHECKING
+from lexical import tokenize
+
+if TYPE_CHECKING:
+    from indexing import IndexState
+
+
+# Json list of the indexes to serve (see IndexSpec), only the built-in veryfi-python one without it
+INDEX_REGISTRY_PATH = os.environ.get("INDEX_REGISTRY_PATH") or None
+# Estimated megabytes the open indexes may take together, past it the least recently used ones are closed
+# (and opened again by their next question)
+INDEX_MEMORY_CAP_MB = float(os.environ.get("INDEX_MEMORY_CAP_MB", "512"))
+# A keyword of an index in the question counts as much as this many words of its function names
+ROUTE_KEYWORD_WEIGHT = 10
+
+logger = logging.getLogger(__name__)
+
+
+"""
+One named index: its sources (raw file or github tree urls, see ingest_doc_page), persisted under {name}_index
+and data/{name}_doc.jsonl. title names the package in the UI and the prompts, keywords in a question pick this
+index (e.g. nodejs), few_shot adds the veryfi-python client examples to its code prompt
+"""
+class IndexSpec(BaseModel):
+    name     : str
+    title    : str
+    sources  : List[str]
+    keywords : List[str] = []
+    few_shot : bool = False
+
+
+"""
+The specs in the json file at path, the default spec (first, the one questions go to when none is a better match)
+when there is no file. The default is kept unless the file has a spec of the same name
+"""
+def load_index_specs(default : IndexSpec, path : Optional[str] = INDEX_REGISTRY_PATH) -> List[IndexSpec]:
+    if not path:
+        return [default]
+    with open(path, "r") as f:
+        specs = [IndexSpec(**spec) for spec in json.load(f)]
+    if default.name not in [spec.name for spec in specs]:
+        specs.insert(0, default)
+    return specs
+
+
+"""
+The named indexes served by one process, opened on first use and kept open in least recently used order
+while their estimated memory (IndexState.memory_bytes) stays under memory_cap bytes
+
+open_index(spec) opens the persisted index of a spec (None if it was never built), put swaps in a rebuilt one.
+A closed index is only dropped from here, requests still reading it finish with it
+
+route picks the index a question is about
+"""
+class IndexRegistry:
+    def __init__(self, specs : List[IndexSpec], open_index : Callable[[IndexSpec], Optional[IndexState]],
+                 memory_cap : float = INDEX_MEMORY_CAP_MB * 2 ** 20):
+        if not specs:
+            raise ValueError("At least one index is needed")
+        self.specs : Dict[str, IndexSpec] = {spec.name : spec for spec in specs}
+        self.default = specs[0].name
+        self.open_index = open_index
+        self.memory_cap = memory_cap
+        self.stats : Counter = Counter()
+        self._open : "OrderedDict[str, IndexState]" = OrderedDict()
+        self._open_locks : Dict[str, threading.Lock] = {name : threading.Lock() for name in self.specs}
+        # Words of the function names of every index, for route
+        self._vocabulary : Dict[str, frozenset] = {}
+        self._lock = threading.Lock()
+
+    def spec(self, name : Optional[str] = None) -> IndexSpec:
+        name = name or self.default
+        if name not in self.specs:
+            raise ValueError(f"Unknown index {name}, one of {list(self.specs)}")
+        return self.specs[name]
+
+    """
+    The open index, opened (see open_index) if it isn't. None if it was never built
+    """
+    def get(self, name : Optional[str] = None) -> Optional[IndexState]:
+        spec = self.spec(name)
+        state = self.peek(spec.name)
+        if state is not None:
+            return state
+        with self._open_locks[spec.name]:
+            state = self.peek(spec.name)
+            if state is None:
+                state = self.open_index(spec)
+                if state is not None:
+                    self.stats["opened"] += 1
+                    self.put(spec.name, state)
+        return state
+
+    """
+    The open index if it is, without opening it. Counts as a use
+    """
+    def peek(self, name : Optional[str] = None) -> Optional[IndexState]:
+        name = name or self.default
+        with self._lock:
+            state = self._open.get(name)
+            if state is not None:
+                self._open.move_to_end(name)
+        return state
+
+    """
+    Serve name from state from now on (a newly opened or rebuilt version), closing other indexes if that goes over the cap
+    """
+    def put(self, name : str, state : IndexState):
+        self.spec(name)
+        with self._lock:
+            self._open[name] = state
+            self._open.move_to_end(name)
+            self._vocabulary.pop(name, None)
+        self._enforce_cap(keep=name)
+
+    def evict(self, name : str):
+        with self._lock:
+            if self._open.pop(name, None) is not None:
+                self.stats["evicted"] += 1
+
+    def memory_bytes(self) -> Dict[str, int]:
+        with self._lock:
+            states = list(self._open.items())
+        return {name : state.memory_bytes() for name, state in states}
+
+    def _enforce_cap(self, keep : str):
+        sizes = self.memory_bytes()
+        total = sum(sizes.values())
+        with self._lock:
+            for name in list(self._open):
+                if total <= self.memory_cap:
+                    break
+                # The index just opened stays even alone over the cap, it is about to be used
+                if name != keep:
+                    del self._open[name]
+                    total -= sizes.get(name, 0)
+                    self.stats["evicted"] += 1
+                    logger.info("Closed index %s to stay under %.0fMB", name, self.memory_cap / 2 ** 20)
+
+    """
+    Name of the index to answer question from: selected if it names one (a pick in the UI), else the index whose
+    keywords (ROUTE_KEYWORD_WEIGHT each) and function name words the question shares the most of, the default on a tie
+    """
+    def route(self, question : str, selected : Optional[str] = None) -> str:
+        if selected in self.specs:
+            return selected
+        if len(self.specs) == 1:
+            return self.default
+        words, stemmed = set(tokenize(question, stem=False)), set(tokenize(question))
+        best, best_score = self.default, 0
+        for name, spec in self.specs.items():
+            score = ROUTE_KEYWORD_WEIGHT * len(words & set(tokenize(" ".join(spec.keywords), stem=False))) + \
+                    len(stemmed & self._name_words(name))
+            if score > best_score:
+                best, best_score = name, score
+        return best
+
+    def _name_words(self, name : str) -> frozenset:
+        words = self._vocabulary.get(name)
+        if words is None:
+            words = set()
+            path = f"data/{name}_doc.jsonl"
+            if os.path.isfile(path):
+                with jsonlines.open(path, "r") as reader:
+                    for doc in reader:
+                        words.update(tokenize(doc["name"].rsplit(".", 1)[-1]))
+            words = self._vocabulary[name] = frozenset(words)
+        return words
+
+    def get_stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {**self.stats, "open" : len(self._open)}
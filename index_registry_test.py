@@ -0,0 +1,86 @@
+import os
+import json
+import tempfile
+import unittest
+import jsonlines
+from index_registry import IndexRegistry, IndexSpec, load_index_specs
+
+
+class FakeState:
+    def __init__(self, size : int):
+        self.size = size
+
+    def memory_bytes(self) -> int:
+        return self.size
+
+
+class TestIndexRegistry(unittest.TestCase):
+
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.tmp = tempfile.TemporaryDirectory()
+        os.chdir(self.tmp.name)
+        os.makedirs("data")
+        self.specs = [IndexSpec(name="python", title="veryfi-python", sources=[], keywords=["python"]),
+                      IndexSpec(name="nodejs", title="veryfi-nodejs", sources=[], keywords=["nodejs", "node"]),
+                      IndexSpec(name="java", title="veryfi-java", sources=[], keywords=["java"])]
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        self.tmp.cleanup()
+
+
+    def test_lru_eviction(self):
+        opened = []
+
+        def open_index(spec):
+            opened.append(spec.name)
+            return FakeState(40) if spec.name != "java" else None
+
+        registry = IndexRegistry(self.specs, open_index, memory_cap=100)
+        self.assertEqual(registry.get().size, 40)
+        self.assertIs(registry.get("python"), registry.get())
+        registry.get("nodejs")
+        # Never built, nothing is kept and it's asked again next time
+        self.assertIsNone(registry.get("java"))
+        self.assertIsNone(registry.get("java"))
+        self.assertEqual(opened, ["python", "nodejs", "java", "java"])
+
+        # python was used last, a 40 bytes rebuild of java pushes nodejs out
+        registry.get("python")
+        registry.put("java", FakeState(40))
+        self.assertEqual(registry.memory_bytes(), {"python" : 40, "java" : 40})
+        self.assertIsNone(registry.peek("nodejs"))
+        # Alone over the cap, the new one is still kept
+        registry.put("nodejs", FakeState(500))
+        self.assertEqual(registry.memory_bytes(), {"nodejs" : 500})
+        self.assertEqual(registry.get_stats(), {"opened" : 2, "evicted" : 3, "open" : 1})
+
+        with self.assertRaises(ValueError):
+            registry.get("go")
+
+
+    def test_route(self):
+        with jsonlines.open("data/nodejs_doc.jsonl", "w") as writer:
+            writer.write({"name" : "veryfi.Client.processDocumentUrl"})
+        registry = IndexRegistry(self.specs, lambda spec: None)
+        self.assertEqual(registry.route("How do I get started?"), "python")
+        self.assertEqual(registry.route("Process a receipt from node"), "nodejs")
+        self.assertEqual(registry.route("How do I process a document url?"), "nodejs")
+        # A pick in the UI wins, an unknown one is ignored
+        self.assertEqual(registry.route("Process a receipt from node", "java"), "java")
+        self.assertEqual(registry.route("How do I use java?", "go"), "java")
+
+
+    def test_load_specs(self):
+        default = self.specs[0]
+        self.assertEqual(load_index_specs(default, None), [default])
+        with open("indexes.json", "w") as f:
+            json.dump([{"name" : "nodejs", "title" : "veryfi-nodejs", "sources" : ["https://example.com/index.js"]}], f)
+        specs = load_index_specs(default, "indexes.json")
+        self.assertEqual([spec.name for spec in specs], ["python", "nodejs"])
+        self.assertEqual((specs[1].keywords, specs[1].few_shot), ([], False))
+
+
+if __name__ == '__main__':
+    unittest.main()
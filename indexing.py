@@ -1,35 +1,552 @@
+from __future__ import annotations
+import os
+import re
+import json
+import shutil
 import requests
-from preprocess import get_docs, FunctionDoc
-from typing import List, Tuple
+import time
+import hashlib
+import logging
+import threading
+import jsonlines
+from requests.adapters import HTTPAdapter
+from concurrent.futures import ThreadPoolExecutor
+from preprocess import get_docs, save_docs, FunctionDoc
+from typing import List, Tuple, Dict, Any, Callable, Optional, Union, Iterable, TYPE_CHECKING
+from vectorstore import NumpyVectorStore
+from lexical import LexicalIndex, fuse
+from prompt_budget import count_tokens
+from metrics import record_search
 
-from langchain.schema import Document
-from langchain.embeddings import OpenAIEmbeddings
-from langchain.vectorstores import Chroma
+# langchain is slow to import, it is only imported where documents are built or embedded (see predict startup)
+if TYPE_CHECKING:
+    from langchain.schema import Document
+    from langchain.embeddings.base import Embeddings
+    from langchain.vectorstores import Chroma
 
 
+# Number of docs sent to openai per embedding request when (re)building the index
+EMBEDDING_BATCH_SIZE = int(os.environ.get("EMBEDDING_BATCH_SIZE", "100"))
+# Source files fetched in parallel when ingesting, and the timeout of every request in seconds
+FETCH_WORKERS = int(os.environ.get("FETCH_WORKERS", "8"))
+FETCH_TIMEOUT = float(os.environ.get("FETCH_TIMEOUT", "10"))
+# Backend queries are served from: "chroma", or "numpy" for the in process NumpyVectorStore (no duckdb)
+VECTOR_STORE = os.environ.get("VECTOR_STORE", "chroma")
+# Rank documents by BM25 (see lexical) and by vector together. Questions that name a function outright are
+# answered from BM25 alone, without embedding them
+HYBRID_SEARCH = os.environ.get("HYBRID_SEARCH", "1") == "1"
+GITHUB_API_URL = "https://api.github.com"
+GITHUB_RAW_URL = "https://raw.githubusercontent.com"
+
+logger = logging.getLogger(__name__)
+
+
+_embeddings : Optional[Embeddings] = None
+_embeddings_lock = threading.Lock()
+
+
+"""
+Embeddings client shared by indexing and question embedding, openai's unless set_embeddings replaced it
+(the benchmarks use a client for the local openai stand-in). Requests wait for their turn at the openai
+rate limits (RateLimitedEmbeddings), and with QUERY_EMBEDDING_BATCHING the questions of concurrent users are
+embedded together (BatchingEmbeddings)
+"""
+def get_embeddings() -> Embeddings:
+    global _embeddings
+    with _embeddings_lock:
+        if _embeddings is None:
+            from langchain.embeddings import OpenAIEmbeddings
+            _embeddings = _wrap_embeddings(OpenAIEmbeddings())
+        return _embeddings
+
+
+"""
+Use these embeddings from now on, None goes back to openai's. Only affects indexes opened afterwards
+"""
+def set_embeddings(embeddings : Optional[Embeddings]):
+    global _embeddings
+    with _embeddings_lock:
+        _embeddings = _wrap_embeddings(embeddings) if embeddings is not None else None
+
+
+def _wrap_embeddings(embeddings : Embeddings) -> Embeddings:
+    from embedding_batcher import BatchingEmbeddings, RateLimitedEmbeddings, QUERY_EMBEDDING_BATCHING
+    if isinstance(embeddings, (BatchingEmbeddings, RateLimitedEmbeddings)):
+        return embeddings
+    embeddings = RateLimitedEmbeddings(embeddings)
+    return BatchingEmbeddings(embeddings) if QUERY_EMBEDDING_BATCHING else embeddings
+
+
+"""
+Id of a document in the index, a hash of its content, so an unchanged FunctionDoc keeps its id across rebuilds
+"""
+def doc_hash(text : str) -> str:
+    return hashlib.sha256(text.encode()).hexdigest()
+
+
+"""
+Persistent content hash -> embedding store, one {"hash", "embedding"} record per line
+"""
+def load_embedding_cache(path : str) -> Dict[str, List[float]]:
+    if not os.path.isfile(path):
+        return {}
+    with jsonlines.open(path, "r") as reader:
+        return {record["hash"] : record["embedding"] for record in reader}
+
+
+def save_embedding_cache(path : str, cache : Dict[str, List[float]]):
+    tmp_path = f"{path}.tmp"
+    with jsonlines.open(tmp_path, "w") as writer:
+        for key, embedding in cache.items():
+            writer.write({"hash" : key, "embedding" : embedding})
+    os.replace(tmp_path, path)
+
+
+"""
+Layout of the persisted index:
+
+    {index_name}_index/
+        embedding_cache.jsonl       content hash -> embedding, shared by all versions
+        CURRENT                     name of the version queries are served from
+        versions/{version}/         one Chroma persist directory per build, or vectors.npy + documents.jsonl
+                                    for the numpy backend
+
+A version is named after the hash of the document ids it holds, so rebuilding unchanged docs is a no-op.
+A new version is written next to the live one, marked with a COMPLETE file once fully persisted, and only
+becomes CURRENT after that. Readers of the previous version are never affected by a rebuild
+"""
+def get_index_directory(index_name : str) -> str:
+    return index_name + "_index"
+
+
+def get_version_directory(index_name : str, version : str) -> str:
+    return os.path.join(get_index_directory(index_name), "versions", version)
+
+
+def get_current_version(index_name : str) -> Optional[str]:
+    path = os.path.join(get_index_directory(index_name), "CURRENT")
+    if not os.path.isfile(path):
+        return None
+    with open(path, "r") as f:
+        version = f.read().strip()
+    # A version built for the other backend doesn't count, switching VECTOR_STORE triggers a (cached) rebuild
+    return version if version and is_version_complete(index_name, version) else None
+
+
+"""
+Point CURRENT to version, write then rename so readers see either the old or the new version
+"""
+def set_current_version(index_name : str, version : str):
+    path = os.path.join(get_index_directory(index_name), "CURRENT")
+    with open(f"{path}.tmp", "w") as f:
+        f.write(version)
+    os.replace(f"{path}.tmp", path)
+
+
+"""
+Version name of an index holding the given document ids
+"""
+def get_documents_version(ids : Iterable[str]) -> str:
+    return hashlib.sha1("\n".join(sorted(ids)).encode()).hexdigest()[:12]
+
+
+def is_version_complete(index_name : str, version : str, backend : Optional[str] = None) -> bool:
+    version_directory = get_version_directory(index_name, version)
+    if (backend or VECTOR_STORE) == "numpy":
+        return NumpyVectorStore.exists(version_directory)
+    return os.path.isfile(os.path.join(version_directory, "COMPLETE"))
+
+
+"""
+Builds a new index version from documents streamed in batches, see build_index_db
+
+add() embeds the documents of a batch that are not in the embedding cache right away, and only keeps their ids.
+finish() iterates over the documents a second time (e.g. read back from the jsonl they were written to)
+to write the added ones to the collection, so the documents never need to be held in memory all at once
+"""
+class IndexBuilder:
+    def __init__(self, index_name : str, embeddings : Optional[Embeddings] = None, backend : Optional[str] = None):
+        self.index_name = index_name
+        self.embeddings = embeddings or get_embeddings()
+        self.backend = backend or VECTOR_STORE
+        os.makedirs(os.path.join(get_index_directory(index_name), "versions"), exist_ok=True)
+        self.cache_path = os.path.join(get_index_directory(index_name), "embedding_cache.jsonl")
+        self.cache : Dict[str, List[float]] = load_embedding_cache(self.cache_path)
+        # Ids of every document added so far, in order
+        self.ids : Dict[str, None] = {}
+        self.embedded = 0
+
+    def add(self, documents : Iterable[Document]):
+        missing : Dict[str, str] = {}
+        for doc in documents:
+            key = doc_hash(doc.page_content)
+            if key not in self.ids:
+                self.ids[key] = None
+                if key not in self.cache:
+                    missing[key] = doc.page_content
+        keys = list(missing)
+        for i in range(0, len(keys), EMBEDDING_BATCH_SIZE):
+            batch = keys[i : i + EMBEDDING_BATCH_SIZE]
+            vectors = self.embeddings.embed_documents([missing[key] for key in batch])
+            self.cache.update(zip(batch, vectors))
+            self.embedded += len(batch)
+
+    def finish(self, documents : Callable[[], Iterable[Document]]) -> Tuple[str, Dict[str, int]]:
+        version = get_documents_version(self.ids)
+        if is_version_complete(self.index_name, version, self.backend):
+            return version, {"added" : 0, "deleted" : 0, "unchanged" : len(self.ids), "embedded" : self.embedded}
+        # Only keep embeddings of the current docs, so the store doesn't grow with every change upstream
+        save_embedding_cache(self.cache_path, {key : self.cache[key] for key in self.ids})
+        if self.backend == "numpy":
+            return version, self._finish_numpy(version, documents)
+
+        # Leftover of an interrupted build
+        version_directory = get_version_directory(self.index_name, version)
+        shutil.rmtree(version_directory, ignore_errors=True)
+        current = get_current_version(self.index_name)
+        if current:
+            shutil.copytree(get_version_directory(self.index_name, current), version_directory, 
+                            ignore=shutil.ignore_patterns("COMPLETE*"))
+
+        from langchain.vectorstores import Chroma
+        vectordb   = Chroma(persist_directory=version_directory, embedding_function=self.embeddings)
+        collection = vectordb._collection
+        existing   = set(collection.get(include=[])["ids"])
+        deleted    = [key for key in existing if key not in self.ids]
+        if deleted:
+            collection.delete(ids=deleted)
+
+        added : Dict[str, Document] = {}
+        def flush():
+            metadatas = [doc.metadata for doc in added.values()]
+            collection.add(ids=list(added), 
+                           embeddings=[self.cache[key] for key in added],
+                           documents=[doc.page_content for doc in added.values()],
+                           metadatas=metadatas if any(metadatas) else None)
+            added.clear()
+
+        added_count = 0
+        for doc in documents():
+            key = doc_hash(doc.page_content)
+            if key not in existing and key not in added:
+                existing.add(key)
+                added[key] = doc
+                added_count += 1
+                if len(added) >= EMBEDDING_BATCH_SIZE:
+                    flush()
+        if added:
+            flush()
+        vectordb.persist()
+        open(os.path.join(version_directory, "COMPLETE"), "w").close()
+
+        stats = {"added" : added_count, "deleted" : len(deleted), 
+                 "unchanged" : len(self.ids) - added_count, "embedded" : self.embedded}
+        logger.info("build_index_db %s version=%s %s", self.index_name, version, stats)
+        return version, stats
+
+    """
+    The whole matrix is rewritten from the embedding cache, at this corpus size that is cheaper than copying
+    the previous version. Added and deleted are still counted against the current version
+    """
+    def _finish_numpy(self, version : str, documents : Callable[[], Iterable[Document]]) -> Dict[str, int]:
+        current = get_current_version(self.index_name)
+        existing = set(NumpyVectorStore.load_ids(get_version_directory(self.index_name, current))) if current else set()
+        rows : Dict[str, Document] = {}
+        for doc in documents():
+            rows.setdefault(doc_hash(doc.page_content), doc)
+        NumpyVectorStore.save(get_version_directory(self.index_name, version), list(rows),
+                              (self.cache[key] for key in rows), list(rows.values()))
+
+        added_count = len([key for key in rows if key not in existing])
+        stats = {"added" : added_count, "deleted" : len([key for key in existing if key not in rows]),
+                 "unchanged" : len(rows) - added_count, "embedded" : self.embedded}
+        logger.info("build_index_db %s version=%s backend=numpy %s", self.index_name, version, stats)
+        return stats
+
 
 """ 
-Build the index using openai embeddings and save to directory
+Build the index using openai embeddings and save to a new version directory, returns (version, stats)
+
+The index is built incrementally: every document is identified by the hash of its content,
+only documents whose hash is not in the embedding cache are embedded (in batches of EMBEDDING_BATCH_SIZE).
+The new version starts as a copy of the current one, and only the ids that were added or removed since are
+written to its collection. Rebuild time and embedding spend scale with the number of changed FunctionDocs, not with the corpus
+
+The new version is not made current, see validate_index_db and set_current_version
+Stats count added, deleted, unchanged and newly embedded documents
 """
-def build_index_db(documents : List[Document], index_name):
-    embeddings = OpenAIEmbeddings()
-    vectordb   = Chroma.from_documents(documents, embeddings, persist_directory=index_name+"_index")
-    vectordb.persist()
+def build_index_db(documents : List[Document], index_name, embeddings : Optional[Embeddings] = None) -> Tuple[str, Dict[str, int]]:
+    version = get_documents_version(doc_hash(doc.page_content) for doc in documents)
+    if is_version_complete(index_name, version):
+        return version, {"added" : 0, "deleted" : 0, "unchanged" : len(set(doc.page_content for doc in documents)), "embedded" : 0}
+    builder = IndexBuilder(index_name, embeddings)
+    builder.add(documents)
+    return builder.finish(lambda: documents)
 
 
 """
-Get pre-built index db
+Get pre-built index db, the current version unless a version is given
 """
-def get_index_db(persist_directory : str) -> Chroma:
-    embeddings = OpenAIEmbeddings()
-    vectordb = Chroma(persist_directory=persist_directory+"_index", embedding_function=embeddings)
+def get_index_db(index_name : str, version : Optional[str] = None, embeddings : Optional[Embeddings] = None) -> Union[Chroma, NumpyVectorStore]:
+    embeddings = embeddings or get_embeddings()
+    version = version or get_current_version(index_name)
+    if VECTOR_STORE == "numpy":
+        return NumpyVectorStore(get_version_directory(index_name, version), embeddings)
+    # Only the chroma backend pulls in chromadb and duckdb
+    from langchain.vectorstores import Chroma
+    vectordb = Chroma(persist_directory=get_version_directory(index_name, version), embedding_function=embeddings)
     return vectordb
 
 
+"""
+Sanity check a freshly built index before serving from it: it holds the expected number of documents
+and a nearest neighbour query on one of its own vectors returns that document
+"""
+def validate_index_db(vectordb : Union[Chroma, NumpyVectorStore], expected_count : int) -> bool:
+    if isinstance(vectordb, NumpyVectorStore):
+        return vectordb.validate(expected_count)
+    collection = vectordb._collection
+    if expected_count == 0 or collection.count() != expected_count:
+        return False
+    sample = collection.get(limit=1, include=["embeddings"])
+    result = collection.query(query_embeddings=sample["embeddings"], n_results=1, include=[])
+    return result["ids"][0][:1] == sample["ids"][:1]
+
+
+"""
+Delete old version directories, keeping the current one and the keep - 1 most recently built ones
+(requests that started before the last swap may still read the previous version)
+"""
+def prune_index_versions(index_name : str, keep : int = 2):
+    versions_directory = os.path.join(get_index_directory(index_name), "versions")
+    current = get_current_version(index_name)
+    versions = sorted((name for name in os.listdir(versions_directory) if name != current),
+                      key=lambda name: os.path.getmtime(os.path.join(versions_directory, name)), reverse=True)
+    for name in versions[max(keep - 1, 0):]:
+        shutil.rmtree(os.path.join(versions_directory, name), ignore_errors=True)
+
+
+_session : Optional[requests.Session] = None
+_session_lock = threading.Lock()
+
+
+"""
+Shared http session, connections to github are kept alive and reused across fetches and rebuilds
+"""
+def get_session() -> requests.Session:
+    global _session
+    with _session_lock:
+        if _session is None:
+            _session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=FETCH_WORKERS, pool_maxsize=FETCH_WORKERS)
+            _session.mount("https://", adapter)
+            _session.mount("http://", adapter)
+        return _session
+
+
+"""
+GET url, sending the ETag / Last-Modified seen last time (validators) as If-None-Match / If-Modified-Since
+
+Returns (text, validators), text is None when the server answered 304 Not Modified
+"""
+def fetch_if_changed(url : str, validators : Optional[Dict[str, str]] = None) -> Tuple[Optional[str], Dict[str, str]]:
+    validators = validators or {}
+    headers = {}
+    if validators.get("etag"):
+        headers["If-None-Match"] = validators["etag"]
+    if validators.get("last_modified"):
+        headers["If-Modified-Since"] = validators["last_modified"]
+    response = get_session().get(url, headers=headers, timeout=FETCH_TIMEOUT)
+    if response.status_code == 304:
+        return None, validators
+    response.raise_for_status()
+    return response.text, {"etag" : response.headers.get("ETag"), "last_modified" : response.headers.get("Last-Modified")}
+
+
+"""
+List the raw urls of every .py file under a github tree url, like
+https://github.com/veryfi/veryfi-python/tree/master/veryfi
+"""
+def list_package_files(tree_url : str) -> List[str]:
+    match = re.match(r"https://github\.com/([^/]+)/([^/]+)/tree/([^/]+)/?(.*)", tree_url)
+    if not match:
+        raise ValueError(f"Not a github tree url: {tree_url}")
+    owner, repo, branch, path = match.groups()
+    response = get_session().get(f"{GITHUB_API_URL}/repos/{owner}/{repo}/git/trees/{branch}", 
+                                 params={"recursive" : "1"}, timeout=FETCH_TIMEOUT)
+    response.raise_for_status()
+    prefix = path.strip("/") + "/" if path.strip("/") else ""
+    return [f"{GITHUB_RAW_URL}/{owner}/{repo}/{branch}/{item['path']}" for item in response.json()["tree"]
+            if item["type"] == "blob" and item["path"].startswith(prefix) and item["path"].endswith(".py")]
+
+
+def load_fetch_state(index_name : str) -> Dict[str, dict]:
+    path = os.path.join(get_index_directory(index_name), "fetch_state.json")
+    if not os.path.isfile(path):
+        return {}
+    with open(path, "r") as f:
+        return json.load(f)
+
+
+def save_fetch_state(index_name : str, state : Dict[str, dict]):
+    path = os.path.join(get_index_directory(index_name), "fetch_state.json")
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(f"{path}.tmp", "w") as f:
+        json.dump(state, f)
+    os.replace(f"{path}.tmp", path)
+
+
+"""
+Document indexed for a FunctionDoc, with its token count precomputed so prompts can be budgeted without
+encoding the doc again on every request (see prompt_budget)
+"""
+def to_document(doc : FunctionDoc) -> Document:
+    from langchain.schema import Document
+    text = str(doc)
+    return Document(page_content=text, metadata={"tokens" : count_tokens(text)})
+
+
 """
 Pull code from github and extract function signatures and docstrings
+
+doc_urls is one url or a list of them, raw file urls or github tree urls (expanded to every .py file under them).
+Files are fetched concurrently, at most FETCH_WORKERS at a time, with conditional requests.
+The parsed docs of every file are kept with its ETag / Last-Modified (in {index_name}_index/fetch_state.json),
+so a file the server reports as unchanged is neither downloaded nor parsed again. Since the index version is
+the hash of its docs, unchanged sources then make build_index_db a no-op as well, nothing is re-embedded
+
+Documents are returned in the order of the urls, and the docs of all files are written to data/{index_name}_doc.jsonl
 """
-def ingest_doc_page(doc_url, index_name) -> List[Document]:
-    code : str = requests.get(doc_url).text
-    docs : list[FunctionDoc] = get_docs(code, index_name)
-    return [Document(page_content=str(doc)) for doc in docs]
+def ingest_doc_page(doc_urls : Union[str, List[str]], index_name) -> List[Document]:
+    doc_urls = [doc_urls] if isinstance(doc_urls, str) else doc_urls
+    urls = []
+    for url in doc_urls:
+        urls.extend(list_package_files(url) if "github.com/" in url and "/tree/" in url else [url])
+
+    previous = load_fetch_state(index_name)
+
+    def fetch(url : str) -> Tuple[str, dict]:
+        cached = previous.get(url)
+        text, validators = fetch_if_changed(url, cached["validators"] if cached else None)
+        if text is None:
+            return url, cached
+        docs : List[FunctionDoc] = get_docs(text, index_name, save=False)
+        return url, {"validators" : validators, "docs" : [doc.dict() for doc in docs]}
+
+    with ThreadPoolExecutor(max_workers=max(1, min(FETCH_WORKERS, len(urls)))) as executor:
+        state = dict(executor.map(fetch, urls))
+    save_fetch_state(index_name, state)
+
+    docs : List[FunctionDoc] = [FunctionDoc(**doc) for url in urls for doc in state[url]["docs"]]
+    save_docs(docs, index_name)
+    return [to_document(doc) for doc in docs]
+
+
+"""
+Handle on a loaded index db together with everything derived from it (sample prompts, lookup tables, ...)
+
+Derived values are built at most once per index version, concurrent callers wait for the first build.
+Rebuilding the index creates a new IndexState, so swapping the handle drops every derived value in one assignment
+
+Search through search or similarity_search_with_score here rather than on vectordb, they are safe to call from many threads
+"""
+class IndexState:
+    def __init__(self, vectordb : Chroma, version : str, index_name : Optional[str] = None):
+        self.vectordb = vectordb
+        self.version  = version
+        self.index_name = index_name
+        self._derived : Dict[str, Any] = {}
+        self._build_locks : Dict[str, threading.Lock] = {}
+        self._lock = threading.Lock()
+        self._search_lock = threading.Lock()
+
+    """
+    Vector search, embedding is the query's embedding if the caller already has it (saves the request to openai)
+    """
+    def similarity_search_with_score(self, query : str, k : int = 4, embedding : Optional[List[float]] = None) -> List[Tuple[Document, float]]:
+        start = time.perf_counter()
+        if isinstance(self.vectordb, NumpyVectorStore):
+            backend = "numpy"
+            if embedding is None:
+                embedding = self.vectordb.embedding_function.embed_query(query)
+            results = self.vectordb.similarity_search_by_vector_with_score(embedding, k)
+        else:
+            # chromadb's duckdb connection breaks when threads query it at once. The question is embedded 
+            # outside of the lock (that's the slow part, a request to openai), only the lookup takes turns
+            from langchain.vectorstores.chroma import _results_to_docs_and_scores
+            backend = "chroma"
+            if embedding is None:
+                embedding = self.vectordb._embedding_function.embed_query(query)
+            with self._search_lock:
+                results = _results_to_docs_and_scores(self.vectordb._collection.query(query_embeddings=[[float(x) for x in embedding]], n_results=k))
+        record_search(backend, time.perf_counter() - start, [float(score) for _, score in results])
+        return results
+
+    """
+    BM25 index of the documents of this version, built on first use (update_index builds it with the state)
+    """
+    def get_lexical_index(self) -> LexicalIndex:
+        return self.get_or_build("lexical_index", lambda: LexicalIndex(self._load_documents()))
+
+    def _load_documents(self) -> List[Document]:
+        if isinstance(self.vectordb, NumpyVectorStore):
+            return list(self.vectordb.documents)
+        from langchain.schema import Document
+        with self._search_lock:
+            records = self.vectordb._collection.get(include=["documents", "metadatas"])
+        return [Document(page_content=text, metadata=metadata or {}) 
+                for text, metadata in zip(records["documents"], records["metadatas"] or [None] * len(records["documents"]))]
+
+    """
+    Hybrid search: a question that confidently names a function (see LexicalIndex.confident_match) gets the BM25
+    ranking without being embedded, any other gets the BM25 and vector rankings fused (see lexical.fuse).
+    Scores are BM25 or fused scores, higher is closer (unlike similarity_search_with_score's distances)
+
+    Returns the results and how the question was served: "lexical" (not embedded), "reused" (the given
+    embedding was used) or "embedded". Without HYBRID_SEARCH it is a vector search, with its distances
+    """
+    def search(self, query : str, k : int = 4, embedding : Optional[List[float]] = None) -> Tuple[List[Tuple[Document, float]], str]:
+        path = "embedded" if embedding is None else "reused"
+        if not HYBRID_SEARCH:
+            return self.similarity_search_with_score(query, k, embedding), path
+        start = time.perf_counter()
+        lexical, confident = self.get_lexical_index().search(query, k)
+        record_search("lexical", time.perf_counter() - start, [])
+        if confident:
+            return lexical, "lexical"
+        # The vector ranking goes first, it wins ties
+        return fuse([self.similarity_search_with_score(query, k, embedding), lexical], k), path
+
+    """
+    Whether the question confidently names a function, so it can be answered without being embedded
+    """
+    def is_lexical_match(self, query : str) -> bool:
+        return HYBRID_SEARCH and self.get_lexical_index().confident_match(query) is not None
+
+    """
+    Rough bytes held in memory for this index: its vectors, its documents (their text, and a few times that for
+    the BM25 postings and python objects around it) and the arrays derived from it (intent gate, ...)
+    """
+    def memory_bytes(self) -> int:
+        def base() -> int:
+            documents = self.get_lexical_index().documents
+            text = sum(len(doc.page_content) for doc in documents)
+            if isinstance(self.vectordb, NumpyVectorStore):
+                vectors = self.vectordb.vectors.nbytes
+            else:
+                with self._search_lock:
+                    sample = self.vectordb._collection.get(limit=1, include=["embeddings"])["embeddings"]
+                vectors = len(documents) * len(sample[0]) * 4 if sample else 0
+            return vectors + 4 * text
+        derived = sum(getattr(value, "nbytes", 0) for value in list(self._derived.values()))
+        return self.get_or_build("memory_bytes", base) + derived
+
+    def get_or_build(self, key : str, build : Callable[[], Any]) -> Any:
+        if key in self._derived:
+            return self._derived[key]
+        with self._lock:
+            build_lock = self._build_locks.setdefault(key, threading.Lock())
+        with build_lock:
+            if key not in self._derived:
+                self._derived[key] = build()
+        return self._derived[key]
@@ -0,0 +1,121 @@
+import os
+import json
+import shutil
+import hashlib
+import tempfile
+import threading
+import unittest
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import indexing
+from indexing import ingest_doc_page, fetch_if_changed, list_package_files
+
+
+"""
+Serves files from a dict, with an ETag per content and 304 answers to matching If-None-Match
+"""
+class SourceServer:
+    def __init__(self, files):
+        self.files = files
+        self.hits = []
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                path = self.path.split("?")[0]
+                server.hits.append((path, self.headers.get("If-None-Match")))
+                if path not in server.files:
+                    self.send_response(404)
+                    self.end_headers()
+                    return
+                body = server.files[path].encode()
+                etag = '"' + hashlib.md5(body).hexdigest() + '"'
+                if self.headers.get("If-None-Match") == etag:
+                    self.send_response(304)
+                    self.end_headers()
+                    return
+                self.send_response(200)
+                self.send_header("ETag", etag)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+        self.url = "http://127.0.0.1:%d" % self.httpd.server_address[1]
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+class TestIngest(unittest.TestCase):
+
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.tmp = tempfile.mkdtemp()
+        os.chdir(self.tmp)
+        os.mkdir("data")
+        self.server = SourceServer({
+            "/client.py" : 'class Client:\n    def get_documents(self, q=None):\n        """\n        Get list of documents\n        """\n        pass\n',
+            "/w9.py" : 'def process_w9(file_path):\n    """\n    Process a w9 document\n    """\n    pass\n',
+        })
+        self.parsed = []
+        self.get_docs = indexing.get_docs
+        indexing.get_docs = lambda code, title, save=True: self.parsed.append(code) or self.get_docs(code, title, save)
+
+    def tearDown(self):
+        indexing.get_docs = self.get_docs
+        self.server.stop()
+        os.chdir(self.cwd)
+        shutil.rmtree(self.tmp)
+
+
+    def test_conditional_fetch(self):
+        text, validators = fetch_if_changed(self.server.url + "/client.py")
+        self.assertIn("get_documents", text)
+        self.assertTrue(validators["etag"])
+        text, same_validators = fetch_if_changed(self.server.url + "/client.py", validators)
+        self.assertIsNone(text)
+        self.assertEqual(same_validators, validators)
+
+
+    def test_unchanged_sources_are_not_parsed_again(self):
+        urls = [self.server.url + "/client.py", self.server.url + "/w9.py"]
+        first = ingest_doc_page(urls, "test")
+        self.assertEqual([doc.page_content.split("\n")[0] for doc in first], 
+                         ["Function name: Client.get_documents", "Function name: process_w9"])
+        self.assertEqual(len(self.parsed), 2)
+
+        second = ingest_doc_page(urls, "test")
+        self.assertEqual([doc.page_content for doc in second], [doc.page_content for doc in first])
+        self.assertEqual(len(self.parsed), 2)
+
+        self.server.files["/w9.py"] = self.server.files["/w9.py"].replace("Process a w9", "Process a W-9")
+        third = ingest_doc_page(urls, "test")
+        self.assertEqual(len(self.parsed), 3)
+        self.assertIn("W-9", third[1].page_content)
+        with open("data/test_doc.jsonl") as f:
+            self.assertEqual(len(f.readlines()), 2)
+
+
+    def test_list_package_files(self):
+        self.server.files["/repos/veryfi/veryfi-python/git/trees/master"] = json.dumps({"tree" : [
+            {"path" : "veryfi/client.py", "type" : "blob"},
+            {"path" : "veryfi/errors.py", "type" : "blob"},
+            {"path" : "veryfi/data", "type" : "tree"},
+            {"path" : "tests/test_client.py", "type" : "blob"},
+        ]})
+        github_api_url, indexing.GITHUB_API_URL = indexing.GITHUB_API_URL, self.server.url
+        try:
+            urls = list_package_files("https://github.com/veryfi/veryfi-python/tree/master/veryfi")
+        finally:
+            indexing.GITHUB_API_URL = github_api_url
+        self.assertEqual(urls, [indexing.GITHUB_RAW_URL + "/veryfi/veryfi-python/master/veryfi/client.py",
+                                indexing.GITHUB_RAW_URL + "/veryfi/veryfi-python/master/veryfi/errors.py"])
+
+
+if __name__ == '__main__':
+    unittest.main()
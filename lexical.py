@@ -0,0 +1,155 @@
+from __future__ import annotations
+import os
+import re
+import math
+from collections import Counter
+from typing import List, Tuple, Dict, Optional, TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from langchain.schema import Document
+
+
+# BM25 term saturation and length normalization
+BM25_K1 = 1.5
+BM25_B = 0.75
+# A term in the function name counts as much as NAME_WEIGHT terms of the docstring, a parameter name as PARAMETER_WEIGHT
+NAME_WEIGHT = 3.
+PARAMETER_WEIGHT = 2.
+# A question is a confident lexical match for a function when it contains every word of the function's name
+# (delete_document for "how do I delete a document"), the name has at least LEXICAL_MIN_NAME_WORDS words,
+# and no other function with as many name words is matched too (or it is, but only with plurals folded:
+# "delete line item" is delete_line_item, not delete_line_items)
+LEXICAL_MIN_NAME_WORDS = int(os.environ.get("LEXICAL_MIN_NAME_WORDS", "2"))
+# Reciprocal rank fusion constant, higher flattens the difference between ranks
+RRF_K = 60
+
+STOPWORDS = {"a", "an", "the", "to", "of", "for", "in", "on", "by", "with", "and", "or", "is", "it", "this", "that",
+             "how", "do", "i", "my", "me", "can", "you", "use", "using", "def", "self", "param", "return", "none"}
+
+
+def _stem(word : str) -> str:
+    return word[:-1] if len(word) > 3 and word.endswith("s") and not word.endswith("ss") else word
+
+
+"""
+Lowercased words of text, identifiers split on underscores and camel case (process_document_url and
+processDocumentUrl are both process, document, url), plurals folded (documents is document) unless not stem,
+stopwords dropped
+"""
+def tokenize(text : str, stem : bool = True) -> List[str]:
+    tokens = []
+    for word in re.findall(r"\w+", text):
+        for part in re.sub(r"([a-z0-9])([A-Z])", r"\1_\2", word).lower().split("_"):
+            if part and part not in STOPWORDS:
+                tokens.append(_stem(part) if stem else part)
+    return tokens
+
+
+"""
+(name, definition, docstring) of a document indexed from a FunctionDoc (see FunctionDoc.__str__),
+any other text is all docstring
+"""
+def parse_fields(text : str) -> Tuple[str, str, str]:
+    match = re.match(r"Function name: (.*)\nDefinition: (.*?)(?:\nDoc: (.*))?$", text, re.S)
+    if not match:
+        return "", "", text
+    return match.group(1), match.group(2), match.group(3) or ""
+
+
+def parameter_names(definition : str) -> List[str]:
+    start, end = definition.find("("), definition.rfind(")")
+    if start < 0 or end < start:
+        return []
+    names = [re.split(r"[:=]", parameter)[0].strip(" *\n\t") for parameter in definition[start + 1 : end].split(",")]
+    return [name for name in names if name and name != "self"]
+
+
+"""
+In memory BM25 index over the documents of an index version, built from the same documents as the vectors
+
+Every document is scored on its function name (the part after the class, weighted NAME_WEIGHT), its parameter
+names (PARAMETER_WEIGHT) and its docstring, as one bag of weighted term counts (a simplified BM25F)
+
+Analysis:
+    - build is O(total tokens)
+    - search walks the postings of the query terms only, O(matching postings) plus O(n log k) for the top k
+"""
+class LexicalIndex:
+    def __init__(self, documents : List[Document]):
+        self.documents = documents
+        self.name_words : List[frozenset] = []
+        self.raw_name_words : List[frozenset] = []
+        # term -> [(document, weighted term frequency)]
+        self.postings : Dict[str, List[Tuple[int, float]]] = {}
+        self.lengths : List[float] = []
+        for i, doc in enumerate(documents):
+            name, definition, docstring = parse_fields(doc.page_content)
+            name_tokens = tokenize(name.rsplit(".", 1)[-1])
+            self.name_words.append(frozenset(name_tokens))
+            self.raw_name_words.append(frozenset(tokenize(name.rsplit(".", 1)[-1], stem=False)))
+            counts : Counter = Counter()
+            for token in name_tokens:
+                counts[token] += NAME_WEIGHT
+            for token in tokenize(" ".join(parameter_names(definition))):
+                counts[token] += PARAMETER_WEIGHT
+            for token in tokenize(docstring):
+                counts[token] += 1.
+            for term, count in counts.items():
+                self.postings.setdefault(term, []).append((i, count))
+            self.lengths.append(sum(counts.values()))
+        self.average_length = sum(self.lengths) / len(self.lengths) if self.lengths else 0.
+        n = len(documents)
+        self.idf = {term : math.log(1. + (n - len(postings) + 0.5) / (len(postings) + 0.5)) for term, postings in self.postings.items()}
+
+    def __len__(self) -> int:
+        return len(self.documents)
+
+    def scores(self, query : str) -> Dict[int, float]:
+        scores : Dict[int, float] = {}
+        for term in set(tokenize(query)):
+            for i, count in self.postings.get(term, ()):
+                norm = BM25_K1 * (1. - BM25_B + BM25_B * self.lengths[i] / self.average_length)
+                scores[i] = scores.get(i, 0.) + self.idf[term] * count * (BM25_K1 + 1.) / (count + norm)
+        return scores
+
+    """
+    Index of the document the query names unambiguously (see LEXICAL_MIN_NAME_WORDS), None if there is none
+    """
+    def confident_match(self, query : str) -> Optional[int]:
+        words = set(tokenize(query))
+        matches = [i for i, name in enumerate(self.name_words) if len(name) >= LEXICAL_MIN_NAME_WORDS and name <= words]
+        if not matches:
+            return None
+        longest = max(len(self.name_words[i]) for i in matches)
+        matches = [i for i in matches if len(self.name_words[i]) == longest]
+        if len(matches) > 1:
+            raw_words = set(tokenize(query, stem=False))
+            matches = [i for i in matches if self.raw_name_words[i] <= raw_words]
+        return matches[0] if len(matches) == 1 else None
+
+    """
+    Top k documents by BM25 score (higher is closer), documents without any query term are left out.
+    Returns them with whether the first one is a confident match, which then comes first whatever its score
+    """
+    def search(self, query : str, k : int = 4) -> Tuple[List[Tuple[Document, float]], bool]:
+        scores = self.scores(query)
+        ranked = sorted(scores, key=lambda i: -scores[i])
+        confident = self.confident_match(query)
+        if confident is not None:
+            ranked = [confident] + [i for i in ranked if i != confident]
+        return [(self.documents[i], scores.get(i, 0.)) for i in ranked[:k]], confident is not None
+
+
+"""
+Reciprocal rank fusion of rankings of the same documents (by page_content): every document scores
+1 / (RRF_K + rank) in every ranking it is in, ties go to the earlier ranking. Returns the top k with their fused score
+"""
+def fuse(rankings : List[List[Tuple[Document, float]]], k : int = 4) -> List[Tuple[Document, float]]:
+    scores : Dict[str, float] = {}
+    documents : Dict[str, Document] = {}
+    for ranking in rankings:
+        for rank, (doc, _) in enumerate(ranking):
+            scores[doc.page_content] = scores.get(doc.page_content, 0.) + 1. / (RRF_K + rank + 1)
+            documents.setdefault(doc.page_content, doc)
+    top = sorted(scores, key=lambda key: -scores[key])[:k]
+    return [(documents[key], scores[key]) for key in top]
@@ -0,0 +1,73 @@
+import unittest
+from langchain.schema import Document
+from preprocess import FunctionDoc
+from lexical import LexicalIndex, tokenize, parse_fields, parameter_names, fuse
+
+
+DOCS = [
+    FunctionDoc(name="Client.get_documents", definition="def get_documents(self, q: Optional[str] = None, **kwargs):",
+                docstring="Get list of documents\n:param q: Search term"),
+    FunctionDoc(name="Client.get_document", definition="def get_document(self, document_id):", docstring="Retrieve document by ID"),
+    FunctionDoc(name="Client.delete_document", definition="def delete_document(self, document_id):", docstring="Delete Document from Veryfi"),
+    FunctionDoc(name="Client.process_document", definition="def process_document(self, file_path: str, categories=None):",
+                docstring="Process a document and extract all the fields from it"),
+    FunctionDoc(name="Client.process_document_url", definition="def process_document_url(self, file_url: str = None):",
+                docstring="Process Document from url and extract all the fields from it"),
+    FunctionDoc(name="Client.delete_line_item", definition="def delete_line_item(self, document_id, line_item_id):",
+                docstring="Delete an item from a document"),
+    FunctionDoc(name="Client.delete_line_items", definition="def delete_line_items(self, document_id):",
+                docstring="Delete all items from a document"),
+]
+
+
+class TestLexicalIndex(unittest.TestCase):
+
+    def setUp(self):
+        self.documents = [Document(page_content=str(doc)) for doc in DOCS]
+        self.index = LexicalIndex(self.documents)
+
+    def names(self, results):
+        return [parse_fields(doc.page_content)[0] for doc, _ in results]
+
+
+    def test_tokenize(self):
+        self.assertEqual(tokenize("How do I processDocumentUrl with process_document_url?"),
+                         ["process", "document", "url", "process", "document", "url"])
+        self.assertEqual(tokenize("delete line items"), ["delete", "line", "item"])
+        self.assertEqual(tokenize("delete line items", stem=False), ["delete", "line", "items"])
+        self.assertEqual(parse_fields(str(DOCS[1])), ("Client.get_document", "def get_document(self, document_id):", "Retrieve document by ID"))
+        self.assertEqual(parse_fields("plain text"), ("", "", "plain text"))
+        self.assertEqual(parameter_names(DOCS[0].definition), ["q", "kwargs"])
+
+
+    def test_confident_match(self):
+        results, confident = self.index.search("use veryfi-python package to delete document")
+        self.assertTrue(confident)
+        self.assertEqual(self.names(results)[0], "Client.delete_document")
+        # The longest name wins, plurals only break ties
+        self.assertEqual(self.names(self.index.search("process document with url")[0])[0], "Client.process_document_url")
+        self.assertEqual(self.names(self.index.search("delete a line item")[0])[0], "Client.delete_line_item")
+        self.assertEqual(self.names(self.index.search("delete the line items")[0])[0], "Client.delete_line_items")
+        self.assertEqual(self.names(self.index.search("get my documents")[0])[0], "Client.get_documents")
+        for question in ["extract fields from a receipt", "document", "what is the weather today"]:
+            self.assertFalse(self.index.search(question)[1], question)
+
+
+    def test_ranking(self):
+        results, confident = self.index.search("extract fields from an invoice", k=2)
+        self.assertFalse(confident)
+        self.assertEqual(set(self.names(results)), {"Client.process_document", "Client.process_document_url"})
+        self.assertGreater(results[0][1], 0.)
+        self.assertEqual(self.index.search("weather", k=2), ([], False))
+
+
+    def test_fuse(self):
+        a, b, c = (Document(page_content=text) for text in "abc")
+        fused = fuse([[(a, 0.1), (b, 0.2)], [(b, 9.), (c, 8.)]], k=2)
+        self.assertEqual([doc.page_content for doc, _ in fused], ["b", "a"])
+        # Ties go to the first ranking
+        self.assertEqual([doc.page_content for doc, _ in fuse([[(a, 0.)], [(c, 0.)]])], ["a", "c"])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,341 @@
+import os
+import time
+import asyncio
+import logging
+import threading
+import functools
+import weakref
+from collections import Counter
+from typing import Optional, Iterator, AsyncIterator, List, Dict, Tuple, Any, Callable, Awaitable
+from prompt_budget import count_message_tokens, count_tokens, MODEL_CONTEXT_TOKENS
+from metrics import record_llm_call, record_llm_event
+from resilience import ResilientCaller, CircuitBreaker
+from scheduler import chat_scheduler, OPENAI_QUEUE_TIMEOUT
+
+
+CHAT_MODEL = "gpt-3.5-turbo"
+# Seconds before an attempt at a chat completion is given up on, streams included (a slow completion would otherwise
+# hold its user, and a queue slot, for as long as openai takes)
+OPENAI_REQUEST_TIMEOUT = float(os.environ.get("OPENAI_REQUEST_TIMEOUT", "60"))
+# Seconds a chat completion may take with its retries, every attempt gets what is left of it at most
+OPENAI_DEADLINE = float(os.environ.get("OPENAI_DEADLINE", "90"))
+# Retries after a transient error (timeout, connection error, 429, 5xx), with jittered exponential backoff
+# between OPENAI_RETRY_BACKOFF and OPENAI_RETRY_BACKOFF_MAX seconds (longer if openai sends a Retry-After)
+OPENAI_MAX_RETRIES = int(os.environ.get("OPENAI_MAX_RETRIES", "2"))
+OPENAI_RETRY_BACKOFF = float(os.environ.get("OPENAI_RETRY_BACKOFF", "0.5"))
+OPENAI_RETRY_BACKOFF_MAX = float(os.environ.get("OPENAI_RETRY_BACKOFF_MAX", "8"))
+# Seconds without an answer (the first token for streams) before the same request is sent again, whichever
+# answers first is used. Cuts the tail of slow completions at the price of the duplicates' tokens, 0 is off
+OPENAI_HEDGE_DELAY = float(os.environ.get("OPENAI_HEDGE_DELAY", "0"))
+# Transient failures in a row before chat completions fail fast, for OPENAI_BREAKER_RESET seconds
+# (then one trial request decides whether openai is back)
+OPENAI_BREAKER_FAILURES = int(os.environ.get("OPENAI_BREAKER_FAILURES", "5"))
+OPENAI_BREAKER_RESET = float(os.environ.get("OPENAI_BREAKER_RESET", "30"))
+# Connections kept open to openai by the async client, shared by all requests on an event loop
+OPENAI_MAX_CONNECTIONS = int(os.environ.get("OPENAI_MAX_CONNECTIONS", "64"))
+
+logger = logging.getLogger(__name__)
+# Prompt and completion tokens of all requests, as reported by openai (estimated for streams, which don't report usage)
+token_usage : Counter = Counter()
+_token_usage_lock = threading.Lock()
+
+
+def get_token_usage() -> Dict[str, int]:
+    with _token_usage_lock:
+        return dict(token_usage)
+
+
+"""
+Count a chat completion in token_usage and the metrics. status is "error" when it failed (nothing is counted 
+in token_usage then), "cancelled" when the caller stopped reading a stream
+"""
+def _record_usage(prompt_tokens : int, completion_tokens : int, stream : bool, seconds : float, status : str = "ok"):
+    record_llm_call(CHAT_MODEL, stream, seconds, prompt_tokens, completion_tokens, status)
+    if status == "error":
+        return
+    with _token_usage_lock:
+        token_usage.update(requests=1, prompt_tokens=prompt_tokens, completion_tokens=completion_tokens)
+    logger.info("chat completion stream=%s prompt_tokens=%d completion_tokens=%d seconds=%.3f", 
+                stream, prompt_tokens, completion_tokens, seconds)
+
+
+"""
+Completion tokens to ask for, at most token_len but never more than what is left of the context window,
+so a prompt that grew too long gets a shorter answer instead of a context length error
+"""
+def _max_tokens(prompt_tokens : int, token_len : int) -> int:
+    max_tokens = min(token_len, MODEL_CONTEXT_TOKENS - prompt_tokens)
+    if max_tokens < token_len:
+        logger.warning("Prompt of %d tokens leaves %d of %d completion tokens", prompt_tokens, max(max_tokens, 0), token_len)
+    if max_tokens <= 0:
+        raise ValueError(f"Prompt of {prompt_tokens} tokens doesn't fit in the {MODEL_CONTEXT_TOKENS} tokens context")
+    return max_tokens
+
+
+"""
+Request parameters of a chat completion, and its prompt tokens. The request_timeout of every attempt is added by chat_caller
+"""
+def _chat_params(messages : List[dict], token_len : int, stream : bool = False) -> Tuple[Dict[str, Any], int]:
+    prompt_tokens = count_message_tokens(messages)
+    params = dict(
+        model=CHAT_MODEL,
+        messages=messages,
+        temperature=0.,
+        max_tokens=_max_tokens(prompt_tokens, token_len),
+    )
+    if stream:
+        params["stream"] = True
+    return params, prompt_tokens
+
+
+"""
+Errors worth retrying: openai timed out, was unreachable, rate limited us or failed on its side
+"""
+def _is_transient(error : BaseException) -> bool:
+    import openai
+    if isinstance(error, (openai.error.Timeout, openai.error.APIConnectionError, openai.error.RateLimitError,
+                          openai.error.ServiceUnavailableError, openai.error.TryAgain, asyncio.TimeoutError)):
+        return True
+    return isinstance(error, openai.error.APIError) and (error.http_status is None or error.http_status >= 500)
+
+
+def _retry_after(error : BaseException) -> Optional[float]:
+    headers = getattr(error, "headers", None) or {}
+    try:
+        return float(headers.get("Retry-After") or headers.get("retry-after"))
+    except (TypeError, ValueError):
+        return None
+
+
+chat_breaker = CircuitBreaker(OPENAI_BREAKER_FAILURES, OPENAI_BREAKER_RESET, name="openai")
+# Deadline, retries, hedging and circuit breaker of all chat completions
+chat_caller = ResilientCaller(_is_transient,
+                              deadline=OPENAI_DEADLINE,
+                              attempt_timeout=OPENAI_REQUEST_TIMEOUT,
+                              max_retries=OPENAI_MAX_RETRIES,
+                              backoff_base=OPENAI_RETRY_BACKOFF,
+                              backoff_max=OPENAI_RETRY_BACKOFF_MAX,
+                              hedge_delay=OPENAI_HEDGE_DELAY,
+                              breaker=chat_breaker,
+                              retry_after=_retry_after,
+                              on_event=record_llm_event)
+
+
+"""
+fn as one attempt of chat_caller that first waits its turn at chat_scheduler (at most OPENAI_QUEUE_TIMEOUT
+seconds, out of the attempt's timeout) for a request of tokens. A 429 holds all chat completions for its Retry-After
+"""
+def _backoff(error : BaseException):
+    retry_after = _retry_after(error)
+    chat_scheduler.backoff(OPENAI_RETRY_BACKOFF if retry_after is None else retry_after)
+
+
+def _scheduled(fn : Callable[[float], Any], tokens : int) -> Callable[[float], Any]:
+    def attempt(timeout : float):
+        import openai
+        start = time.monotonic()
+        chat_scheduler.acquire(tokens, timeout=min(timeout, OPENAI_QUEUE_TIMEOUT))
+        try:
+            return fn(max(timeout - (time.monotonic() - start), 0.001))
+        except openai.error.RateLimitError as e:
+            _backoff(e)
+            raise
+    return attempt
+
+
+def _ascheduled(fn : Callable[[float], Awaitable[Any]], tokens : int) -> Callable[[float], Awaitable[Any]]:
+    async def attempt(timeout : float):
+        import openai
+        start = time.monotonic()
+        await chat_scheduler.aacquire(tokens, timeout=min(timeout, OPENAI_QUEUE_TIMEOUT))
+        try:
+            return await fn(max(timeout - (time.monotonic() - start), 0.001))
+        except openai.error.RateLimitError as e:
+            _backoff(e)
+            raise
+    return attempt
+
+
+def _read_response(response : dict, seconds : float) -> Optional[str]:
+    usage = response.get("usage") or {}
+    _record_usage(usage.get("prompt_tokens", 0), usage.get("completion_tokens", 0), False, seconds)
+    if "choices" in response:
+        if len(response["choices"]) > 0:
+            out = response["choices"][0]["message"]["content"]
+            return out.strip()
+    return None
+
+
+def _read_delta(chunk : dict) -> Optional[str]:
+    choices = chunk.get("choices")
+    if choices:
+        return choices[0].get("delta", {}).get("content")
+    return None
+
+
+"""
+Raises UpstreamUnavailableError when openai kept failing (see chat_caller), hedge_delay overrides OPENAI_HEDGE_DELAY
+"""
+def call_gpt_turbo(messages, token_len=300, hedge_delay : Optional[float] = None) -> Optional[str]:
+    # Imported on first call, keeps importing predict fast
+    import openai
+    params, prompt_tokens = _chat_params(messages, token_len)
+    start = time.perf_counter()
+    try:
+        response = chat_caller.call(_scheduled(lambda timeout: openai.ChatCompletion.create(**params, request_timeout=timeout),
+                                               prompt_tokens + params["max_tokens"]),
+                                    hedge_delay=hedge_delay)
+    except Exception:
+        _record_usage(prompt_tokens, 0, False, time.perf_counter() - start, "error")
+        raise
+    return _read_response(response, time.perf_counter() - start)
+
+
+"""
+One attempt at a stream: the request, read up to the first content delta. Returns the deltas read and the rest
+of the stream, so an attempt that fails before anything reached the caller can be retried (or hedged)
+"""
+def _open_stream(params : Dict[str, Any], timeout : float) -> Tuple[List[str], Iterator[dict]]:
+    import openai
+    chunks = openai.ChatCompletion.create(**params, request_timeout=timeout)
+    head = []
+    try:
+        for chunk in chunks:
+            delta = _read_delta(chunk)
+            if delta:
+                head.append(delta)
+                break
+    except BaseException:
+        chunks.close()
+        raise
+    return head, chunks
+
+
+"""
+Streaming variant of call_gpt_turbo, yields the content deltas as soon as openai sends them.
+Retries and hedging only cover the wait for the first delta, an error after it is raised as is
+
+Leading and trailing whitespace is not stripped here since the deltas arrive one at a time,
+the caller is expected to strip the joined text (see CodeblockStreamRenderer in predict)
+"""
+def call_gpt_turbo_stream(messages : List[dict], token_len=300, hedge_delay : Optional[float] = None) -> Iterator[str]:
+    params, prompt_tokens = _chat_params(messages, token_len, stream=True)
+    start = time.perf_counter()
+    chunks = None
+    deltas = []
+    status = "cancelled"
+    try:
+        head, chunks = chat_caller.call(_scheduled(functools.partial(_open_stream, params), prompt_tokens + params["max_tokens"]),
+                                        discard=lambda opened: opened[1].close(), hedge_delay=hedge_delay)
+        for delta in head:
+            deltas.append(delta)
+            yield delta
+        for chunk in chunks:
+            delta = _read_delta(chunk)
+            if delta:
+                deltas.append(delta)
+                yield delta
+        status = "ok"
+    except Exception:
+        status = "error"
+        raise
+    finally:
+        # Also counted when the caller stops reading early, the tokens were generated (and billed) up to there
+        _record_usage(prompt_tokens, count_tokens("".join(deltas)), True, time.perf_counter() - start, status)
+        if chunks is not None:
+            chunks.close()
+
+
+# One aiohttp session per event loop, a session can't be used from another loop than the one it was made on
+_aiosessions : "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, Any]" = weakref.WeakKeyDictionary()
+
+
+"""
+Shared aiohttp session of the running event loop, with a pool of up to OPENAI_MAX_CONNECTIONS connections.
+Without it openai opens (and closes) a new session, and connection, for every async request
+"""
+def _use_aiosession():
+    import aiohttp
+    import openai
+    loop = asyncio.get_running_loop()
+    session = _aiosessions.get(loop)
+    if session is None or session.closed:
+        session = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=OPENAI_MAX_CONNECTIONS))
+        _aiosessions[loop] = session
+    # openai reads its session from a context variable, this sets it for the current task only
+    openai.aiosession.set(session)
+
+
+"""
+Close the shared session of the running event loop, call before the loop is closed
+"""
+async def close_aiosession():
+    session = _aiosessions.pop(asyncio.get_running_loop(), None)
+    if session is not None:
+        await session.close()
+
+
+"""
+Async variant of call_gpt_turbo, waits for the completion without holding a thread
+"""
+async def acall_gpt_turbo(messages : List[dict], token_len=300, hedge_delay : Optional[float] = None) -> Optional[str]:
+    import openai
+    params, prompt_tokens = _chat_params(messages, token_len)
+    _use_aiosession()
+    start = time.perf_counter()
+    try:
+        response = await chat_caller.acall(_ascheduled(lambda timeout: openai.ChatCompletion.acreate(**params, request_timeout=timeout),
+                                                       prompt_tokens + params["max_tokens"]),
+                                           hedge_delay=hedge_delay)
+    except Exception:
+        _record_usage(prompt_tokens, 0, False, time.perf_counter() - start, "error")
+        raise
+    return _read_response(response, time.perf_counter() - start)
+
+
+async def _aopen_stream(params : Dict[str, Any], timeout : float) -> Tuple[List[str], AsyncIterator[dict]]:
+    import openai
+    chunks = await openai.ChatCompletion.acreate(**params, request_timeout=timeout)
+    head = []
+    try:
+        async for chunk in chunks:
+            delta = _read_delta(chunk)
+            if delta:
+                head.append(delta)
+                break
+    except BaseException:
+        await chunks.aclose()
+        raise
+    return head, chunks
+
+
+"""
+Async variant of call_gpt_turbo_stream
+"""
+async def acall_gpt_turbo_stream(messages : List[dict], token_len=300, hedge_delay : Optional[float] = None) -> AsyncIterator[str]:
+    params, prompt_tokens = _chat_params(messages, token_len, stream=True)
+    _use_aiosession()
+    start = time.perf_counter()
+    response = None
+    deltas = []
+    status = "cancelled"
+    try:
+        head, response = await chat_caller.acall(_ascheduled(functools.partial(_aopen_stream, params), prompt_tokens + params["max_tokens"]),
+                                                 discard=lambda opened: opened[1].aclose(), hedge_delay=hedge_delay)
+        for delta in head:
+            deltas.append(delta)
+            yield delta
+        async for chunk in response:
+            delta = _read_delta(chunk)
+            if delta:
+                deltas.append(delta)
+                yield delta
+        status = "ok"
+    except Exception:
+        status = "error"
+        raise
+    finally:
+        _record_usage(prompt_tokens, count_tokens("".join(deltas)), True, time.perf_counter() - start, status)
+        if response is not None:
+            # Gives the connection back to the pool when the caller stopped reading early
+            await response.aclose()
@@ -0,0 +1,183 @@
+import time
+import asyncio
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+import openai
+import llm
+from fake_openai import FakeOpenAIServer
+from llm import call_gpt_turbo, call_gpt_turbo_stream, get_token_usage, acall_gpt_turbo, acall_gpt_turbo_stream, close_aiosession
+from resilience import CircuitBreaker, UpstreamUnavailableError, CircuitOpenError
+from scheduler import RateLimitScheduler
+
+
+class TestLLM(unittest.TestCase):
+
+    def setUp(self):
+        self.reply = "\n```python\nfrom veryfi import Client\n```\n"
+        self.server = FakeOpenAIServer(reply=self.reply, chunk_size=3).start()
+        self.api_base, self.api_key = openai.api_base, openai.api_key
+        openai.api_base, openai.api_key = self.server.api_base, "test"
+        # Fresh breaker and short backoffs, so the flaky server tests don't wait or trip each other
+        self.caller = dict(vars(llm.chat_caller))
+        llm.chat_caller.breaker = CircuitBreaker(failure_threshold=5, reset_timeout=30.)
+        llm.chat_caller.backoff_base, llm.chat_caller.backoff_max = 0.01, 0.02
+
+    def tearDown(self):
+        vars(llm.chat_caller).update(self.caller)
+        openai.api_base, openai.api_key = self.api_base, self.api_key
+        self.server.stop()
+
+
+    def test_call_gpt_turbo(self):
+        out = call_gpt_turbo([{"role" : "user", "content" : "hi"}])
+        self.assertEqual(out, self.reply.strip())
+
+
+    def test_call_gpt_turbo_stream(self):
+        deltas = list(call_gpt_turbo_stream([{"role" : "user", "content" : "hi"}]))
+        self.assertGreater(len(deltas), 1)
+        self.assertEqual("".join(deltas), self.reply)
+        self.assertTrue(self.server.requests[-1][1]["stream"])
+
+
+    def test_token_usage(self):
+        before = get_token_usage()
+        call_gpt_turbo([{"role" : "user", "content" : "delete a document"}])
+        list(call_gpt_turbo_stream([{"role" : "user", "content" : "hi"}]))
+        usage = get_token_usage()
+        self.assertEqual(usage["requests"] - before.get("requests", 0), 2)
+        # The stand-in reports words as tokens
+        self.assertGreaterEqual(usage["prompt_tokens"] - before.get("prompt_tokens", 0), 3)
+        self.assertGreater(usage["completion_tokens"] - before.get("completion_tokens", 0), 0)
+        self.assertLessEqual(self.server.requests[-1][1]["max_tokens"], 300)
+
+
+    def test_acall_gpt_turbo(self):
+        async def run():
+            try:
+                out = await acall_gpt_turbo([{"role" : "user", "content" : "hi"}])
+                deltas = [delta async for delta in acall_gpt_turbo_stream([{"role" : "user", "content" : "hi"}])]
+                return out, deltas, len(llm._aiosessions)
+            finally:
+                await close_aiosession()
+
+        out, deltas, sessions = asyncio.run(run())
+        self.assertEqual(out, self.reply.strip())
+        self.assertEqual("".join(deltas), self.reply)
+        self.assertEqual(self.server.requests[-1][1]["stream"], True)
+        self.assertEqual(sessions, 1)
+
+
+    def test_acall_gpt_turbo_concurrent(self):
+        self.server.latency = 0.3
+        async def run():
+            try:
+                return await asyncio.gather(*[acall_gpt_turbo([{"role" : "user", "content" : str(i)}]) for i in range(8)])
+            finally:
+                await close_aiosession()
+
+        start = time.perf_counter()
+        outs = asyncio.run(run())
+        # Waiting on one completion doesn't hold up the others
+        self.assertLess(time.perf_counter() - start, 8 * 0.3 / 2)
+        self.assertEqual(outs, [self.reply.strip()] * 8)
+
+
+    def test_retry(self):
+        self.server.errors = [503, 500, 0, 429]
+        self.assertEqual(call_gpt_turbo([{"role" : "user", "content" : "hi"}]), self.reply.strip())
+        self.assertEqual(len(self.server.requests), 3)
+        # Rate limited, retried after Retry-After
+        self.assertEqual("".join(call_gpt_turbo_stream([{"role" : "user", "content" : "hi"}])), self.reply)
+        self.assertEqual(len(self.server.requests), 5)
+
+
+    def test_give_up(self):
+        self.server.errors = [503] * 3 + [400]
+        with self.assertRaises(UpstreamUnavailableError):
+            call_gpt_turbo([{"role" : "user", "content" : "hi"}])
+        self.assertEqual(len(self.server.requests), 3)
+        # Not transient, not retried
+        with self.assertRaises(openai.error.InvalidRequestError):
+            call_gpt_turbo([{"role" : "user", "content" : "hi"}])
+        self.assertEqual(len(self.server.requests), 4)
+
+
+    def test_deadline(self):
+        self.server.delays = [1.] * 3
+        llm.chat_caller.deadline = 0.5
+        start = time.perf_counter()
+        with self.assertRaises(UpstreamUnavailableError):
+            call_gpt_turbo([{"role" : "user", "content" : "hi"}])
+        self.assertLess(time.perf_counter() - start, 1.)
+
+
+    def test_hedge(self):
+        self.server.delays = [2., 0., 2., 0., 2., 0.]
+        message = [{"role" : "user", "content" : "hi"}]
+
+        async def run():
+            try:
+                out = await acall_gpt_turbo(message, hedge_delay=0.1)
+                deltas = [delta async for delta in acall_gpt_turbo_stream(message, hedge_delay=0.1)]
+                return out, "".join(deltas)
+            finally:
+                await close_aiosession()
+
+        start = time.perf_counter()
+        self.assertEqual(call_gpt_turbo(message, hedge_delay=0.1), self.reply.strip())
+        self.assertEqual(asyncio.run(run()), (self.reply.strip(), self.reply))
+        # The duplicates answered, none waited for the slow ones
+        self.assertLess(time.perf_counter() - start, 2.)
+        self.assertEqual(len(self.server.requests), 6)
+
+
+    def test_circuit_breaker(self):
+        llm.chat_caller.breaker = CircuitBreaker(failure_threshold=2, reset_timeout=0.2)
+        llm.chat_caller.max_retries = 0
+        self.server.errors = [503, 503]
+        for i in range(2):
+            with self.assertRaises(UpstreamUnavailableError):
+                call_gpt_turbo([{"role" : "user", "content" : "hi"}])
+        with self.assertRaises(CircuitOpenError):
+            call_gpt_turbo([{"role" : "user", "content" : "hi"}])
+        self.assertEqual(len(self.server.requests), 2)
+        # A trial request closes it again
+        time.sleep(0.2)
+        self.assertEqual(call_gpt_turbo([{"role" : "user", "content" : "hi"}]), self.reply.strip())
+        self.assertEqual(llm.chat_caller.breaker.state, "closed")
+
+
+    def test_rate_limits(self):
+        self.server.rpm, self.server.rate_period = 4, 0.4
+        scheduler = llm.chat_scheduler
+        self.addCleanup(setattr, llm, "chat_scheduler", scheduler)
+
+        def burst():
+            def ask(i):
+                try:
+                    return call_gpt_turbo([{"role" : "user", "content" : str(i)}])
+                except UpstreamUnavailableError as e:
+                    return e
+            with ThreadPoolExecutor(max_workers=12) as pool:
+                return list(pool.map(ask, range(12)))
+
+        # Not coordinated, the burst runs into the limits
+        llm.chat_scheduler = RateLimitScheduler("test")
+        burst()
+        self.assertGreater(self.server.rate_limited["chat"], 0)
+
+        self.server._limits.clear()
+        self.server.rate_limited.clear()
+        llm.chat_caller.breaker = CircuitBreaker(failure_threshold=5, reset_timeout=30.)
+        # A little under the limits, requests don't reach openai in exactly the order and spacing they were sent
+        llm.chat_scheduler = RateLimitScheduler("test", requests_per_minute=4, period=0.5)
+        start = time.perf_counter()
+        self.assertEqual(burst(), [self.reply.strip()] * 12)
+        self.assertEqual(self.server.rate_limited["chat"], 0)
+        # 4 at once, then 8/s
+        self.assertGreater(time.perf_counter() - start, 0.7)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,461 @@
+import os
+import json
+import time
+import uuid
+import bisect
+import logging
+import inspect
+import functools
+import threading
+import contextvars
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List, Tuple, Optional, Any, Callable, Iterator
+
+
+# Off turns spans, traces and metrics into no-ops (traced functions are not even wrapped)
+METRICS_ENABLED = os.environ.get("METRICS_ENABLED", "1") == "1"
+# Prometheus endpoint (GET /metrics) started by the app, 0 to not serve it
+METRICS_HOST = os.environ.get("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.environ.get("METRICS_PORT", "8002"))
+
+# Seconds, from a vector lookup to a slow completion
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1., 2.5, 5., 10., 30., 60.)
+# Queries per embedding request
+BATCH_SIZE_BUCKETS = (1, 2, 4, 8, 16, 32, 64, 128, 256)
+# Vector search distances, 0 (same direction) to 2 (opposite) for normalized embeddings
+DISTANCE_BUCKETS = (0.05, 0.1, 0.2, 0.3, 0.4, 0.5, 0.6, 0.8, 1., 1.5, 2.)
+
+logger = logging.getLogger(__name__)
+
+
+def _format_labels(names : Tuple[str, ...], values : Tuple[str, ...], extra : str = "") -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _escape(value : str) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_value(value : float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return str(int(value)) if float(value).is_integer() else repr(float(value))
+
+
+class Counter:
+    def __init__(self, name : str, help : str, labels : Tuple[str, ...] = ()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self._values : Dict[Tuple[str, ...], float] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount : float = 1., **labels : str):
+        key = tuple(str(labels[name]) for name in self.labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.) + amount
+
+    def get(self, **labels : str) -> float:
+        return self._values.get(tuple(str(labels[name]) for name in self.labels), 0.)
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            for key, value in sorted(self._values.items()):
+                lines.append(f"{self.name}{_format_labels(self.labels, key)} {_format_value(value)}")
+        return lines
+
+
+class Histogram:
+    def __init__(self, name : str, help : str, labels : Tuple[str, ...] = (), buckets : Tuple[float, ...] = LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = tuple(buckets)
+        # label values -> [count per bucket (not cumulative, the last one is +Inf), sum]
+        self._values : Dict[Tuple[str, ...], list] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value : float, **labels : str):
+        key = tuple(str(labels[name]) for name in self.labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None:
+                entry = self._values[key] = [[0] * (len(self.buckets) + 1), 0.]
+            entry[0][index] += 1
+            entry[1] += value
+
+    def count(self, **labels : str) -> int:
+        entry = self._values.get(tuple(str(labels[name]) for name in self.labels))
+        return sum(entry[0]) if entry else 0
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            for key, (counts, total) in sorted(self._values.items()):
+                cumulative = 0
+                for bound, count in zip(self.buckets + (float("inf"),), counts):
+                    cumulative += count
+                    le = 'le="' + _format_value(bound) + '"'
+                    lines.append(f"{self.name}_bucket{_format_labels(self.labels, key, le)} {cumulative}")
+                lines.append(f"{self.name}_sum{_format_labels(self.labels, key)} {_format_value(total)}")
+                lines.append(f"{self.name}_count{_format_labels(self.labels, key)} {cumulative}")
+        return lines
+
+
+stage_seconds = Histogram("chatbot_stage_seconds", "Seconds spent per stage of answering a question", ("stage",))
+request_seconds = Histogram("chatbot_request_seconds", "Seconds per request, from the call to its last update", ("entry",))
+requests_total = Counter("chatbot_requests_total", "Requests by entry point and outcome", ("entry", "outcome"))
+llm_seconds = Histogram("chatbot_llm_seconds", "Seconds per chat completion, the whole stream for streams", ("model", "stream"))
+llm_requests_total = Counter("chatbot_llm_requests_total", "Chat completions by model and status", ("model", "stream", "status"))
+llm_tokens_total = Counter("chatbot_llm_tokens_total", "Chat completion tokens (estimated for streams)", ("model", "kind"))
+vector_search_seconds = Histogram("chatbot_vector_search_seconds", "Seconds per vector search, embedding the query included", ("backend",))
+vector_search_distance = Histogram("chatbot_vector_search_top_distance", "Distance of the closest search result", ("backend",),
+                                   buckets=DISTANCE_BUCKETS)
+index_rebuild_seconds = Histogram("chatbot_index_rebuild_seconds", "Seconds per stage of an index rebuild", ("stage",))
+index_rebuilds_total = Counter("chatbot_index_rebuilds_total", "Index rebuilds by status", ("status",))
+intent_gate_total = Counter("chatbot_intent_gate_total", "Intent checks by the path that decided them", ("path",))
+llm_events_total = Counter("chatbot_llm_events_total", "Chat completion retries, hedges and circuit breaker rejections", ("event",))
+question_embeddings_total = Counter("chatbot_question_embeddings_total",
+                                    "Question embeddings needed (cache, intent gate, retrieval): embedded, reused or skipped for a lexical match",
+                                    ("result",))
+embedding_batch_size = Histogram("chatbot_embedding_batch_size", "Queries per batched embedding request", buckets=BATCH_SIZE_BUCKETS)
+embedding_batch_wait = Histogram("chatbot_embedding_batch_wait_seconds", "Seconds a query waited for its embedding batch to be sent")
+embedding_requests_total = Counter("chatbot_embedding_requests_total",
+                                   "Batched query embedding requests sent, embedding_queries_total minus this is the requests saved")
+embedding_queries_total = Counter("chatbot_embedding_queries_total",
+                                  "Query embeddings by how they were served: sent, coalesced with the same text in flight, cache_hit",
+                                  ("result",))
+openai_queue_seconds = Histogram("chatbot_openai_queue_seconds", "Seconds a request waited for its turn at the openai rate limits",
+                                 ("api", "priority"))
+openai_scheduler_total = Counter("chatbot_openai_scheduler_total",
+                                 "Requests to openai shed (shed_full, shed_timeout) and 429 backoffs (rate_limited) by api and priority",
+                                 ("api", "priority", "event"))
+
+REGISTRY = [stage_seconds, request_seconds, requests_total, llm_seconds, llm_requests_total, llm_tokens_total,
+            vector_search_seconds, vector_search_distance, index_rebuild_seconds, index_rebuilds_total, intent_gate_total,
+            llm_events_total, question_embeddings_total, embedding_batch_size, embedding_batch_wait, embedding_requests_total, embedding_queries_total,
+            openai_queue_seconds, openai_scheduler_total]
+
+
+"""
+Every metric in the Prometheus text format
+"""
+def render() -> str:
+    return "\n".join(line for metric in REGISTRY for line in metric.render()) + "\n"
+
+
+"""
+What happened while serving one request: seconds per stage, chat completions and vector searches.
+Logged as one json line (logger "metrics") when the request finishes
+"""
+class Trace:
+    def __init__(self, entry : str):
+        self.entry = entry
+        self.request_id = uuid.uuid4().hex[:16]
+        self.start = time.perf_counter()
+        self.attributes : Dict[str, Any] = {}
+        self.stages : Dict[str, float] = {}
+        self.llm_calls : List[dict] = []
+        self.searches : List[dict] = []
+
+    # outcome is "error" or "cancelled" when the request didn't complete, else the one it was annotated with
+    def finish(self, outcome : Optional[str] = None):
+        seconds = time.perf_counter() - self.start
+        outcome = outcome or self.attributes.pop("outcome", None) or "ok"
+        self.attributes.pop("outcome", None)
+        request_seconds.observe(seconds, entry=self.entry)
+        requests_total.inc(entry=self.entry, outcome=outcome)
+        if logger.isEnabledFor(logging.INFO):
+            logger.info(json.dumps({
+                "event" : "request", "entry" : self.entry, "request_id" : self.request_id, "outcome" : outcome,
+                "ms" : round(seconds * 1000, 3), **self.attributes,
+                "stages" : {stage : round(seconds * 1000, 3) for stage, seconds in self.stages.items()},
+                "llm_calls" : self.llm_calls, "searches" : self.searches,
+            }))
+
+
+_current_trace : contextvars.ContextVar[Optional[Trace]] = contextvars.ContextVar("trace", default=None)
+
+
+def current_trace() -> Optional[Trace]:
+    return _current_trace.get()
+
+
+"""
+Make trace the current one for the duration of the block. The block must not yield,
+see traced for generators
+"""
+@contextmanager
+def activate(trace : Optional[Trace]) -> Iterator[Optional[Trace]]:
+    token = _current_trace.set(trace)
+    try:
+        yield trace
+    finally:
+        _current_trace.reset(token)
+
+
+"""
+Set attributes of the current request (outcome, is_intent, ...), they go in its log line
+"""
+def annotate(**attributes : Any):
+    trace = _current_trace.get()
+    if trace is not None:
+        trace.attributes.update(attributes)
+
+
+"""
+Seconds spent on a stage: into timings (if given) whether or not metrics are enabled,
+and into the stage histogram and the current request
+"""
+def record_stage(stage : str, seconds : float, timings : Optional[Dict[str, float]] = None):
+    if timings is not None:
+        timings[stage] = seconds
+    if not METRICS_ENABLED:
+        return
+    stage_seconds.observe(seconds, stage=stage)
+    trace = _current_trace.get()
+    if trace is not None:
+        trace.stages[stage] = seconds
+
+
+@contextmanager
+def span(stage : str, timings : Optional[Dict[str, float]] = None) -> Iterator[None]:
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_stage(stage, time.perf_counter() - start, timings)
+
+
+def record_llm_call(model : str, stream : bool, seconds : float, prompt_tokens : int, completion_tokens : int,
+                    status : str = "ok"):
+    if not METRICS_ENABLED:
+        return
+    llm_seconds.observe(seconds, model=model, stream=str(stream).lower())
+    llm_requests_total.inc(model=model, stream=str(stream).lower(), status=status)
+    llm_tokens_total.inc(prompt_tokens, model=model, kind="prompt")
+    llm_tokens_total.inc(completion_tokens, model=model, kind="completion")
+    trace = _current_trace.get()
+    if trace is not None:
+        trace.llm_calls.append({"model" : model, "stream" : stream, "status" : status, "ms" : round(seconds * 1000, 3),
+                                "prompt_tokens" : prompt_tokens, "completion_tokens" : completion_tokens})
+
+
+def record_search(backend : str, seconds : float, distances : List[float]):
+    if not METRICS_ENABLED:
+        return
+    vector_search_seconds.observe(seconds, backend=backend)
+    if distances:
+        vector_search_distance.observe(distances[0], backend=backend)
+    trace = _current_trace.get()
+    if trace is not None:
+        trace.searches.append({"backend" : backend, "ms" : round(seconds * 1000, 3),
+                               "distances" : [round(distance, 4) for distance in distances]})
+
+
+def record_rebuild(timings : Dict[str, float], status : str = "done"):
+    if not METRICS_ENABLED:
+        return
+    index_rebuilds_total.inc(status=status)
+    for stage, seconds in timings.items():
+        index_rebuild_seconds.observe(seconds, stage=stage)
+
+
+def count_intent_path(path : str):
+    if METRICS_ENABLED:
+        intent_gate_total.inc(path=path)
+
+
+def record_embedding_batch(size : int, waits : List[float]):
+    if not METRICS_ENABLED:
+        return
+    embedding_requests_total.inc()
+    embedding_batch_size.observe(size)
+    for seconds in waits:
+        embedding_batch_wait.observe(seconds)
+
+
+def count_embedding_query(result : str):
+    if METRICS_ENABLED:
+        embedding_queries_total.inc(result=result)
+
+
+def record_scheduler_wait(api : str, priority : str, seconds : float):
+    if not METRICS_ENABLED:
+        return
+    openai_queue_seconds.observe(seconds, api=api, priority=priority)
+    trace = _current_trace.get()
+    if trace is not None:
+        trace.attributes["openai_queue_ms"] = round(trace.attributes.get("openai_queue_ms", 0.) + seconds * 1000, 3)
+
+
+def count_scheduler_event(api : str, priority : str, event : str):
+    if METRICS_ENABLED:
+        openai_scheduler_total.inc(api=api, priority=priority, event=event)
+
+
+def count_question_embedding(result : str):
+    if not METRICS_ENABLED:
+        return
+    question_embeddings_total.inc(result=result)
+    trace = _current_trace.get()
+    if trace is not None:
+        trace.attributes.setdefault("embeddings", []).append(result)
+
+
+"""
+A retry, hedge, ... of the chat completions (see ResilientCaller), also listed in the log line of the current request
+"""
+def record_llm_event(event : str):
+    if not METRICS_ENABLED:
+        return
+    llm_events_total.inc(event=event)
+    trace = _current_trace.get()
+    if trace is not None:
+        trace.attributes.setdefault("llm_events", []).append(event)
+
+
+def _record_first_update(trace : Trace):
+    if "first_update" not in trace.stages:
+        with activate(trace):
+            record_stage("first_update", time.perf_counter() - trace.start)
+
+
+"""
+Trace every call of the decorated function as one request, entry is its name in the metrics and logs.
+Works on functions, coroutines, generators and async generators. A call made while a request is already being
+traced (app.bot calling answer_question_stream_async) is part of that request
+
+Generators are resumed by whichever thread or task reads the next update (gradio reads sync generators from a
+thread pool), so the trace is made current around every step rather than once, and time to the first update
+is recorded as the first_update stage
+
+Without METRICS_ENABLED the function is returned as is
+"""
+def traced(entry : str) -> Callable[[Callable], Callable]:
+    def decorator(fn : Callable) -> Callable:
+        if not METRICS_ENABLED:
+            return fn
+
+        def begin() -> Tuple[Trace, bool]:
+            trace = _current_trace.get()
+            return (trace, False) if trace is not None else (Trace(entry), True)
+
+        if inspect.isasyncgenfunction(fn):
+            @functools.wraps(fn)
+            async def async_generator_wrapper(*args, **kwargs):
+                trace, owner = begin()
+                outcome = "cancelled"
+                generator = fn(*args, **kwargs)
+                try:
+                    while True:
+                        with activate(trace):
+                            try:
+                                item = await generator.__anext__()
+                            except StopAsyncIteration:
+                                outcome = None
+                                return
+                        if owner:
+                            _record_first_update(trace)
+                        yield item
+                except Exception:
+                    outcome = "error"
+                    raise
+                finally:
+                    with activate(trace):
+                        await generator.aclose()
+                    if owner:
+                        trace.finish(outcome)
+            return async_generator_wrapper
+
+        if inspect.isgeneratorfunction(fn):
+            @functools.wraps(fn)
+            def generator_wrapper(*args, **kwargs):
+                trace, owner = begin()
+                outcome = "cancelled"
+                generator = fn(*args, **kwargs)
+                try:
+                    while True:
+                        with activate(trace):
+                            try:
+                                item = next(generator)
+                            except StopIteration:
+                                outcome = None
+                                return
+                        if owner:
+                            _record_first_update(trace)
+                        yield item
+                except Exception:
+                    outcome = "error"
+                    raise
+                finally:
+                    with activate(trace):
+                        generator.close()
+                    if owner:
+                        trace.finish(outcome)
+            return generator_wrapper
+
+        if inspect.iscoroutinefunction(fn):
+            @functools.wraps(fn)
+            async def coroutine_wrapper(*args, **kwargs):
+                trace, owner = begin()
+                outcome = "cancelled"
+                try:
+                    with activate(trace):
+                        result = await fn(*args, **kwargs)
+                    outcome = None
+                    return result
+                except Exception:
+                    outcome = "error"
+                    raise
+                finally:
+                    if owner:
+                        trace.finish(outcome)
+            return coroutine_wrapper
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            trace, owner = begin()
+            outcome = "error"
+            try:
+                with activate(trace):
+                    result = fn(*args, **kwargs)
+                outcome = None
+                return result
+            finally:
+                if owner:
+                    trace.finish(outcome)
+        return wrapper
+    return decorator
+
+
+"""
+Serve render() at GET /metrics from a background thread, for prometheus to scrape. Returns the server
+"""
+def start_metrics_server(host : str = METRICS_HOST, port : int = METRICS_PORT) -> ThreadingHTTPServer:
+    class Handler(BaseHTTPRequestHandler):
+        def log_message(self, *args):
+            pass
+
+        def do_GET(self):
+            if self.path.split("?")[0] != "/metrics":
+                self.send_response(404)
+                self.end_headers()
+                return
+            data = render().encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="metrics", daemon=True).start()
+    return server
@@ -0,0 +1,155 @@
+import asyncio
+import unittest
+import contextvars
+import urllib.request
+import urllib.error
+from concurrent.futures import ThreadPoolExecutor
+import metrics
+from metrics import Counter, Histogram, traced, span, annotate, record_stage, record_llm_call, current_trace, start_metrics_server
+
+
+class TestMetrics(unittest.TestCase):
+
+    def setUp(self):
+        self.traces = []
+        self.finish = metrics.Trace.finish
+        traces = self.traces
+        finish = self.finish
+
+        def record_finish(trace, outcome=None):
+            traces.append((trace, outcome or trace.attributes.get("outcome") or "ok"))
+            finish(trace, outcome)
+
+        metrics.Trace.finish = record_finish
+
+    def tearDown(self):
+        metrics.Trace.finish = self.finish
+
+
+    def test_render(self):
+        counter = Counter("test_total", "Test counter", ("kind",))
+        counter.inc(kind="a")
+        counter.inc(2, kind='b"')
+        histogram = Histogram("test_seconds", "Test histogram", buckets=(0.1, 1.))
+        histogram.observe(0.05)
+        histogram.observe(0.5)
+        histogram.observe(5)
+        lines = counter.render() + histogram.render()
+        self.assertIn("# TYPE test_total counter", lines)
+        self.assertIn('test_total{kind="a"} 1', lines)
+        self.assertIn('test_total{kind="b\\""} 2', lines)
+        self.assertIn('test_seconds_bucket{le="0.1"} 1', lines)
+        self.assertIn('test_seconds_bucket{le="1"} 2', lines)
+        self.assertIn('test_seconds_bucket{le="+Inf"} 3', lines)
+        self.assertIn("test_seconds_count 3", lines)
+        self.assertEqual(histogram.count(), 3)
+
+
+    def test_traced_function(self):
+        executor = ThreadPoolExecutor(max_workers=1)
+
+        @traced("test_function")
+        def answer(timings):
+            with span("retrieval", timings):
+                pass
+            # Stages recorded on another thread belong to the request when run in a copy of its context
+            executor.submit(contextvars.copy_context().run, record_stage, "generation", 0.5).result()
+            record_llm_call("test-model", False, 0.5, 10, 20)
+            annotate(outcome="answered")
+            return current_trace()
+
+        timings = {}
+        trace = answer(timings)
+        executor.shutdown()
+        self.assertIsNone(current_trace())
+        self.assertEqual(self.traces, [(trace, "answered")])
+        self.assertIn("retrieval", timings)
+        self.assertEqual(set(trace.stages), {"retrieval", "generation"})
+        self.assertEqual(trace.llm_calls[0]["completion_tokens"], 20)
+
+
+    def test_traced_error(self):
+        @traced("test_error")
+        def answer():
+            raise ValueError()
+
+        with self.assertRaises(ValueError):
+            answer()
+        self.assertEqual(self.traces[0][1], "error")
+
+
+    def test_traced_generators(self):
+        @traced("test_inner")
+        async def inner():
+            for i in range(3):
+                await asyncio.sleep(0)
+                with span(f"step{i}"):
+                    pass
+                yield i
+
+        @traced("test_outer")
+        async def outer():
+            async for i in inner():
+                yield i
+
+        @traced("test_generator")
+        def generator():
+            yield current_trace()
+            yield current_trace()
+
+        async def run():
+            items = [i async for i in outer()]
+            # Left before the end
+            async for i in outer():
+                break
+            return items
+
+        self.assertEqual(asyncio.run(run()), [0, 1, 2])
+        (trace, outcome), (cancelled, cancelled_outcome) = self.traces
+        # inner is part of outer's request
+        self.assertEqual((trace.entry, outcome), ("test_outer", "ok"))
+        self.assertEqual(set(trace.stages), {"step0", "step1", "step2", "first_update"})
+        self.assertEqual(cancelled_outcome, "cancelled")
+
+        # The trace is current while the generator runs, not in between
+        steps = generator()
+        first = next(steps)
+        self.assertIsNone(current_trace())
+        self.assertIs(next(steps), first)
+        self.assertEqual(list(steps), [])
+        self.assertIs(self.traces[-1][0], first)
+
+
+    def test_disabled(self):
+        enabled = metrics.METRICS_ENABLED
+        metrics.METRICS_ENABLED = False
+        try:
+            def answer():
+                return current_trace()
+
+            self.assertIs(traced("test_disabled")(answer), answer)
+            timings = {}
+            with span("retrieval", timings):
+                pass
+            self.assertIn("retrieval", timings)
+        finally:
+            metrics.METRICS_ENABLED = enabled
+
+
+    def test_metrics_server(self):
+        record_stage("test_stage", 0.01)
+        server = start_metrics_server("127.0.0.1", 0)
+        try:
+            url = f"http://127.0.0.1:{server.server_address[1]}"
+            with urllib.request.urlopen(url + "/metrics") as response:
+                body = response.read().decode()
+            self.assertIn('chatbot_stage_seconds_count{stage="test_stage"}', body)
+            with self.assertRaises(urllib.error.HTTPError):
+                urllib.request.urlopen(url + "/other")
+        finally:
+            server.shutdown()
+            server.server_close()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,151 @@
+import os
+import sys
+import time
+import argparse
+import jsonlines
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, Future
+from typing import List, Tuple, Iterator, Union, Optional, Callable, Deque
+from preprocess import get_docs, FunctionDoc
+
+
+# Files handed to a worker process per task, amortizes the inter process overhead for small files
+FILES_PER_TASK = 16
+
+
+"""
+Expand sources into an ordered list of python files: a directory (walked in sorted order), a file path,
+or a list mixing both. The order only depends on the sources, so output is deterministic
+"""
+def list_source_files(sources : Union[str, List[str]]) -> List[str]:
+    sources = [sources] if isinstance(sources, str) else sources
+    out = []
+    for source in sources:
+        if os.path.isdir(source):
+            for root, dirs, files in os.walk(source):
+                dirs[:] = sorted(d for d in dirs if not d.startswith(".") and d != "__pycache__")
+                out.extend(os.path.join(root, name) for name in sorted(files) if name.endswith(".py"))
+        else:
+            out.append(source)
+    return out
+
+
+"""
+Runs in the worker processes: parse every file of the task, returns (path, docs as dicts or None if it doesn't parse)
+"""
+def parse_files(paths : List[str]) -> List[Tuple[str, Optional[List[dict]]]]:
+    out = []
+    for path in paths:
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                program = f.read()
+            out.append((path, [doc.dict() for doc in get_docs(program, "", save=False)]))
+        except (SyntaxError, UnicodeDecodeError, ValueError):
+            out.append((path, None))
+    return out
+
+
+"""
+Parse files across a process pool and yield (path, docs) in the order of the files
+
+At most workers * 2 tasks are in flight, results are consumed in submission order, so memory stays bounded
+and the output doesn't depend on which worker finishes first
+"""
+def iter_parsed_files(paths : List[str], workers : int) -> Iterator[Tuple[str, Optional[List[dict]]]]:
+    tasks = [paths[i : i + FILES_PER_TASK] for i in range(0, len(paths), FILES_PER_TASK)]
+    if workers <= 1:
+        for task in tasks:
+            yield from parse_files(task)
+        return
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        pending : Deque[Future] = deque()
+        next_task = 0
+        while next_task < len(tasks) or pending:
+            while next_task < len(tasks) and len(pending) < workers * 2:
+                pending.append(executor.submit(parse_files, tasks[next_task]))
+                next_task += 1
+            yield from pending.popleft().result()
+
+
+"""
+Extract the docs of many python files and stream them to data/{title}_doc.jsonl in batches of batch_size
+
+Every batch is also passed to on_batch (e.g. IndexBuilder.add), nothing holds all docs in memory.
+Returns throughput stats: files, failed files, docs, seconds, files/s and docs/s
+"""
+def extract_docs(sources : Union[str, List[str]],
+                 title : str,
+                 workers : Optional[int] = None,
+                 batch_size : int = 256,
+                 on_batch : Optional[Callable[[List[FunctionDoc]], None]] = None) -> dict:
+    start = time.perf_counter()
+    workers = workers or os.cpu_count() or 1
+    paths = list_source_files(sources)
+    files, failed, docs = 0, 0, 0
+    batch : List[FunctionDoc] = []
+
+    def flush():
+        writer.write_all(doc.dict() for doc in batch)
+        if on_batch:
+            on_batch(batch)
+        batch.clear()
+
+    with jsonlines.open(f"data/{title}_doc.jsonl", "w") as writer:
+        for path, parsed in iter_parsed_files(paths, workers):
+            files += 1
+            if parsed is None:
+                failed += 1
+                continue
+            for doc in parsed:
+                batch.append(FunctionDoc(**doc))
+                docs += 1
+                if len(batch) >= batch_size:
+                    flush()
+        if batch:
+            flush()
+
+    seconds = time.perf_counter() - start
+    return {"files" : files, "failed" : failed, "docs" : docs, "seconds" : seconds,
+            "files/s" : files / seconds if seconds else 0., "docs/s" : docs / seconds if seconds else 0.}
+
+
+def read_docs(title : str) -> Iterator[FunctionDoc]:
+    with jsonlines.open(f"data/{title}_doc.jsonl", "r") as reader:
+        for doc in reader:
+            yield FunctionDoc(**doc)
+
+
+"""
+Extract docs from sources and build a new version of the {title} index from them, streaming batches into
+the IndexBuilder as they are parsed. The version is made current if it validates
+"""
+def extract_and_index(sources : Union[str, List[str]], title : str, workers : Optional[int] = None, batch_size : int = 256) -> dict:
+    from indexing import IndexBuilder, get_index_db, validate_index_db, set_current_version, to_document
+
+    builder = IndexBuilder(title)
+    stats = extract_docs(sources, title, workers, batch_size,
+                         on_batch=lambda docs: builder.add(to_document(doc) for doc in docs))
+    version, index_stats = builder.finish(lambda: (to_document(doc) for doc in read_docs(title)))
+    if not validate_index_db(get_index_db(title, version, builder.embeddings), len(builder.ids)):
+        raise RuntimeError(f"Index version {version} failed validation")
+    set_current_version(title, version)
+    return {**stats, "version" : version, **index_stats}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Extract function docs from python sources in parallel")
+    parser.add_argument("sources", nargs="+", help="directories or python files")
+    parser.add_argument("--title", required=True, help="writes data/{title}_doc.jsonl")
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--batch-size", type=int, default=256)
+    parser.add_argument("--index", action="store_true", help="also build the {title} index (needs OPENAI_API_KEY)")
+    args = parser.parse_args()
+
+    run = extract_and_index if args.index else extract_docs
+    stats = run(args.sources, args.title, args.workers, args.batch_size)
+    print(f"{stats['files']} files ({stats['failed']} failed), {stats['docs']} docs in {stats['seconds']:.2f}s: "
+          f"{stats['files/s']:.1f} files/s, {stats['docs/s']:.1f} docs/s", file=sys.stderr)
+    if args.index:
+        print(f"index version {stats['version']}: {stats['added']} added, {stats['deleted']} deleted, "
+              f"{stats['embedded']} embedded", file=sys.stderr)
@@ -0,0 +1,62 @@
+import os
+import tempfile
+import unittest
+import jsonlines
+from pipeline import extract_docs, list_source_files
+
+
+PROGRAM = '''
+def fn_{i}(a, b):
+    """
+    Function {i}
+
+    Args:
+        a: first
+        b: second
+    """
+    return a + b
+'''
+
+
+class TestPipeline(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.cwd = os.getcwd()
+        os.chdir(self.tmp.name)
+        os.makedirs("data")
+        os.makedirs("src/pkg")
+        for i in range(40):
+            with open(f"src/pkg/module_{i:02d}.py", "w") as f:
+                f.write(PROGRAM.format(i=i))
+        with open("src/broken.py", "w") as f:
+            f.write("def broken(:\n")
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        self.tmp.cleanup()
+
+    def read(self, title):
+        with jsonlines.open(f"data/{title}_doc.jsonl") as reader:
+            return list(reader)
+
+
+    def test_deterministic_across_workers(self):
+        batches = []
+        serial = extract_docs("src", "serial", workers=1, batch_size=7)
+        parallel = extract_docs("src", "parallel", workers=3, batch_size=7, on_batch=lambda docs: batches.append(len(docs)))
+        self.assertEqual((serial["files"], serial["failed"], serial["docs"]), (41, 1, 40))
+        self.assertEqual(self.read("serial"), self.read("parallel"))
+        self.assertEqual([doc["name"] for doc in self.read("serial")][:2], ["fn_0", "fn_1"])
+        self.assertEqual(sum(batches), 40)
+        self.assertLessEqual(max(batches), 7)
+
+
+    def test_list_source_files(self):
+        files = list_source_files(["src/pkg", "src/broken.py"])
+        self.assertEqual(files[0], os.path.join("src/pkg", "module_00.py"))
+        self.assertEqual(files[-1], "src/broken.py")
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,53 +1,256 @@
-import sys
+from __future__ import annotations
 import os
-if not os.environ.get("OPENAI_API_KEY"):
-    print("Please set OpenAI API key environment variable and then run the app")
-    sys.exit()
-import openai
-openai.api_key = os.environ.get("OPENAI_API_KEY")
+import re
 import jsonlines
-from typing import Tuple, List, Optional
-from indexing import ingest_doc_page, build_index_db, get_index_db
-from langchain.schema import Document
-from langchain.vectorstores import Chroma
+import atexit
+import threading
+import time
+import queue
+import logging
+import asyncio
+import functools
+import contextvars
+from concurrent.futures import ThreadPoolExecutor, Future
+import numpy as np
+from collections import Counter
+from typing import Tuple, List, Optional, Dict, Iterator, AsyncIterator, Any, Callable, Union, TYPE_CHECKING
+from indexing import ingest_doc_page, build_index_db, get_index_db, validate_index_db, IndexState
+from indexing import get_current_version, set_current_version, prune_index_versions, get_embeddings
+from llm import call_gpt_turbo, call_gpt_turbo_stream, acall_gpt_turbo, acall_gpt_turbo_stream
+from answer_cache import AnswerCache
+from index_registry import IndexRegistry, IndexSpec, load_index_specs
+from prompt_budget import fit_doc, fit_messages, CODE_PROMPT_TOKEN_BUDGET, INTENT_PROMPT_TOKEN_BUDGET
+from conversation import Conversation, refers_back, CONVERSATION_FOLLOW_UP_WORDS
+from scheduler import priority, BACKGROUND
+from metrics import span, record_stage, annotate, traced, record_rebuild, count_intent_path, count_question_embedding
+# langchain (and chromadb under it) take most of the import time, they are imported on first use instead
+if TYPE_CHECKING:
+    from langchain.schema import Document
+    from langchain.vectorstores import Chroma
 
 
 INDEX_NAME = "veryfi_python_client"
 DOC_PAGE_URL = "https://raw.githubusercontent.com/veryfi/veryfi-python/master/veryfi/client.py"
+# Comma separated raw file urls or github tree urls (e.g. https://github.com/veryfi/veryfi-python/tree/master/veryfi)
+DOC_PAGE_URLS = os.environ.get("DOC_PAGE_URLS", DOC_PAGE_URL).split(",")
+# The index questions go to unless another one of INDEX_REGISTRY_PATH fits them better (see IndexRegistry.route)
+DEFAULT_INDEX = IndexSpec(name=INDEX_NAME, title="veryfi-python", sources=DOC_PAGE_URLS, keywords=["python"], few_shot=True)
+
+# Intent gate: cosine similarity between the question and the closest docstring sentence.
+# At or above YES the question is on topic, at or below NO it is not, anything in between is asked to chatgpt.
+# ada-002 scores any question about documents and inboxes above 0.9 against the docstrings, gmail ones included,
+# so only a near copy of a docstring is a local yes. Unrelated questions ("the weather in Paris") score below 0.8
+INTENT_GATE_ENABLED = os.environ.get("INTENT_GATE_ENABLED", "1") == "1"
+INTENT_YES_THRESHOLD = float(os.environ.get("INTENT_YES_THRESHOLD", "0.95"))
+INTENT_NO_THRESHOLD = float(os.environ.get("INTENT_NO_THRESHOLD", "0.8"))
+
+
+"""
+Raises if the thresholds leave no band for chatgpt, or turn it upside down (every question would be decided locally)
+"""
+def check_intent_thresholds(yes : float, no : float):
+    if not no < yes:
+        raise ValueError(f"INTENT_NO_THRESHOLD ({no}) must be below INTENT_YES_THRESHOLD ({yes})")
+
+
+check_intent_thresholds(INTENT_YES_THRESHOLD, INTENT_NO_THRESHOLD)
+
+# Start retrieval and generation while the intent check is still running. Saves one round trip for on-topic
+# questions, but off-topic questions pay for a generation that is thrown away. Turn off when cost matters more
+SPECULATIVE_GENERATION = os.environ.get("SPECULATIVE_GENERATION", "1") == "1"
+PREDICT_WORKERS = int(os.environ.get("PREDICT_WORKERS", "8"))
+
+# When the index is opened: "background" in a thread started by start_index_warmup while the app starts up,
+# "lazy" by the first question, "eager" while predict is imported (before the app binds its port)
+INDEX_WARMUP = os.environ.get("INDEX_WARMUP", "background")
+
+# Finished answers, by exact normalized question or by question embedding at least ANSWER_CACHE_SIMILARITY close.
+# Set ANSWER_CACHE_PATH to keep the cache across restarts
+ANSWER_CACHE_ENABLED = os.environ.get("ANSWER_CACHE_ENABLED", "1") == "1"
+ANSWER_CACHE_SIZE = int(os.environ.get("ANSWER_CACHE_SIZE", "256"))
+ANSWER_CACHE_TTL = float(os.environ.get("ANSWER_CACHE_TTL", str(24 * 3600)))
+# ada-002 scores unrelated questions about the sdk above 0.9 ("delete document" vs "get document"), only near rewordings pass this
+ANSWER_CACHE_SIMILARITY = float(os.environ.get("ANSWER_CACHE_SIMILARITY", "0.98"))
+ANSWER_CACHE_PATH = os.environ.get("ANSWER_CACHE_PATH") or None
+
+# Questions that name a function outright (see IndexState.search) are not embedded at all: the intent gate takes
+# them as on topic and the answer cache only looks them up by exact question. Needs HYBRID_SEARCH
+LEXICAL_SKIP_EMBEDDING = os.environ.get("LEXICAL_SKIP_EMBEDDING", "1") == "1"
+
+logger = logging.getLogger(__name__)
+_executor = ThreadPoolExecutor(max_workers=PREDICT_WORKERS, thread_name_prefix="predict")
+
+
+"""
+Run fn on the predict executor, in a copy of the caller's context so its stages count towards the caller's request
+"""
+def _submit(fn : Callable, *args) -> Future:
+    return _executor.submit(contextvars.copy_context().run, fn, *args)
+
+
+"""
+Run a blocking call (embedding, retrieval, loading the index) on the predict executor, for the async answer path.
+The langchain embeddings and vector stores have no async api, only the chat completions are awaited directly
+"""
+async def _in_executor(fn : Callable, *args) -> Any:
+    return await asyncio.wrap_future(_submit(fn, *args))
 
 
 """
 Ingest code file directly from github, extract function signatures and docstrings, generate embeddings for each function
-and build vector database for the embeddings to use for retrieval
+and build vector database for the embeddings to use for retrieval. name is one of the registry's indexes, the default one if None
+
+The new index is built into its own version directory while queries keep being served from the current one.
+It is only swapped in, by replacing its state in the registry, after it validates.
+Raises if the new version doesn't validate, the current index stays in place
+
+Returns the version, the counts from build_index_db and the seconds spent per stage (ingest, build, swap, total)
 
 Ideally this part should be in its own microservice and expose a REST API endpoint
 """
-def update_index():
-    global vectordb
-    documents : List[Document] = ingest_doc_page(DOC_PAGE_URL, INDEX_NAME)
-    build_index_db(documents, INDEX_NAME)
-    vectordb = get_index_db(INDEX_NAME)
+def update_index(name : Optional[str] = None) -> Dict[str, Any]:
+    spec = registry.spec(name)
+    with _rebuild_locks[spec.name]:
+        timings : Dict[str, float] = {}
+        start = time.perf_counter()
+        try:
+            documents : List[Document] = ingest_doc_page(spec.sources, spec.name)
+            timings["ingest"] = time.perf_counter() - start
+            version, stats = build_index_db(documents, spec.name)
+            timings["build"] = time.perf_counter() - start - timings["ingest"]
+            current = registry.peek(spec.name)
+            if current is None or current.version != version:
+                vectordb : Chroma = get_index_db(spec.name, version)
+                if not validate_index_db(vectordb, stats["added"] + stats["unchanged"]):
+                    raise RuntimeError(f"Index version {version} failed validation, keeping version {get_current_version(spec.name)}")
+                set_current_version(spec.name, version)
+                # New state object, so everything cached from the previous index is dropped together with it
+                state = IndexState(vectordb, version, spec.name)
+                state.get_lexical_index()
+                registry.put(spec.name, state)
+                prune_index_versions(spec.name)
+            timings["swap"] = time.perf_counter() - start - timings["ingest"] - timings["build"]
+        except Exception:
+            record_rebuild({"total" : time.perf_counter() - start}, status="failed")
+            raise
+        timings["total"] = time.perf_counter() - start
+        record_rebuild(timings)
+        return {"version" : version, **stats, "timings" : timings}
+
+
+def _run_index_rebuild(name : str):
+    try:
+        # Its embedding requests go after the questions', see RateLimitScheduler
+        with priority(BACKGROUND):
+            result = update_index(name)
+        update = {"state" : "done", "result" : result}
+    except Exception as e:
+        logger.exception("Index rebuild of %s failed", name)
+        update = {"state" : "failed", "error" : str(e)}
+    with _rebuild_status_lock:
+        _rebuild_status[name].update(update, finished=time.time())
+
+
+"""
+Start rebuilding an index (the default one if name is None) in a background thread, queries are served from
+its current version meanwhile
+
+If a rebuild of it is already running the request joins it instead of starting another one (counted in "coalesced").
+Returns the rebuild status, see get_rebuild_status
+"""
+def request_index_rebuild(name : Optional[str] = None) -> Dict[str, Any]:
+    name = registry.spec(name).name
+    with _rebuild_status_lock:
+        status = _rebuild_status[name]
+        if status["state"] == "running":
+            status["coalesced"] += 1
+            return {"index" : name, **status}
+        status.clear()
+        status.update(state="running", started=time.time(), finished=None, result=None, error=None, coalesced=0)
+        threading.Thread(target=_run_index_rebuild, args=(name,), name=f"index-rebuild-{name}", daemon=True).start()
+        return {"index" : name, **status}
+
+
+"""
+State of the last rebuild of an index: idle, running, done or failed, with start/finish times, the result 
+(version and counts from build_index_db) or the error, and the version served (None while it isn't open)
+"""
+def get_rebuild_status(name : Optional[str] = None) -> Dict[str, Any]:
+    name = registry.spec(name).name
+    state = registry.peek(name)
+    with _rebuild_status_lock:
+        return {"index" : name, **_rebuild_status[name], "current_version" : state.version if state else None}
+
+
+"""
+Open the persisted current version of an index, None if it was never built. Holds the index's rebuild lock,
+so it can't open an older version than the one a rebuild just swapped in
+"""
+def _open_index(spec : IndexSpec) -> Optional[IndexState]:
+    with _rebuild_locks[spec.name]:
+        state = registry.peek(spec.name)
+        if state is not None:
+            return state
+        version = get_current_version(spec.name)
+        if not version:
+            return None
+        state = IndexState(get_index_db(spec.name, version), version, spec.name)
+        state.get_lexical_index()
+        logger.info("Loaded index %s version %s", spec.name, version)
+        return state
+
+
+registry = IndexRegistry(load_index_specs(DEFAULT_INDEX), _open_index)
+_rebuild_locks : Dict[str, threading.Lock] = {name : threading.Lock() for name in registry.specs}
+_rebuild_status_lock = threading.Lock()
+_rebuild_status : Dict[str, Dict[str, Any]] = {name : {"state" : "idle"} for name in registry.specs}
+
+
+"""
+The live state of an index (the default one if name is None), opened on first use: the current version if
+one was persisted, else a new index is built. The registry may close it when other indexes need the memory,
+it is opened again here then
+"""
+def get_index_state(name : Optional[str] = None) -> IndexState:
+    state = registry.get(name)
+    if state is not None:
+        return state
+    update_index(name)
+    return registry.get(name)
+
+
+"""
+Name of the index a question goes to, index if it is one (picked in the UI), see IndexRegistry.route
+"""
+def route_question(question : str, index : Optional[str] = None) -> str:
+    return registry.route(question, index)
+
+
+def _warm_up():
+    start = time.perf_counter()
+    try:
+        get_index_state()
+        import openai
+    except Exception:
+        logger.exception("Index warmup failed, the first question will retry")
+        return
+    logger.info("Index warmed up in %.2fs", time.perf_counter() - start)
 
 
-# Load pre-built index if exists, else create new index
-if os.path.isdir(INDEX_NAME):
-    vectordb : Chroma = get_index_db(INDEX_NAME)
-else:
-    update_index()
+"""
+Open the index (and import what answering needs) in a background thread, so it overlaps with the app starting.
+Questions that arrive before it is done wait for it in get_index_state. Does nothing unless INDEX_WARMUP is "background"
+"""
+def start_index_warmup() -> Optional[threading.Thread]:
+    if INDEX_WARMUP != "background":
+        return None
+    thread = threading.Thread(target=_warm_up, name="index-warmup", daemon=True)
+    thread.start()
+    return thread
 
 
-def call_gpt_turbo(messages, token_len=300) -> Optional[str]:
-  response = openai.ChatCompletion.create(
-    model="gpt-3.5-turbo",
-    messages=messages,
-    temperature=0.,
-    max_tokens=token_len,
-  )
-  if "choices" in response:
-    if len(response["choices"]) > 0:
-      out = response["choices"][0]["message"]["content"]
-      return out.strip()
-  return None
+if INDEX_WARMUP == "eager":
+    get_index_state()
 
 
 """
@@ -69,18 +272,170 @@ def parse_codeblock(text : str) -> str:
     return "".join(lines)
 
 
+"""
+The text parse_codeblock rendered html from, to remember an answer as it was written
+"""
+def unparse_codeblock(html : str) -> str:
+    lines = [""]
+    for part in re.split(r'(<pre><code class="[^"]*">|</code></pre>|<br/>)', html):
+        if part.startswith("<pre><code"):
+            lines.append("```" + part[len('<pre><code class="') : -2])
+        elif part == "</code></pre>":
+            lines.append("```")
+        elif part == "<br/>":
+            lines.append("")
+        else:
+            lines[-1] += part.replace("&lt;", "<").replace("&gt;", ">")
+    # A fence on the first line left an empty one before it
+    if len(lines) > 1 and not lines[0] and lines[1].startswith("```"):
+        lines.pop(0)
+    return "\n".join(lines)
+
+
+"""
+Incremental parse_codeblock for streamed completions
+
+Complete lines are rendered once and kept, only the trailing partial line is rendered again on every chunk.
+A partial line containing ` is held back until its newline arrives, so a half received fence like ``` or ```pyth
+is never shown as text or with the wrong language class. While a code block is open the output is closed with
+</code></pre> so every intermediate render is valid html
+
+close() returns exactly parse_codeblock of the stripped full text, same as the non streaming path
+"""
+class CodeblockStreamRenderer:
+    def __init__(self):
+        self._text = ""
+        self._rendered_lines : List[str] = []
+        self._pending = ""
+        self._in_code = False
+
+    def _render_line(self, line : str, index : int) -> str:
+        if "```" in line:
+            return f'<pre><code class="{line[3:]}">' if line != "```" else '</code></pre>'
+        if index > 0:
+            return "<br/>" + line.replace("<", "&lt;").replace(">", "&gt;")
+        return line
+
+    def feed(self, chunk : str) -> str:
+        if not self._text:
+            # Same as the strip() in call_gpt_turbo
+            chunk = chunk.lstrip()
+        self._text += chunk
+        lines = (self._pending + chunk).split("\n")
+        self._pending = lines.pop()
+        for line in lines:
+            if "```" in line:
+                self._in_code = line != "```"
+            self._rendered_lines.append(self._render_line(line, len(self._rendered_lines)))
+        return self.render()
+
+    def render(self) -> str:
+        out = "".join(self._rendered_lines)
+        if self._pending and "`" not in self._pending:
+            out += self._render_line(self._pending, len(self._rendered_lines))
+        if self._in_code:
+            out += '</code></pre>'
+        return out
+
+    def close(self) -> str:
+        return parse_codeblock(self._text.strip())
+
+
+def _render_answer(out : Optional[str], timings : Dict[str, float]) -> Optional[str]:
+    if out:
+        with span("render", timings):
+            out = parse_codeblock(out)
+    return out
+
+
 """
 Call chatgpt to generate sample code for how to use the veryfi-python package, given a question in natural language
+See build_code_suggestion_messages for the prompt, state is the index to answer from (the default one if None)
+and conversation what the session said before the question (see Conversation)
+"""
+def generate_code_suggestion(question : str, timings : Optional[Dict[str, float]] = None, 
+                             vector : Optional[np.ndarray] = None, state : Optional[IndexState] = None,
+                             conversation : Optional[Conversation] = None) -> Optional[str]:
+    timings = {} if timings is None else timings
+    messages = build_code_suggestion_messages(question, timings, vector, state, conversation)
+    with span("generation", timings):
+        out = call_gpt_turbo(messages)
+    return _render_answer(out, timings)
+
+
+"""
+Streaming variant of generate_code_suggestion, yields the rendered html of the answer so far after every chunk
+The last value yielded is the complete answer, empty if chatgpt didn't return anything
+"""
+def generate_code_suggestion_stream(question : str, timings : Optional[Dict[str, float]] = None, 
+                                    vector : Optional[np.ndarray] = None, state : Optional[IndexState] = None,
+                                    conversation : Optional[Conversation] = None) -> Iterator[str]:
+    timings = {} if timings is None else timings
+    messages = build_code_suggestion_messages(question, timings, vector, state, conversation)
+    renderer = CodeblockStreamRenderer()
+    start = time.perf_counter()
+    for delta in call_gpt_turbo_stream(messages):
+        if "first_token" not in timings:
+            record_stage("first_token", time.perf_counter() - start, timings)
+        yield renderer.feed(delta)
+    record_stage("generation", time.perf_counter() - start, timings)
+    yield renderer.close()
+
+
+"""
+Async variant of generate_code_suggestion
+"""
+async def generate_code_suggestion_async(question : str, timings : Optional[Dict[str, float]] = None, 
+                                         vector : Optional[np.ndarray] = None, state : Optional[IndexState] = None,
+                                         conversation : Optional[Conversation] = None) -> Optional[str]:
+    timings = {} if timings is None else timings
+    messages = await _in_executor(build_code_suggestion_messages, question, timings, vector, state, conversation)
+    with span("generation", timings):
+        out = await acall_gpt_turbo(messages)
+    return _render_answer(out, timings)
+
+
+"""
+Async variant of generate_code_suggestion_stream
+"""
+async def generate_code_suggestion_stream_async(question : str, timings : Optional[Dict[str, float]] = None, 
+                                                vector : Optional[np.ndarray] = None, state : Optional[IndexState] = None,
+                                                conversation : Optional[Conversation] = None) -> AsyncIterator[str]:
+    timings = {} if timings is None else timings
+    messages = await _in_executor(build_code_suggestion_messages, question, timings, vector, state, conversation)
+    renderer = CodeblockStreamRenderer()
+    start = time.perf_counter()
+    async for delta in acall_gpt_turbo_stream(messages):
+        if "first_token" not in timings:
+            record_stage("first_token", time.perf_counter() - start, timings)
+        yield renderer.feed(delta)
+    record_stage("generation", time.perf_counter() - start, timings)
+    yield renderer.close()
+
+
+"""
+Prompt for the code suggestion
 
 To give chatgpt some context, include 3 examples taken from the veryfi-python README page. The example is given in this format
 
 input: {most_relevant_doc}\n{question}
 output: {code}
 
-{most_relevant_doc} is retrieved using embedding search over a pre-built index of all function signatures and docstrings
+{most_relevant_doc} is retrieved using hybrid keyword and embedding search over a pre-built index of all function
+signatures and docstrings (see IndexState.search), of state or the default index. vector is the question embedding
+if it was already computed
+
+The sample questions never change, so the system prompt and samples only depend on the index.
+They are built once per index version and cached on the IndexState. Only indexes with few_shot get them,
+they are veryfi-python client examples
+
+In a conversation the earlier turns go between the samples and the question, packed within their own
+CONVERSATION_TOKEN_BUDGET (see Conversation.messages), and the doc is retrieved for the question with the one before
+it (see Conversation.query). vector is the embedding of the question alone, it is only used without earlier turns
 """
-def generate_code_suggestion(question : str) -> Optional[str]:
-    def build_prompt_with_samples_for_code_suggestion() -> List[dict]:
+def build_code_suggestion_messages(question : str, timings : Dict[str, float], vector : Optional[np.ndarray] = None,
+                                   state : Optional[IndexState] = None, conversation : Optional[Conversation] = None) -> List[dict]:
+    def build_prompt_with_samples_for_code_suggestion(state : IndexState) -> List[dict]:
         setup_code = \
         """
     from veryfi import Client
@@ -128,29 +483,116 @@ def generate_code_suggestion(question : str) -> Optional[str]:
         questions = [sample_question1, sample_question2, sample_question3]
         codes = [sample_code1, sample_code2, sample_code3]
         out = [{"role" : "system", "content" : """You are a helpful Python developer. I give you a few python code examples with documentation."""}]
+        if not spec.few_shot:
+            return out
         for q, c in zip(questions, codes):
-            retrieved_docs : Tuple[Document, int] = vectordb.similarity_search_with_score(q)
-            most_relevant_doc : str = retrieved_docs[0][0].page_content
+            retrieved_docs, _ = state.search(q)
+            most_relevant_doc : str = fit_doc(retrieved_docs[0][0])
             out.append({"role" : "user", "content" : f"{most_relevant_doc}\n{q.strip()}"})
             out.append({"role" : "assistant", "content" : c.strip()})
         
         return out
 
-    #
-    retrieved_docs : Tuple[Document, int] = vectordb.similarity_search_with_score(question)
-    most_relevant_doc = retrieved_docs[0][0].page_content
+    start = time.perf_counter()
+    # Read the state once, update_index can swap the index while this request is running
+    state = state or get_index_state()
+    spec : IndexSpec = registry.spec(state.index_name)
+    history, history_tokens = conversation.messages() if conversation else ([], 0)
+    query = conversation.query(question) if conversation else question
+    retrieved_docs, path = state.search(query, embedding=vector if query == question else None)
+    _count_embedding(path)
+    most_relevant_doc = fit_doc(retrieved_docs[0][0])
     instruction = \
-    """Using the provided function signature and documentation from veryfi OCR package. 
+    f"""Using the provided function signature and documentation from {spec.title} package. 
         Please give me Python code for this prompt.
     """.strip()
-    messages = build_prompt_with_samples_for_code_suggestion()
-    messages.append({"role" : "user", "content" : f"{instruction}\n{most_relevant_doc}\n{question.strip()}"})
-    out = call_gpt_turbo(messages)
-    if out:
-        return parse_codeblock(out)
+    samples : List[dict] = state.get_or_build("code_suggestion_samples", 
+                                              lambda: build_prompt_with_samples_for_code_suggestion(state))
+    # The cached samples are shared between requests, fit_messages builds a new list.
+    # Samples are dropped from the last one if the prompt would be over budget
+    examples = [samples[i : i + 2] for i in range(1, len(samples), 2)]
+    messages, tokens = fit_messages(samples[:1], examples, 
+                                    history + [{"role" : "user", "content" : f"{instruction}\n{most_relevant_doc}\n{question.strip()}"}],
+                                    CODE_PROMPT_TOKEN_BUDGET + history_tokens)
+    logger.debug("code suggestion prompt: %d tokens (%d of them earlier turns), %d of %d samples", 
+                 tokens, history_tokens, (len(messages) - 2 - len(history)) // 2, len(examples))
+    record_stage("retrieval", time.perf_counter() - start, timings)
+    return messages
+
+
+"""
+First sentence of every docstring in the index, these represent what users might ask about the package
+"""
+def load_intent_samples(index_name : str = INDEX_NAME) -> List[str]:
+    out = []
+    with jsonlines.open(f"data/{index_name}_doc.jsonl", "r") as reader:
+        for sample in reader:
+            docstring = sample["docstring"]
+            if docstring:
+                out.append(docstring.split("\n")[0].strip())
     return out
 
 
+"""
+Embed the intent samples and normalize them, so scoring a question is a single matrix-vector product
+"""
+def build_intent_gate(samples : List[str]) -> np.ndarray:
+    if not samples:
+        return np.zeros((0, 0), dtype=np.float32)
+    vectors = np.asarray(get_embeddings().embed_documents(samples), dtype=np.float32)
+    return vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+
+
+def embed_question(question : str) -> np.ndarray:
+    return np.asarray(get_embeddings().embed_query(question), dtype=np.float32)
+
+
+"""
+Highest cosine similarity between the question embedding and any of the intent samples
+"""
+def score_intent(vector : np.ndarray, gate : np.ndarray) -> float:
+    if gate.size == 0:
+        return 0.
+    return float(np.max(gate @ vector) / np.linalg.norm(vector))
+
+
+# How many questions each path of is_veryfi_python_help_intent answered: lexical_yes, local_yes, local_no, llm
+intent_gate_stats : Counter = Counter()
+_intent_gate_stats_lock = threading.Lock()
+
+
+def _count_intent_path(path : str):
+    with _intent_gate_stats_lock:
+        intent_gate_stats[path] += 1
+    count_intent_path(path)
+
+
+def get_intent_gate_stats() -> Dict[str, int]:
+    with _intent_gate_stats_lock:
+        return dict(intent_gate_stats)
+
+
+# What happened every time a question embedding was needed (answer cache, intent gate, retrieval): "embedded"
+# is a request to openai, "reused" an embedding of the same question from an earlier stage, "lexical" none at all
+embedding_stats : Counter = Counter()
+_embedding_stats_lock = threading.Lock()
+
+
+def _count_embedding(result : str):
+    with _embedding_stats_lock:
+        embedding_stats[result] += 1
+    count_question_embedding(result)
+
+
+def get_embedding_stats() -> Dict[str, int]:
+    with _embedding_stats_lock:
+        return dict(embedding_stats)
+
+
+def _skips_embedding(question : str, state : IndexState) -> bool:
+    return LEXICAL_SKIP_EMBEDDING and state.is_lexical_match(question)
+
+
 """
 Using chatgpt, provide a list of example prompts asking for help on using the veryfi-python package
 Take the first sentence of all the docstrings in the code to use as prompts. This represents what user might ask
@@ -167,30 +609,454 @@ which will become a bottleneck if the package has hundreds of methods.
 To scale this approach, the best solution is to fine-tune a custom model, and at inference time only need to 
 input the question without the need to provide any examples.
 
+In front of chatgpt there is a local gate: the question embedding is compared against the embedded samples
+(built once per index version), and only questions in the ambiguous band between INTENT_NO_THRESHOLD and
+INTENT_YES_THRESHOLD pay for the chat completion
+"""
+def is_veryfi_python_help_intent(question : str, vector : Optional[np.ndarray] = None, state : Optional[IndexState] = None) -> bool:
+    decision = _intent_gate(question, vector, state)
+    if isinstance(decision, bool):
+        return decision
+    return _is_yes(call_gpt_turbo(decision, token_len=10))
+
+
+"""
+Async variant of is_veryfi_python_help_intent, the local gate runs on the predict executor (it embeds the question)
+"""
+async def is_veryfi_python_help_intent_async(question : str, vector : Optional[np.ndarray] = None,
+                                             state : Optional[IndexState] = None) -> bool:
+    decision = await _in_executor(_intent_gate, question, vector, state)
+    if isinstance(decision, bool):
+        return decision
+    return _is_yes(await acall_gpt_turbo(decision, token_len=10))
+
+
+def _is_yes(out : Optional[str]) -> bool:
+    return bool(out and "yes" in out.lower())
+
+
+"""
+The local part of is_veryfi_python_help_intent: True or False when the gate decides, 
+else the messages to ask chatgpt with. Questions are checked against state, the default index if None
 """
-def is_veryfi_python_help_intent(question : str) -> bool:
-    def build_prompt_with_samples_for_intent_detection() -> List[dict]:
-        out = [{"role" : "system", "content" : """You are a helpful Python developer. 
-                                                Please check if the following prompt is asking for help with the veryfi-python package.
+def _intent_gate(question : str, vector : Optional[np.ndarray] = None, state : Optional[IndexState] = None) -> Union[bool, List[dict]]:
+    def build_prompt_with_samples_for_intent_detection(samples : List[str], question : str) -> List[dict]:
+        out = [{"role" : "system", "content" : f"""You are a helpful Python developer. 
+                                                Please check if the following prompt is asking for help with the {spec.title} package.
                                                 I give you a few examples.
                                                 """}]
-        # Take only the first sentence of the docstring as sample
-        with jsonlines.open(f"data/{INDEX_NAME}_doc.jsonl", "r") as reader:
-            for sample in reader:
-                docstring = sample["docstring"]
-                if docstring:
-                    first_sentence = docstring.split("\n")[0].strip()
-                    out.append({"role" : "user", "content" : first_sentence})
-                    out.append({"role" : "assistant", "content" : "yes"})
-        return out    
+        # Take only the first sentence of the docstring as sample, as many as fit in INTENT_PROMPT_TOKEN_BUDGET
+        examples = [[{"role" : "user", "content" : first_sentence}, {"role" : "assistant", "content" : "yes"}] 
+                    for first_sentence in samples]
+        messages, tokens = fit_messages(out, examples, [{"role" : "user", "content" : question}], INTENT_PROMPT_TOKEN_BUDGET)
+        logger.debug("intent prompt: %d tokens, %d of %d samples", tokens, (len(messages) - 2) // 2, len(samples))
+        return messages
+
+    state = state or get_index_state()
+    spec : IndexSpec = registry.spec(state.index_name)
+    samples : List[str] = state.get_or_build("intent_samples", lambda: load_intent_samples(spec.name))
+    if INTENT_GATE_ENABLED:
+        # A question naming one of the functions is on topic
+        if vector is None and _skips_embedding(question, state):
+            _count_embedding("lexical")
+            _count_intent_path("lexical_yes")
+            return True
+        gate : np.ndarray = state.get_or_build("intent_gate", lambda: build_intent_gate(samples))
+        _count_embedding("embedded" if vector is None else "reused")
+        vector = embed_question(question.strip()) if vector is None else vector
+        score = score_intent(vector, gate)
+        if score >= INTENT_YES_THRESHOLD:
+            _count_intent_path("local_yes")
+            return True
+        if score <= INTENT_NO_THRESHOLD:
+            _count_intent_path("local_no")
+            return False
+    _count_intent_path("llm")
 
     instruction = \
+    f"""
+    Is this question asking for help on using the {spec.title} package?
     """
-    Is this question asking for help on using the veryfi-python package?
-    """
-    messages = build_prompt_with_samples_for_intent_detection()
-    messages.append({"role" : "user", "content" : f"{instruction}\n{question.strip()}"})
-    out = call_gpt_turbo(messages, token_len=10)
-    if out and "yes" in out.lower():
-        return True
-    return False
\ No newline at end of file
+    if INTENT_GATE_ENABLED and len(gate):
+        # The samples closest to the question are the most useful examples, they go in first
+        samples = [samples[i] for i in np.argsort(-(gate @ vector), kind="stable")]
+    return build_prompt_with_samples_for_intent_detection(samples, f"{instruction}\n{question.strip()}")
+
+
+# Index name -> its answer cache, every index has its own since an AnswerCache holds the entries of one version
+_answer_caches : Dict[str, AnswerCache] = {}
+_answer_caches_lock = threading.Lock()
+
+
+"""
+The answer cache of an index, created on first use. With ANSWER_CACHE_PATH the default index's cache is kept
+there and the others next to it, as {path without extension}_{name}{extension}
+"""
+def get_answer_cache(name : str) -> AnswerCache:
+    with _answer_caches_lock:
+        cache = _answer_caches.get(name)
+        if cache is None:
+            path = ANSWER_CACHE_PATH
+            if path and name != registry.default:
+                base, ext = os.path.splitext(path)
+                path = f"{base}_{name}{ext}"
+            cache = _answer_caches[name] = AnswerCache(max_entries=ANSWER_CACHE_SIZE, 
+                                                       ttl=ANSWER_CACHE_TTL, 
+                                                       similarity_threshold=ANSWER_CACHE_SIMILARITY, 
+                                                       path=path)
+        return cache
+
+
+def _save_answer_caches():
+    with _answer_caches_lock:
+        caches = list(_answer_caches.values())
+    for cache in caches:
+        cache.save()
+
+
+if ANSWER_CACHE_PATH:
+    atexit.register(_save_answer_caches)
+
+
+"""
+Look up a finished answer for the question in the cache of state's index, to its version, exact match first then by embedding
+
+Returns (answer, question embedding). The embedding is None on an exact hit, when neither the cache
+nor the intent gate needs it, or when the question names a function (see LEXICAL_SKIP_EMBEDDING),
+otherwise it is passed on to the intent gate and retrieval so the question is embedded once (vector if it already was).
+Without use_cache (a follow up) the cache is skipped, the embedding is still made for the intent gate
+"""
+def _lookup_cached_answer(question : str, state : IndexState, timings : Dict[str, float], use_cache : bool = True,
+                          vector : Optional[np.ndarray] = None) -> Tuple[Optional[str], Optional[np.ndarray]]:
+    version = state.version
+    answer_cache = get_answer_cache(state.index_name)
+    use_cache = use_cache and ANSWER_CACHE_ENABLED
+    with span("cache", timings):
+        answer = None
+        if use_cache:
+            answer = answer_cache.get_exact(question, version)
+        if answer is None and (use_cache or INTENT_GATE_ENABLED):
+            if vector is not None:
+                _count_embedding("reused")
+            elif _skips_embedding(question, state):
+                _count_embedding("lexical")
+            else:
+                _count_embedding("embedded")
+                vector = embed_question(question)
+            if use_cache and vector is not None:
+                answer = answer_cache.get_similar(vector, version)
+    return answer, vector
+
+
+def _store_answer(question : str, answer : Optional[str], state : IndexState, vector : Optional[np.ndarray], use_cache : bool = True):
+    if use_cache and ANSWER_CACHE_ENABLED and answer:
+        get_answer_cache(state.index_name).put(question, answer, state.version, vector)
+
+
+"""
+Keep question and its answer in the conversation it was asked in (if any), as text. Off topic and unanswered questions aren't
+"""
+def _remember(conversation : Optional[Conversation], question : str, answer : Optional[str]):
+    if conversation is not None and answer:
+        conversation.add(question, unparse_codeblock(answer))
+
+
+def _timed_intent(question : str, vector : Optional[np.ndarray], timings : Dict[str, float], state : IndexState) -> bool:
+    with span("intent", timings):
+        out = is_veryfi_python_help_intent(question, vector, state)
+    annotate(is_intent=out)
+    return out
+
+
+async def _timed_intent_async(question : str, vector : Optional[np.ndarray], timings : Dict[str, float], state : IndexState) -> bool:
+    with span("intent", timings):
+        out = await is_veryfi_python_help_intent_async(question, vector, state)
+    annotate(is_intent=out)
+    return out
+
+
+"""
+The state of the index question goes to (see route_question), noted in the request's log line
+"""
+def _question_state(question : str, index : Optional[str] = None) -> IndexState:
+    state = get_index_state(route_question(question, index))
+    annotate(index=state.index_name)
+    return state
+
+
+
+
+"""
+Whether question depends on the earlier turns of conversation: it refers back to them (see refers_back), or it is
+too short to stand on its own ("with a url") and doesn't clearly match state's index by itself, by naming a function
+or by an embedding at INTENT_YES_THRESHOLD of a docstring. Returns it with the question embedding, if one was made
+"""
+def _is_follow_up(question : str, conversation : Optional[Conversation], state : IndexState) -> Tuple[bool, Optional[np.ndarray]]:
+    if not conversation:
+        return False, None
+    if refers_back(question):
+        return True, None
+    if len(question.split()) > CONVERSATION_FOLLOW_UP_WORDS or state.is_lexical_match(question):
+        return False, None
+    _count_embedding("embedded")
+    vector = embed_question(question)
+    samples : List[str] = state.get_or_build("intent_samples", lambda: load_intent_samples(state.index_name))
+    gate : np.ndarray = state.get_or_build("intent_gate", lambda: build_intent_gate(samples))
+    return score_intent(vector, gate) < INTENT_YES_THRESHOLD, vector
+
+
+"""
+A question on its way through answer_question or one of its variants, what they share before and after chatgpt.
+Made by _prepare_answer, closed by _finish_answer. answer is the cached answer once prepared, history the conversation
+the code suggestion is given (None unless the question is a follow up)
+"""
+class _PendingAnswer:
+    def __init__(self, question : str, state : IndexState, conversation : Optional[Conversation], follow_up : bool, start : float):
+        self.question = question
+        self.state = state
+        self.conversation = conversation
+        self.follow_up = follow_up
+        self.history = conversation if follow_up else None
+        self.start = start
+        self.answer : Optional[str] = None
+        self.vector : Optional[np.ndarray] = None
+        self.intent_timings : Dict[str, float] = {}
+        self.generation_timings : Dict[str, float] = {}
+
+
+"""
+Everything before the intent check and the code suggestion: route the question, then look its answer up in the cache.
+A cached answer is already remembered in the conversation, the caller only has to return it
+"""
+def _prepare_answer(question : str, index : Optional[str], conversation : Optional[Conversation]) -> _PendingAnswer:
+    start = time.perf_counter()
+    question = question.strip()
+    state = _question_state(question, index)
+    follow_up, vector = _is_follow_up(question, conversation, state)
+    annotate(follow_up=follow_up)
+    if follow_up:
+        # Routed with the question before it. Its answer depends on the session's conversation, it isn't cached
+        state = _question_state(conversation.query(question), index)
+    pending = _PendingAnswer(question, state, conversation, follow_up, start)
+    pending.answer, pending.vector = _lookup_cached_answer(question, state, pending.intent_timings, not follow_up, vector)
+    if pending.answer is not None:
+        annotate(outcome="cached")
+        _remember(conversation, question, pending.answer)
+        pending.intent_timings["total"] = time.perf_counter() - start
+    return pending
+
+
+"""
+Everything after: cache and remember the answer, note the outcome and log the timings of the stages that ran (a discarded
+speculative generation may still be running, its stages are left out). Returns the timings, with the total
+"""
+def _finish_answer(pending : _PendingAnswer, name : str, speculative : bool, is_intent : bool, answer : Optional[str]) -> Dict[str, float]:
+    _store_answer(pending.question, answer, pending.state, pending.vector, not pending.follow_up)
+    _remember(pending.conversation, pending.question, answer)
+    annotate(outcome="off_topic" if not is_intent else "answered" if answer else "no_answer")
+    timings = {**pending.intent_timings, **(pending.generation_timings if is_intent else {}),
+               "total" : time.perf_counter() - pending.start}
+    logger.info("%s speculative=%s intent=%s timings=%s", name, speculative, is_intent,
+                {k : round(v, 3) for k, v in timings.items()})
+    return timings
+
+
+"""
+Renders buffered by a speculative stream since the last read: whether the stream is done, and the newest render
+(None if there is none yet). An error of the stream is raised here
+"""
+def _newest_render(items : list, done : object) -> Tuple[bool, Optional[str]]:
+    for item in items:
+        if isinstance(item, Exception):
+            raise item
+    renders = [item for item in items if item is not done]
+    return items[-1] is done, renders[-1] if renders else None
+
+
+"""
+Full answer flow for a chat question: intent detection, then code suggestion
+
+With speculative generation the code suggestion is started at the same time as the intent check,
+and its result is dropped if the question turns out to be off topic.
+Otherwise the code suggestion only starts once the intent check says yes
+
+Answers from the answer cache skip both stages. The question is answered from index if given (a name from the
+registry), else from the index it is routed to
+
+With a conversation (the session's, see Conversation) every answered question is remembered in it. A follow up
+(see _is_follow_up) is routed and its doc retrieved along with the question before it and answered knowing the earlier
+turns. Its intent is checked on the question alone, so an off topic follow up is still refused, and it skips the answer
+cache since its answer depends on the conversation. Any other question is answered, and cached, as if asked on its own
+
+Returns (is_intent, answer, timings), timings holds the seconds spent per stage plus the total
+"""
+@traced("answer_question")
+def answer_question(question : str, speculative : Optional[bool] = None, index : Optional[str] = None,
+                    conversation : Optional[Conversation] = None) -> Tuple[bool, Optional[str], Dict[str, float]]:
+    speculative = SPECULATIVE_GENERATION if speculative is None else speculative
+    pending = _prepare_answer(question, index, conversation)
+    if pending.answer is not None:
+        return True, pending.answer, pending.intent_timings
+
+    answer = None
+    args = (pending.question, pending.generation_timings, pending.vector, pending.state, pending.history)
+    if speculative:
+        generation = _submit(generate_code_suggestion, *args)
+        is_intent = _timed_intent(pending.question, pending.vector, pending.intent_timings, pending.state)
+        if is_intent:
+            answer = generation.result()
+    else:
+        is_intent = _timed_intent(pending.question, pending.vector, pending.intent_timings, pending.state)
+        if is_intent:
+            answer = generate_code_suggestion(*args)
+    return is_intent, answer, _finish_answer(pending, "answer_question", speculative, is_intent, answer)
+
+
+"""
+Streaming variant of answer_question, yields (is_intent, answer so far)
+
+Off topic questions yield (False, None) once. With speculative generation the stream is already running
+while the intent check is, its chunks are buffered and replayed (only the latest render, since every
+render contains the whole answer so far) once the intent check says yes. If it says no the stream is abandoned
+"""
+@traced("answer_question_stream")
+def answer_question_stream(question : str, speculative : Optional[bool] = None, index : Optional[str] = None,
+                           conversation : Optional[Conversation] = None) -> Iterator[Tuple[bool, Optional[str]]]:
+    speculative = SPECULATIVE_GENERATION if speculative is None else speculative
+    pending = _prepare_answer(question, index, conversation)
+    if pending.answer is not None:
+        yield True, pending.answer
+        return
+
+    answer = None
+    args = (pending.question, pending.generation_timings, pending.vector, pending.state, pending.history)
+    if speculative:
+        renders : queue.Queue = queue.Queue()
+        cancelled = threading.Event()
+        done = object()
+
+        def produce():
+            try:
+                for render in generate_code_suggestion_stream(*args):
+                    if cancelled.is_set():
+                        break
+                    renders.put(render)
+            except Exception as e:
+                renders.put(e)
+            renders.put(done)
+
+        _submit(produce)
+        is_intent = _timed_intent(pending.question, pending.vector, pending.intent_timings, pending.state)
+        if not is_intent:
+            cancelled.set()
+            yield False, None
+        else:
+            finished = False
+            while not finished:
+                items = [renders.get()]
+                while not renders.empty():
+                    items.append(renders.get())
+                # Skip ahead to the newest render if the producer got ahead of us
+                finished, render = _newest_render(items, done)
+                if render is not None:
+                    answer = render
+                    yield True, answer
+    else:
+        is_intent = _timed_intent(pending.question, pending.vector, pending.intent_timings, pending.state)
+        if not is_intent:
+            yield False, None
+        else:
+            for answer in generate_code_suggestion_stream(*args):
+                yield True, answer
+    _finish_answer(pending, "answer_question_stream", speculative, is_intent, answer)
+
+
+"""
+Async variant of answer_question, for the app: while a request waits on openai it holds no thread,
+so the number of users answered at once is not capped by a thread pool
+
+A speculative generation is cancelled as soon as the question turns out to be off topic
+"""
+@traced("answer_question_async")
+async def answer_question_async(question : str, speculative : Optional[bool] = None, index : Optional[str] = None,
+                                conversation : Optional[Conversation] = None) -> Tuple[bool, Optional[str], Dict[str, float]]:
+    speculative = SPECULATIVE_GENERATION if speculative is None else speculative
+    pending = await _in_executor(_prepare_answer, question, index, conversation)
+    if pending.answer is not None:
+        return True, pending.answer, pending.intent_timings
+
+    answer = None
+    args = (pending.question, pending.generation_timings, pending.vector, pending.state, pending.history)
+    if speculative:
+        generation = asyncio.ensure_future(generate_code_suggestion_async(*args))
+        try:
+            is_intent = await _timed_intent_async(pending.question, pending.vector, pending.intent_timings, pending.state)
+        except BaseException:
+            generation.cancel()
+            raise
+        if is_intent:
+            answer = await generation
+        else:
+            generation.cancel()
+    else:
+        is_intent = await _timed_intent_async(pending.question, pending.vector, pending.intent_timings, pending.state)
+        if is_intent:
+            answer = await generate_code_suggestion_async(*args)
+    return is_intent, answer, _finish_answer(pending, "answer_question_async", speculative, is_intent, answer)
+
+
+"""
+Async variant of answer_question_stream, same (is_intent, answer so far) updates
+
+With speculative generation the stream runs in its own task while the intent check does, and is cancelled
+if the question is off topic or the caller stops reading
+"""
+@traced("answer_question_stream_async")
+async def answer_question_stream_async(question : str, speculative : Optional[bool] = None, index : Optional[str] = None,
+                                       conversation : Optional[Conversation] = None) -> AsyncIterator[Tuple[bool, Optional[str]]]:
+    speculative = SPECULATIVE_GENERATION if speculative is None else speculative
+    pending = await _in_executor(_prepare_answer, question, index, conversation)
+    if pending.answer is not None:
+        yield True, pending.answer
+        return
+
+    answer = None
+    args = (pending.question, pending.generation_timings, pending.vector, pending.state, pending.history)
+    if speculative:
+        renders : asyncio.Queue = asyncio.Queue()
+        done = object()
+
+        async def produce():
+            try:
+                async for render in generate_code_suggestion_stream_async(*args):
+                    renders.put_nowait(render)
+            except Exception as e:
+                renders.put_nowait(e)
+            renders.put_nowait(done)
+
+        producer = asyncio.ensure_future(produce())
+        try:
+            is_intent = await _timed_intent_async(pending.question, pending.vector, pending.intent_timings, pending.state)
+            if not is_intent:
+                yield False, None
+            else:
+                finished = False
+                while not finished:
+                    items = [await renders.get()]
+                    while not renders.empty():
+                        items.append(renders.get_nowait())
+                    # Skip ahead to the newest render if the producer got ahead of us
+                    finished, render = _newest_render(items, done)
+                    if render is not None:
+                        answer = render
+                        yield True, answer
+        finally:
+            producer.cancel()
+    else:
+        is_intent = await _timed_intent_async(pending.question, pending.vector, pending.intent_timings, pending.state)
+        if not is_intent:
+            yield False, None
+        else:
+            async for answer in generate_code_suggestion_stream_async(*args):
+                yield True, answer
+    _finish_answer(pending, "answer_question_stream_async", speculative, is_intent, answer)
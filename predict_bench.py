@@ -0,0 +1,267 @@
+import os
+import sys
+import json
+import time
+import shutil
+import asyncio
+import argparse
+import tempfile
+import functools
+import threading
+import subprocess
+import jsonlines
+from collections import defaultdict
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+from typing import List, Dict, Callable, Optional
+from fake_openai import FakeOpenAIServer
+
+
+"""
+End to end latency benchmark of the bot, offline: chat completions and embeddings are answered by the local
+openai stand-in (fake_openai) and the source file by a local file server, with configurable latencies
+
+Usage:
+    python predict_bench.py [--iterations 20] [--chat-latency 0.3] [--chunk-latency 0.01] [--embedding-latency 0.05]
+                            [--output bench_results/predict_bench_<commit>.json] [--compare earlier.json]
+
+Benchmarks, with p50/p95/p99 in ms of every stage and of the total:
+    update_index                   cold (empty index directory, everything embedded) and warm (source unchanged)
+    is_veryfi_python_help_intent   through the local gate, and through chatgpt with the gate off
+    generate_code_suggestion       retrieval, generation, render
+    answer_question                cache, intent, retrieval, generation, render
+    answer_question.followup       same, every question a follow up in one conversation (prompt tokens per turn printed)
+    app.bot                        first update and total, streamed through the async path like the app serves it
+
+The source is rebuilt from data/veryfi_python_client_doc.jsonl. Everything runs in a temporary directory, so
+the app's index and data/ are never touched. Every benchmark is called once untimed first, which builds what
+is cached per index version (intent gate, code suggestion samples). The answer cache is off, and so is the
+intent gate outside of its own benchmark: the stand-in's bag of words embeddings would score every question
+off topic, chatgpt (the stand-in) says yes to every question instead
+
+Results are written as json together with the commit and the settings, --compare prints how every p50 and p95
+moved against an earlier results file
+"""
+QUESTIONS = [
+    "use veryfi-python package to delete document",
+    "process document with url and extract fields",
+    "process w9 document",
+    "how do I get a list of my documents with veryfi",
+    "update the vendor of a document",
+    "add a tag to a document",
+]
+CODE_REPLY = "```python\nfrom veryfi import Client\n\nclient = Client(client_id, client_secret, username, api_key)\n" \
+             "response = client.delete_document(document_id)\n```"
+
+
+def reply(messages : List[dict]) -> str:
+    return "yes" if "Is this question asking for help" in messages[-1]["content"] else CODE_REPLY
+
+
+def percentiles(samples : List[float]) -> Dict[str, float]:
+    samples = sorted(samples)
+    at = lambda q: samples[min(int(q * len(samples)), len(samples) - 1)] * 1000
+    return {"n" : len(samples), "mean" : sum(samples) / len(samples) * 1000, "p50" : at(0.5), "p95" : at(0.95), "p99" : at(0.99)}
+
+
+"""
+Percentiles of every stage over the runs, runs are timings dicts in seconds
+"""
+def summarize(runs : List[Dict[str, float]]) -> Dict[str, Dict[str, float]]:
+    stages : Dict[str, List[float]] = defaultdict(list)
+    for timings in runs:
+        for stage, seconds in timings.items():
+            stages[stage].append(seconds)
+    return {stage : percentiles(samples) for stage, samples in stages.items()}
+
+
+def repeat(iterations : int, run : Callable[[int], Dict[str, float]]) -> Dict[str, Dict[str, float]]:
+    run(-1)
+    return summarize([run(i) for i in range(iterations)])
+
+
+def timed(fn : Callable, *args) -> Dict[str, float]:
+    start = time.perf_counter()
+    fn(*args)
+    return {"total" : time.perf_counter() - start}
+
+
+"""
+A python module with the functions and docstrings of the docs jsonl, methods (Class.name) in their class
+"""
+def build_source(docs_path : str) -> str:
+    classes : Dict[str, List[str]] = defaultdict(list)
+    with jsonlines.open(docs_path, "r") as reader:
+        for doc in reader:
+            owner = doc["name"].rsplit(".", 1)[0] if "." in doc["name"] else ""
+            indent = "    " if owner else ""
+            body = f"{indent}    {doc['docstring']!r}\n" if doc["docstring"] else ""
+            classes[owner].append(f"{indent}{doc['definition']}\n{body}{indent}    pass\n")
+    lines = list(classes.pop("", []))
+    for owner, methods in classes.items():
+        lines.append(f"class {owner}:\n" + "\n".join(methods))
+    return "\n\n".join(lines)
+
+
+class QuietHandler(SimpleHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+
+def get_commit() -> Optional[str]:
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True).stdout.strip()
+        dirty = subprocess.run(["git", "status", "--porcelain", "--untracked-files=no"], capture_output=True, text=True).stdout.strip()
+        return commit + ("-dirty" if dirty else "")
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(previous : dict, results : dict):
+    print(f"compared to {previous.get('commit')}:")
+    for name, stages in results["benchmarks"].items():
+        for stage, stats in stages.items():
+            before = previous["benchmarks"].get(name, {}).get(stage)
+            if not before:
+                continue
+            changes = "  ".join(f"{key} {before[key]:8.1f} -> {stats[key]:8.1f}ms ({(stats[key] / before[key] - 1) * 100 if before[key] else 0.:+6.1f}%)"
+                                for key in ("p50", "p95"))
+            print(f"    {name:<26} {stage:<12} {changes}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--iterations", type=int, default=20)
+    parser.add_argument("--cold-iterations", type=int, default=3, help="update_index runs from an empty index")
+    parser.add_argument("--chat-latency", type=float, default=0.3, help="seconds before a completion starts")
+    parser.add_argument("--chunk-latency", type=float, default=0.01, help="seconds between streamed chunks")
+    parser.add_argument("--embedding-latency", type=float, default=0.05)
+    parser.add_argument("--output", default=None)
+    parser.add_argument("--compare", default=None)
+    args = parser.parse_args()
+
+    commit = get_commit()
+    output = os.path.abspath(args.output or os.path.join("bench_results", f"predict_bench_{commit or 'unknown'}.json"))
+    previous = None
+    if args.compare:
+        with open(args.compare) as f:
+            previous = json.load(f)
+
+    data = os.path.abspath("data")
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    workdir = tempfile.mkdtemp(prefix="predict_bench")
+    os.chdir(workdir)
+    shutil.copytree(data, "data")
+    os.makedirs("source")
+    with open(os.path.join("source", "client.py"), "w") as f:
+        f.write(build_source(os.path.join("data", "veryfi_python_client_doc.jsonl")))
+    os.environ.setdefault("OPENAI_API_KEY", "test")
+    os.environ["INDEX_WARMUP"] = "lazy"
+    os.environ["ANSWER_CACHE_ENABLED"] = "0"
+    # The stand-in has no rate limits, the scheduler would only hold back the later benchmarks at the real account's
+    for limit in ["OPENAI_CHAT_RPM", "OPENAI_CHAT_TPM", "OPENAI_EMBEDDING_RPM", "OPENAI_EMBEDDING_TPM"]:
+        os.environ.setdefault(limit, "0")
+
+    file_server = ThreadingHTTPServer(("127.0.0.1", 0), functools.partial(QuietHandler, directory=os.path.abspath("source")))
+    threading.Thread(target=file_server.serve_forever, daemon=True).start()
+    server = FakeOpenAIServer(reply=reply, chunk_size=4, latency=args.chat_latency, chunk_latency=args.chunk_latency,
+                              embedding_latency=args.embedding_latency).start()
+    import openai
+    openai.api_base, openai.api_key = server.api_base, os.environ["OPENAI_API_KEY"]
+
+    import predict
+    from indexing import set_embeddings, get_index_directory
+    from llm import close_aiosession
+    from conversation import Conversation
+    from prompt_budget import count_message_tokens
+    set_embeddings(server.embeddings())
+    predict.registry.spec().sources = [f"http://127.0.0.1:{file_server.server_address[1]}/client.py"]
+    predict.INTENT_GATE_ENABLED = False
+    question = lambda i: QUESTIONS[i % len(QUESTIONS)]
+    benchmarks : Dict[str, Dict[str, Dict[str, float]]] = {}
+
+    def update_index_cold(i : int) -> Dict[str, float]:
+        shutil.rmtree(get_index_directory(predict.INDEX_NAME), ignore_errors=True)
+        predict.registry.evict(predict.INDEX_NAME)
+        return predict.update_index()["timings"]
+
+    benchmarks["update_index.cold"] = summarize([update_index_cold(i) for i in range(args.cold_iterations)])
+    benchmarks["update_index.warm"] = repeat(args.iterations, lambda i: predict.update_index()["timings"])
+
+    predict.INTENT_GATE_ENABLED = True
+    gate_stats = predict.get_intent_gate_stats()
+    benchmarks["intent.gate"] = repeat(args.iterations, lambda i: timed(predict.is_veryfi_python_help_intent, question(i)))
+    gate_paths = {path : count - gate_stats.get(path, 0) for path, count in predict.get_intent_gate_stats().items()}
+    predict.INTENT_GATE_ENABLED = False
+    benchmarks["intent.llm"] = repeat(args.iterations, lambda i: timed(predict.is_veryfi_python_help_intent, question(i)))
+
+    def code_suggestion(i : int) -> Dict[str, float]:
+        timings : Dict[str, float] = {}
+        start = time.perf_counter()
+        predict.generate_code_suggestion(question(i), timings)
+        return {**timings, "total" : time.perf_counter() - start}
+
+    benchmarks["generate_code_suggestion"] = repeat(args.iterations, code_suggestion)
+    benchmarks["answer_question"] = repeat(args.iterations, lambda i: predict.answer_question(question(i))[2])
+
+    # Should stay flat as the conversation gets longer, see Conversation.messages
+    conversation = Conversation()
+    conversation_tokens : List[int] = []
+
+    def follow_up(i : int) -> Dict[str, float]:
+        # Refers back to the turn before it, a question that stands on its own is answered without the earlier turns
+        timings = predict.answer_question(f"{question(i)}, the same way as above", conversation=conversation)[2]
+        code_prompts = [body["messages"] for path, body in server.requests 
+                        if path.endswith("/chat/completions") and "Is this question asking for help" not in body["messages"][-1]["content"]]
+        conversation_tokens.append(count_message_tokens(code_prompts[-1]))
+        return timings
+
+    benchmarks["answer_question.followup"] = repeat(args.iterations, follow_up)
+
+    import app
+
+    async def bot(iterations : int) -> List[Dict[str, float]]:
+        runs = []
+        try:
+            for i in range(-1, iterations):
+                start = time.perf_counter()
+                timings : Dict[str, float] = {}
+                async for history in app.bot([[question(i), None]]):
+                    timings.setdefault("first_update", time.perf_counter() - start)
+                timings["total"] = time.perf_counter() - start
+                if i >= 0:
+                    runs.append(timings)
+        finally:
+            await close_aiosession()
+        return runs
+
+    benchmarks["app.bot"] = summarize(asyncio.run(bot(args.iterations)))
+    server.stop()
+    file_server.shutdown()
+    shutil.rmtree(workdir, ignore_errors=True)
+
+    results = {
+        "commit" : commit,
+        "timestamp" : time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "settings" : {**vars(args), "stream_responses" : app.STREAM_RESPONSES, "speculative" : predict.SPECULATIVE_GENERATION,
+                      "vector_store" : os.environ.get("VECTOR_STORE", "chroma"), "hybrid_search" : os.environ.get("HYBRID_SEARCH", "1")},
+        "intent_gate_paths" : gate_paths,
+        "question_embeddings" : predict.get_embedding_stats(),
+        "conversation_prompt_tokens" : conversation_tokens,
+        "benchmarks" : benchmarks,
+    }
+    os.makedirs(os.path.dirname(output), exist_ok=True)
+    with open(output, "w") as f:
+        json.dump(results, f, indent=2)
+
+    print(f"chat {args.chat_latency * 1000:.0f}ms + {args.chunk_latency * 1000:.0f}ms/chunk, "
+          f"embeddings {args.embedding_latency * 1000:.0f}ms, {args.iterations} iterations")
+    print(f"    {'benchmark':<26} {'stage':<12} {'p50':>9} {'p95':>9} {'p99':>9}")
+    for name, stages in benchmarks.items():
+        for stage, stats in stages.items():
+            print(f"    {name:<26} {stage:<12} {stats['p50']:7.1f}ms {stats['p95']:7.1f}ms {stats['p99']:7.1f}ms")
+    print(f"intent gate paths (warm up call included): {gate_paths}")
+    print(f"question embeddings (embedded, reused, or skipped for a lexical match): {predict.get_embedding_stats()}")
+    print(f"code prompt tokens by conversation turn: {conversation_tokens}")
+    print(f"written to {output}")
+    if previous:
+        compare(previous, results)
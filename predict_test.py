@@ -0,0 +1,443 @@
+import os
+import time
+import random
+import shutil
+import asyncio
+import tempfile
+import functools
+import threading
+import unittest
+import numpy as np
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+from typing import List
+import openai
+import indexing
+import llm
+import predict
+import vectorstore_test
+from fake_openai import FakeOpenAIServer
+from indexing import IndexState, build_index_db, get_index_db, set_embeddings, to_document
+from llm import close_aiosession
+from preprocess import FunctionDoc
+from conversation import Conversation
+from resilience import CircuitBreaker
+from scheduler import RateLimitScheduler
+
+
+SOURCE = '''
+class Client:
+    def process_document(self, file_path, categories=None):
+        """
+        Process a document from a file and extract all the fields from it
+        """
+        pass
+
+    def process_document_url(self, file_url, external_id=None):
+        """
+        Process a document from a url and extract all the fields from it
+        """
+        pass
+
+    def delete_document(self, document_id):
+        """
+        Delete a document from the inbox
+        """
+        pass
+
+    def get_documents(self):
+        """
+        Get the list of all the documents in the inbox
+        """
+        pass
+'''
+CODE_REPLY = "Here you go:\n```python\nclient = Client(client_id, client_secret, username, api_key)\n" \
+             "if a < b:\n    client.delete_document(document_id)\n```\nDone"
+
+
+class QuietHandler(SimpleHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+
+"""
+predict end to end, offline: chat completions from the local openai stand-in, bag of words embeddings and
+the source served from a temporary directory. The default index is built from SOURCE on first use
+"""
+class TestPredict(unittest.TestCase):
+
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.tmp = tempfile.mkdtemp()
+        os.chdir(self.tmp)
+        os.makedirs("source")
+        os.makedirs("data")
+        with open(os.path.join("source", "client.py"), "w") as f:
+            f.write(SOURCE)
+        self.file_server = ThreadingHTTPServer(("127.0.0.1", 0), functools.partial(QuietHandler, directory=os.path.abspath("source")))
+        threading.Thread(target=self.file_server.serve_forever, daemon=True).start()
+
+        self.intent_reply = "yes"
+        self.code_delay = 0.
+        self.server = FakeOpenAIServer(reply=self.reply, chunk_size=5).start()
+        self.api_base, self.api_key = openai.api_base, openai.api_key
+        openai.api_base, openai.api_key = self.server.api_base, "test"
+        self.patch(llm, "chat_scheduler", RateLimitScheduler("test"))
+        self.caller = dict(vars(llm.chat_caller))
+        llm.chat_caller.breaker = CircuitBreaker(failure_threshold=5, reset_timeout=30.)
+        self.embeddings = vectorstore_test.WordEmbeddings()
+        set_embeddings(self.embeddings)
+        self.patch(indexing, "VECTOR_STORE", "numpy")
+
+        self.spec = predict.registry.spec()
+        self.patch(self.spec, "sources", [f"http://127.0.0.1:{self.file_server.server_address[1]}/client.py"])
+        self.patch(predict, "ANSWER_CACHE_ENABLED", False)
+        self.patch(predict, "INTENT_GATE_ENABLED", False)
+        self.patch(predict, "SPECULATIVE_GENERATION", False)
+        predict.registry.evict(self.spec.name)
+        predict._answer_caches.clear()
+
+    def tearDown(self):
+        predict.registry.evict(self.spec.name)
+        predict._answer_caches.clear()
+        with predict._rebuild_status_lock:
+            predict._rebuild_status[self.spec.name] = {"state" : "idle"}
+        set_embeddings(None)
+        vars(llm.chat_caller).update(self.caller)
+        openai.api_base, openai.api_key = self.api_base, self.api_key
+        self.server.stop()
+        self.file_server.shutdown()
+        self.file_server.server_close()
+        os.chdir(self.cwd)
+        shutil.rmtree(self.tmp, ignore_errors=True)
+
+    def patch(self, owner, name : str, value):
+        self.addCleanup(setattr, owner, name, getattr(owner, name))
+        setattr(owner, name, value)
+
+    def reply(self, messages : List[dict]) -> str:
+        if "Is this question asking for help" in messages[-1]["content"]:
+            return self.intent_reply
+        time.sleep(self.code_delay)
+        return CODE_REPLY
+
+    def code_prompts(self) -> List[List[dict]]:
+        return [body["messages"] for path, body in self.server.requests
+                if path.endswith("/chat/completions") and "Is this question asking for help" not in body["messages"][-1]["content"]]
+
+    def write_source(self, source : str):
+        path = os.path.join("source", "client.py")
+        mtime = os.path.getmtime(path)
+        with open(path, "w") as f:
+            f.write(source)
+        # Last-Modified has a 1s resolution, the fetch would be answered 304 within the same second
+        os.utime(path, (mtime + 10, mtime + 10))
+
+    def count_searches(self, state : IndexState) -> List[str]:
+        queries : List[str] = []
+        search = state.search
+
+        def counted(query, *args, **kwargs):
+            queries.append(query)
+            return search(query, *args, **kwargs)
+
+        state.search = counted
+        return queries
+
+    def wait_for_rebuild(self) -> dict:
+        deadline = time.time() + 10
+        while predict.get_rebuild_status()["state"] == "running" and time.time() < deadline:
+            time.sleep(0.02)
+        return predict.get_rebuild_status()
+
+
+    def test_answer_cache_per_index(self):
+        self.patch(predict, "ANSWER_CACHE_ENABLED", True)
+        python = predict.get_index_state()
+        docs = [FunctionDoc(name="Client.deleteDocument", definition="deleteDocument(documentId)", docstring="Delete a document")]
+        version, _ = build_index_db([to_document(doc) for doc in docs], "veryfi_nodejs")
+        nodejs = IndexState(get_index_db("veryfi_nodejs", version), version, "veryfi_nodejs")
+        self.assertNotEqual(python.version, nodejs.version)
+
+        predict._store_answer("delete document", "python answer", python, None)
+        predict._store_answer("delete document", "nodejs answer", nodejs, None)
+        # Questions alternating between the indexes don't clear each other's answers
+        for _ in range(2):
+            self.assertEqual(predict._lookup_cached_answer("delete document", python, {})[0], "python answer")
+            self.assertEqual(predict._lookup_cached_answer("delete document", nodejs, {})[0], "nodejs answer")
+        self.assertIsNot(predict.get_answer_cache(python.index_name), predict.get_answer_cache("veryfi_nodejs"))
+
+
+    def test_code_suggestion_samples_per_version(self):
+        state = predict.get_index_state()
+        queries = self.count_searches(state)
+        first = predict.build_code_suggestion_messages("delete document", {})
+        second = predict.build_code_suggestion_messages("get the documents", {})
+        # The 3 samples are retrieved for once, then only the question is
+        self.assertEqual(len(queries), 3 + 2)
+        self.assertEqual(first[:-1], second[:-1])
+        self.assertEqual([message["role"] for message in first], ["system"] + ["user", "assistant"] * 3 + ["user"])
+
+        # A new version is a new state, its samples are built again from its docs
+        self.write_source(SOURCE.replace("extract all the fields from it", "extract all the fields and line items from it"))
+        predict.update_index()
+        new_state = predict.get_index_state()
+        self.assertNotEqual(new_state.version, state.version)
+        new_queries = self.count_searches(new_state)
+        messages = predict.build_code_suggestion_messages("delete document", {})
+        self.assertEqual(len(new_queries), 3 + 1)
+        self.assertTrue(any("line items" in message["content"] for message in messages[1:-1]))
+        self.assertFalse(any("line items" in message["content"] for message in first))
+
+
+    def test_intent_gate(self):
+        self.patch(predict, "INTENT_GATE_ENABLED", True)
+        self.patch(predict, "LEXICAL_SKIP_EMBEDDING", False)
+        state = predict.get_index_state()
+        gate = state.get_or_build("intent_gate", lambda: predict.build_intent_gate(predict.load_intent_samples()))
+        ambiguous = "extract the fields of a receipt"
+        score = predict.score_intent(predict.embed_question(ambiguous), gate)
+        self.patch(predict, "INTENT_YES_THRESHOLD", score + 0.1)
+        self.patch(predict, "INTENT_NO_THRESHOLD", score - 0.1)
+        before = predict.get_intent_gate_stats()
+        requests = len(self.server.requests)
+
+        # A docstring sentence as is, then nothing like any
+        self.assertTrue(predict.is_veryfi_python_help_intent("Delete a document from the inbox"))
+        self.assertFalse(predict.is_veryfi_python_help_intent("what is the weather today in Paris"))
+        self.assertEqual(len(self.server.requests), requests)
+        # In between chatgpt decides, with the closest samples first
+        self.intent_reply = "no"
+        self.assertFalse(predict.is_veryfi_python_help_intent(ambiguous))
+        self.intent_reply = "yes"
+        self.assertTrue(predict.is_veryfi_python_help_intent(ambiguous))
+        prompt = self.server.requests[-1][1]["messages"]
+        samples = predict.load_intent_samples()
+        closest = samples[int(np.argmax(gate @ predict.embed_question(ambiguous)))]
+        self.assertEqual(prompt[1]["content"], closest)
+        self.assertTrue(prompt[-1]["content"].endswith(ambiguous))
+
+        # Naming a function needs no embedding
+        self.patch(predict, "LEXICAL_SKIP_EMBEDDING", True)
+        self.assertTrue(predict.is_veryfi_python_help_intent("how do I use delete_document"))
+        after = predict.get_intent_gate_stats()
+        self.assertEqual({path : count - before.get(path, 0) for path, count in after.items()},
+                         {"local_yes" : 1, "local_no" : 1, "llm" : 2, "lexical_yes" : 1})
+
+
+    def test_intent_thresholds(self):
+        predict.check_intent_thresholds(predict.INTENT_YES_THRESHOLD, predict.INTENT_NO_THRESHOLD)
+        for yes, no in [(0.8, 0.8), (0.75, 0.85)]:
+            with self.assertRaises(ValueError):
+                predict.check_intent_thresholds(yes, no)
+
+
+    def test_intent_gate_sdk_sounding(self):
+        # Close to a docstring but about gmail: above 0.9 yet not a local yes, chatgpt decides
+        self.patch(predict, "INTENT_GATE_ENABLED", True)
+        self.patch(predict, "LEXICAL_SKIP_EMBEDDING", False)
+        question = "delete a document from the gmail inbox"
+        state = predict.get_index_state()
+        gate = state.get_or_build("intent_gate", lambda: predict.build_intent_gate(predict.load_intent_samples()))
+        self.assertGreater(predict.score_intent(predict.embed_question(question), gate), 0.9)
+        before = predict.get_intent_gate_stats()
+        self.intent_reply = "no"
+        self.assertFalse(predict.is_veryfi_python_help_intent(question))
+        after = predict.get_intent_gate_stats()
+        self.assertEqual({path : count - before.get(path, 0) for path, count in after.items() if count != before.get(path, 0)},
+                         {"llm" : 1})
+
+
+    def test_speculative_off_topic(self):
+        self.patch(predict, "ANSWER_CACHE_ENABLED", True)
+        self.intent_reply = "no"
+        self.code_delay = 1.
+
+        async def ask():
+            try:
+                return await predict.answer_question_async("what is the weather today", speculative=True)
+            finally:
+                await close_aiosession()
+
+        # The generation already started is dropped (cancelled on the async path), not waited for
+        for answer in [lambda: predict.answer_question("what is the weather today", speculative=True), lambda: asyncio.run(ask())]:
+            start = time.perf_counter()
+            is_intent, out, timings = answer()
+            self.assertLess(time.perf_counter() - start, 0.8)
+            self.assertEqual((is_intent, out), (False, None))
+            self.assertNotIn("generation", timings)
+        # Nor is its answer cached once it finishes
+        time.sleep(1.2)
+        self.intent_reply = "yes"
+        self.code_delay = 0.
+        requests = len(self.code_prompts())
+        self.assertTrue(predict.answer_question("what is the weather today", speculative=False)[1])
+        self.assertEqual(len(self.code_prompts()), requests + 1)
+
+
+    def test_speculative_same_answer(self):
+        async def ask(question, speculative):
+            try:
+                return await predict.answer_question_async(question, speculative=speculative)
+            finally:
+                await close_aiosession()
+
+        for question in ["delete document", "process a document from a url"]:
+            answers = [predict.answer_question(question, speculative=speculative)[:2] for speculative in (True, False)] + \
+                      [asyncio.run(ask(question, speculative))[:2] for speculative in (True, False)]
+            self.assertEqual(answers, [(True, predict.parse_codeblock(CODE_REPLY))] * 4)
+
+
+    def test_stream(self):
+        # Spaced out, so the speculative path has no newer render to skip ahead to
+        self.server.chunk_latency = 0.01
+        expected = predict.parse_codeblock(CODE_REPLY)
+        self.assertEqual(predict.answer_question("delete document")[1], expected)
+
+        async def ask():
+            try:
+                return [update async for update in predict.answer_question_stream_async("delete document")]
+            finally:
+                await close_aiosession()
+
+        for speculative in (True, False):
+            for updates in [list(predict.answer_question_stream("delete document", speculative=speculative)), asyncio.run(ask())]:
+                # Chunk by chunk (the stand-in sends 5 characters at a time), growing up to the whole answer
+                self.assertGreater(len(updates), 5)
+                self.assertTrue(all(is_intent for is_intent, _ in updates))
+                sizes = [len(render) for _, render in updates]
+                self.assertEqual(sizes, sorted(sizes))
+                self.assertEqual(updates[-1][1], expected)
+
+
+    def test_rebuild_coalesced(self):
+        old = predict.get_index_state()
+        self.write_source(SOURCE.replace("from the inbox", "from the inbox for good"))
+        # Held up while the lock is taken, like a rebuild that takes a while
+        with predict._rebuild_locks[self.spec.name]:
+            first = predict.request_index_rebuild()
+            second = predict.request_index_rebuild()
+            self.assertEqual((first["state"], first["coalesced"]), ("running", 0))
+            self.assertEqual((second["state"], second["coalesced"]), ("running", 1))
+            self.assertIs(predict.get_index_state(), old)
+        status = self.wait_for_rebuild()
+        self.assertEqual((status["state"], status["coalesced"]), ("done", 1))
+        # Swapped in the registry, questions are answered from the new version now
+        new = predict.registry.peek(self.spec.name)
+        self.assertIsNot(new, old)
+        self.assertEqual(status["current_version"], new.version)
+        self.assertEqual(status["result"]["version"], new.version)
+        self.assertEqual(indexing.get_current_version(self.spec.name), new.version)
+        self.assertIn("for good", new.search("delete document")[0][0][0].page_content)
+
+
+    def test_rebuild_failed_validation(self):
+        old = predict.get_index_state()
+        self.write_source(SOURCE.replace("from the inbox", "from the inbox for good"))
+        self.patch(predict, "validate_index_db", lambda vectordb, expected: False)
+        with self.assertRaises(RuntimeError):
+            predict.update_index()
+        predict.request_index_rebuild()
+        status = self.wait_for_rebuild()
+        self.assertEqual(status["state"], "failed")
+        self.assertIn("failed validation", status["error"])
+        # Still serving the old version, from the registry and on disk
+        self.assertIs(predict.get_index_state(), old)
+        self.assertEqual(status["current_version"], old.version)
+        self.assertEqual(indexing.get_current_version(self.spec.name), old.version)
+        predict.registry.evict(self.spec.name)
+        self.assertEqual(predict.get_index_state().version, old.version)
+
+
+    def test_off_topic_follow_up(self):
+        self.patch(predict, "INTENT_GATE_ENABLED", True)
+        self.intent_reply = "no"
+        conversation = Conversation()
+        is_intent, answer, _ = predict.answer_question("delete document", conversation=conversation)
+        self.assertTrue(is_intent)
+        self.assertEqual(predict.unparse_codeblock(answer), CODE_REPLY)
+        # Checked on its own, not with "delete document" before it
+        is_intent, answer, _ = predict.answer_question("what is the weather today in Paris", conversation=conversation)
+        self.assertFalse(is_intent)
+        self.assertIsNone(answer)
+        self.assertEqual(len(self.code_prompts()), 1)
+        self.assertEqual([turn.question for turn in conversation.turns], ["delete document"])
+
+        # An on topic follow up is answered knowing the earlier turn. Asked to chatgpt, the bag of words gate
+        # can't tell it is about the sdk
+        self.patch(predict, "INTENT_GATE_ENABLED", False)
+        self.intent_reply = "yes"
+        is_intent, answer, _ = predict.answer_question("now do the same with a url", conversation=conversation)
+        self.assertTrue(is_intent)
+        prompt = self.code_prompts()[-1]
+        self.assertEqual(prompt[-3:-1], [{"role" : "user", "content" : "delete document"}, {"role" : "assistant", "content" : CODE_REPLY}])
+        self.assertTrue(prompt[-1]["content"].endswith("now do the same with a url"))
+
+
+    def test_follow_ups_skip_answer_cache(self):
+        self.patch(predict, "ANSWER_CACHE_ENABLED", True)
+        conversation = Conversation()
+        predict.answer_question("delete document", conversation=conversation)
+        predict.answer_question("now do it with a url", conversation=conversation)
+        self.assertEqual(len(self.code_prompts()), 2)
+        # The follow up's answer depends on the question before it, it wasn't cached
+        predict.answer_question("now do it with a url")
+        self.assertEqual(len(self.code_prompts()), 3)
+        # Nor is a follow up looked up, asked again with history it is answered again
+        predict.answer_question("now do it with a url", conversation=conversation)
+        self.assertEqual(len(self.code_prompts()), 4)
+        # Too short to stand on its own and nothing like a function: a follow up, answered knowing the earlier turns
+        predict.answer_question("with a url", conversation=conversation)
+        self.assertEqual(len(self.code_prompts()), 5)
+        self.assertIn({"role" : "user", "content" : "now do it with a url"}, self.code_prompts()[-1])
+
+
+    def test_unrelated_questions_in_conversation(self):
+        self.patch(predict, "ANSWER_CACHE_ENABLED", True)
+        for question in ["delete document", "get the documents"]:
+            predict.answer_question(question)
+        self.assertEqual(len(self.code_prompts()), 2)
+        # Each stands on its own: both come from the cache, and are remembered for the questions after them
+        conversation = Conversation()
+        for question in ["delete document", "get the documents"]:
+            is_intent, answer, timings = predict.answer_question(question, conversation=conversation)
+            self.assertEqual((is_intent, predict.unparse_codeblock(answer)), (True, CODE_REPLY))
+            self.assertNotIn("generation", timings)
+        self.assertEqual(len(self.code_prompts()), 2)
+        self.assertEqual([turn.question for turn in conversation.turns], ["delete document", "get the documents"])
+
+        # Retrieved for the question alone and answered without the earlier turns
+        self.patch(predict, "ANSWER_CACHE_ENABLED", False)
+        queries = self.count_searches(predict.get_index_state())
+        predict.answer_question("process a document from a url", conversation=conversation)
+        self.assertEqual(queries, ["process a document from a url"])
+        contents = [message["content"] for message in self.code_prompts()[-1]]
+        self.assertNotIn("get the documents", contents)
+        self.assertIn("Process a document from a url", contents[-1])
+        self.assertEqual(len(conversation), 3)
+
+
+
+class TestCodeblockStreamRenderer(unittest.TestCase):
+
+    def test_any_chunking(self):
+        texts = [CODE_REPLY,
+                 "\n```python\nfrom veryfi import Client\n```\n",
+                 "```py\nx = a<b>c\n```",
+                 "Two blocks:\n```python\nprint(1)\n```\nthen\n```bash\npip install veryfi\n```\nend",
+                 "no code at all\njust <text>"]
+        rng = random.Random(0)
+        for text in texts:
+            for _ in range(30):
+                cuts = sorted(rng.sample(range(1, len(text)), rng.randint(1, min(10, len(text) - 1))))
+                chunks = [text[start : end] for start, end in zip([0] + cuts, cuts + [len(text)])]
+                renderer = predict.CodeblockStreamRenderer()
+                for chunk in chunks:
+                    render = renderer.feed(chunk)
+                    # Every update is valid html: blocks closed, a fence never shown half received
+                    self.assertEqual(render.count("<pre><code"), render.count("</code></pre>"), (chunks, render))
+                    self.assertNotIn("`", render)
+                self.assertEqual(renderer.close(), predict.parse_codeblock(text.strip()), chunks)
+
+
+if __name__ == '__main__':
+    unittest.main()
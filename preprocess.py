@@ -1,3 +1,5 @@
+import os
+import re
 import ast
 from typing import List
 from typing import Optional
@@ -5,6 +7,10 @@ from pydantic import BaseModel
 import jsonlines
 
 
+# "ast" takes signatures and docstrings from node positions in one pass, "legacy" re-scans every function body
+PARSER_MODE = os.environ.get("PARSER_MODE", "ast")
+
+
 """
 Parse function arguments using ast module
 Doesn't work well enough because doesn't include type hinting info
@@ -99,12 +105,129 @@ class FunctionDoc(BaseModel):
             return f"Function name: {self.name}\nDefinition: {self.definition}"
 
 
+"""
+Maps the (lineno, col_offset) positions of ast nodes to offsets in the program string
+
+col_offset counts utf-8 bytes, only lines with non ascii characters need converting
+"""
+class SourceLocator:
+    def __init__(self, program : str):
+        self.program = program
+        # Same line endings as the python tokenizer, str.splitlines would also split on \f, \x1c, ...
+        self.line_starts = [0] + [match.end() for match in re.finditer(r"\r\n|\r|\n", program)]
+
+    def offset(self, lineno : int, col_offset : int) -> int:
+        start = self.line_starts[lineno - 1]
+        end = self.line_starts[lineno] if lineno < len(self.line_starts) else len(self.program)
+        line = self.program[start : end]
+        if not line.isascii():
+            col_offset = len(line.encode("utf-8")[:col_offset].decode("utf-8", errors="ignore"))
+        return start + col_offset
+
+
+"""
+Signature of a function straight from its node positions, from "def" (or "async def") up to its colon
+
+The colon is the first one after the last part of the signature the ast knows about (return annotation,
+arguments, defaults or type parameters). Between that point and the colon there can only be
+closing brackets, commas and comments, so the scan is short and only has to skip comments
+"""
+def parse_function_definition_from_node(node : ast.AST, locator : SourceLocator) -> Optional[str]:
+    parts = [node.returns] if node.returns else []
+    if not parts:
+        args = node.args
+        parts = args.posonlyargs + args.args + args.kwonlyargs + args.defaults + \
+                [default for default in args.kw_defaults if default is not None] + \
+                [arg for arg in (args.vararg, args.kwarg) if arg is not None] + \
+                list(getattr(node, "type_params", []))
+    start = locator.offset(node.lineno, node.col_offset)
+    if parts:
+        anchor = max(parts, key=lambda part: (part.end_lineno, part.end_col_offset))
+        scan = locator.offset(anchor.end_lineno, anchor.end_col_offset)
+    else:
+        scan = start
+    program = locator.program
+    while scan < len(program):
+        char = program[scan]
+        if char == ":":
+            return program[start : scan + 1].strip()
+        if char == "#":
+            newline = program.find("\n", scan)
+            scan = len(program) if newline == -1 else newline
+        scan += 1
+    return None
+
+
+"""
+Docstring of a function in the same format as parse_function_docstring
+"""
+def parse_function_docstring_from_node(node : ast.AST) -> Optional[str]:
+    docstring = ast.get_docstring(node, clean=False)
+    if docstring is None:
+        return None
+    return docstring.strip().replace("  ", "")
+
+
+"""
+Single pass parser: walks class and function bodies once, taking names, signatures and docstrings
+from node positions, without rebuilding any function body as a string
+
+Compared to the legacy parser:
+    - async functions are included
+    - methods of nested classes are named Outer.Inner.method
+    - definitions under if / try / with blocks keep the name of the class they are in
+    - docstrings with single quotes or escaped quotes are read correctly
+"""
+def get_docs_from_ast(program : str) -> List[FunctionDoc]:
+    tree = ast.parse(program)
+    locator = SourceLocator(program)
+    out = []
+
+    def visit(body : list, prefix : str, in_class : bool):
+        for node in body:
+            if isinstance(node, ast.ClassDef):
+                visit(node.body, f"{prefix}{node.name}.", True)
+            elif isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef)):
+                # Take init function but not private functions
+                if not in_class or "__init__" in node.name or not node.name.startswith("_"):
+                    out.append(FunctionDoc(name = f"{prefix}{node.name}",
+                                           docstring=parse_function_docstring_from_node(node),
+                                           definition=parse_function_definition_from_node(node, locator)))
+                # Functions defined inside functions, named without prefix like the legacy parser does
+                visit(node.body, "", False)
+            else:
+                # Blocks of if / try / with / for / while / match statements and their handlers / cases
+                for field in ("body", "orelse", "finalbody", "handlers", "cases"):
+                    block = getattr(node, field, None)
+                    if isinstance(block, list):
+                        visit(block, prefix, in_class)
+
+    visit(tree.body, "", False)
+    return out
+
+
+"""
+Write parsed docs to data/{title}_doc.jsonl
+"""
+def save_docs(docs : List[FunctionDoc], title : str):
+    with jsonlines.open(f"data/{title}_doc.jsonl", "w") as f:
+        for doc in docs:
+            f.write(doc.dict())
+
+
 """
 Given the whole code content, parse for classes and methods signatures and corresponding docstring
 
-Write parsed content to data/{title}_doc.jsonl
+Write parsed content to data/{title}_doc.jsonl, unless save is False
+mode is "ast" (single pass, see get_docs_from_ast) or "legacy"
 """
-def get_docs(program : str, title : str) -> List[FunctionDoc]:
+def get_docs(program : str, title : str, save : bool = True, mode : Optional[str] = None) -> List[FunctionDoc]:
+    if (mode or PARSER_MODE) == "ast":
+        out = get_docs_from_ast(program)
+        if save:
+            save_docs(out, title)
+        return out
+
     program_lines = program.split("\n")
     # Parse the program and generate its AST
     tree = ast.parse(program)
@@ -139,8 +262,7 @@ def get_docs(program : str, title : str) -> List[FunctionDoc]:
                                     definition=function_definition))
 
     # Save to file
-    with jsonlines.open(f"data/{title}_doc.jsonl", "w") as f:
-        for doc in out:
-            f.write(doc.dict())
+    if save:
+        save_docs(out, title)
 
     return out
\ No newline at end of file
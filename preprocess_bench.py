@@ -0,0 +1,67 @@
+import os
+import ast
+import sys
+import time
+import sysconfig
+import argparse
+from typing import List, Tuple
+from preprocess import get_docs
+
+
+"""
+Benchmark get_docs parser modes on a large codebase, the python standard library by default
+
+Usage:
+    python preprocess_bench.py [--path DIR] [--limit N]
+
+For every mode reports files/s, docs/s, total docs and files that raised.
+"ast.parse only" is the floor both modes share, the rest is the cost of extracting the docs.
+Files are read once up front so disk access is not part of the timings
+"""
+def load_sources(path : str, limit : int) -> List[Tuple[str, str]]:
+    sources = []
+    for root, dirs, files in os.walk(path):
+        dirs[:] = sorted(d for d in dirs if d not in ("site-packages", "__pycache__"))
+        for name in sorted(files):
+            if name.endswith(".py"):
+                file_path = os.path.join(root, name)
+                try:
+                    with open(file_path, "r", encoding="utf-8") as f:
+                        program = f.read()
+                    ast.parse(program)
+                except (SyntaxError, UnicodeDecodeError, ValueError):
+                    continue
+                sources.append((file_path, program))
+                if limit and len(sources) >= limit:
+                    return sources
+    return sources
+
+
+def run(label : str, sources : List[Tuple[str, str]], parse) -> dict:
+    docs, failures = 0, 0
+    start = time.perf_counter()
+    for _, program in sources:
+        try:
+            docs += len(parse(program))
+        except Exception:
+            failures += 1
+    elapsed = time.perf_counter() - start
+    result = {"mode" : label, "seconds" : elapsed, "files/s" : len(sources) / elapsed,
+              "docs" : docs, "docs/s" : docs / elapsed, "failures" : failures}
+    print(f"{label:<16} {elapsed:8.2f}s {result['files/s']:10.1f} files/s {docs:8d} docs {result['docs/s']:10.1f} docs/s {failures:5d} failures")
+    return result
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--path", default=sysconfig.get_paths()["stdlib"])
+    parser.add_argument("--limit", type=int, default=0)
+    args = parser.parse_args()
+
+    sources = load_sources(args.path, args.limit)
+    size = sum(len(program) for _, program in sources)
+    print(f"{len(sources)} files, {size / 1e6:.1f} MB from {args.path} (python {sys.version.split()[0]})")
+    run("ast.parse only", sources, lambda program: [ast.parse(program)])
+    legacy = run("legacy", sources, lambda program: get_docs(program, "bench", save=False, mode="legacy"))
+    fast = run("ast", sources, lambda program: get_docs(program, "bench", save=False, mode="ast"))
+    print(f"ast mode speedup: {legacy['seconds'] / fast['seconds']:.2f}x")
@@ -0,0 +1,66 @@
+import unittest
+from preprocess import get_docs
+
+
+PROGRAM = '''
+import functools
+
+
+class Client:
+    def __init__(self, client_id, base_url="https://api.veryfi.com/"):
+        pass
+
+    @functools.lru_cache()
+    def get_document(self, document_id: int,
+                     fields: str = "():") -> dict:
+        """
+        Retrieve document by ID
+        :param document_id: ID of the document you'd like to retrieve
+        """
+        return {}
+
+    def _private(self):
+        pass
+
+    def process_document_url(self, file_url=None, **kwargs):
+        """
+        Process Document from url and extract all the fields from it
+        """
+        return {}
+
+
+def top_level(a, b):
+    """Add "a" and b"""
+    return a + b
+'''
+
+
+class TestPreprocess(unittest.TestCase):
+
+    def test_ast_mode_matches_legacy(self):
+        legacy = get_docs(PROGRAM, "test", save=False, mode="legacy")
+        fast = get_docs(PROGRAM, "test", save=False, mode="ast")
+        self.assertEqual([doc.name for doc in fast], 
+                         ["Client.__init__", "Client.get_document", "Client.process_document_url", "top_level"])
+        self.assertEqual(fast, legacy)
+
+
+    def test_ast_mode_handles_async_nested_classes_and_quotes(self):
+        program = (
+            "class Outer:\n"
+            "    class Inner:\n"
+            "        async def fetch(self, url: str = \"é\") -> bytes:\n"
+            "            '''Fetch \\\"url\\\"'''\n"
+            "    def run(self  # (self): only\n"
+            "            ):  # note: runs\n"
+            "        pass\n"
+        )
+        docs = get_docs(program, "test", save=False, mode="ast")
+        self.assertEqual([doc.name for doc in docs], ["Outer.Inner.fetch", "Outer.run"])
+        self.assertEqual(docs[0].definition, 'async def fetch(self, url: str = "é") -> bytes:')
+        self.assertEqual(docs[0].docstring, 'Fetch "url"')
+        self.assertEqual(docs[1].definition, "def run(self  # (self): only\n            ):")
+
+
+if __name__ == '__main__':
+    unittest.main()
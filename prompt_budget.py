@@ -0,0 +1,108 @@
+import os
+import re
+import logging
+import threading
+from typing import List, Tuple, Optional, Any
+
+
+# Encoding of the chat model, see llm.CHAT_MODEL
+TOKEN_ENCODING = os.environ.get("TOKEN_ENCODING", "cl100k_base")
+# Context window of the chat model, prompt and completion together
+MODEL_CONTEXT_TOKENS = int(os.environ.get("MODEL_CONTEXT_TOKENS", "4096"))
+# Prompt budgets, few-shot examples are dropped to fit in them
+CODE_PROMPT_TOKEN_BUDGET = int(os.environ.get("CODE_PROMPT_TOKEN_BUDGET", "2000"))
+INTENT_PROMPT_TOKEN_BUDGET = int(os.environ.get("INTENT_PROMPT_TOKEN_BUDGET", "1000"))
+# A retrieved doc is cut to this many tokens before it goes in a prompt (Client.get_documents alone is ~700)
+DOC_TOKEN_LIMIT = int(os.environ.get("DOC_TOKEN_LIMIT", "400"))
+# Every chat message costs a few tokens on top of its content, and the reply is primed with a few more
+TOKENS_PER_MESSAGE = 3
+TOKENS_PER_REPLY = 3
+
+logger = logging.getLogger(__name__)
+_encoding : Any = None
+_encoding_loaded = False
+_encoding_lock = threading.Lock()
+# Without the encoding (tiktoken missing or no network to download it) tokens are estimated:
+# every run of up to 4 word characters and every punctuation character counts as one
+_ESTIMATE_PATTERN = re.compile(r"\w{1,4}|[^\w\s]")
+
+
+"""
+The tiktoken encoding, loaded once. None if it can't be loaded, counts are estimated then
+"""
+def get_encoding() -> Any:
+    global _encoding, _encoding_loaded
+    with _encoding_lock:
+        if not _encoding_loaded:
+            try:
+                import tiktoken
+                _encoding = tiktoken.get_encoding(TOKEN_ENCODING)
+            except Exception as e:
+                logger.warning("tiktoken encoding %s unavailable, estimating token counts: %s", TOKEN_ENCODING, e)
+                _encoding = None
+            _encoding_loaded = True
+        return _encoding
+
+
+def count_tokens(text : str) -> int:
+    encoding = get_encoding()
+    if encoding is None:
+        return len(_ESTIMATE_PATTERN.findall(text))
+    return len(encoding.encode(text, disallowed_special=()))
+
+
+"""
+Prompt tokens of a chat completion request with these messages
+"""
+def count_message_tokens(messages : List[dict]) -> int:
+    return sum(TOKENS_PER_MESSAGE + count_tokens(message["role"]) + count_tokens(message["content"])
+               for message in messages) + TOKENS_PER_REPLY
+
+
+"""
+Cut text to at most max_tokens tokens
+"""
+def truncate_tokens(text : str, max_tokens : int) -> str:
+    encoding = get_encoding()
+    if encoding is None:
+        matches = list(_ESTIMATE_PATTERN.finditer(text))
+        return text if len(matches) <= max_tokens else text[:matches[max_tokens - 1].end()] if max_tokens > 0 else ""
+    tokens = encoding.encode(text, disallowed_special=())
+    return text if len(tokens) <= max_tokens else encoding.decode(tokens[:max_tokens])
+
+
+"""
+Token count of an indexed document, precomputed in its metadata at index time (see ingest_doc_page)
+"""
+def get_doc_tokens(doc : Any) -> int:
+    tokens = (doc.metadata or {}).get("tokens")
+    return tokens if tokens is not None else count_tokens(doc.page_content)
+
+
+"""
+Retrieved doc to put in a prompt, cut to DOC_TOKEN_LIMIT tokens if it is longer
+"""
+def fit_doc(doc : Any, max_tokens : Optional[int] = None) -> str:
+    max_tokens = DOC_TOKEN_LIMIT if max_tokens is None else max_tokens
+    if get_doc_tokens(doc) <= max_tokens:
+        return doc.page_content
+    return truncate_tokens(doc.page_content, max_tokens)
+
+
+"""
+Messages head + as many few-shot examples as fit + tail, within budget prompt tokens
+
+examples are lists of messages (e.g. a user question and the assistant answer), kept whole and in order,
+the first ones being the preferred ones. head and tail are always kept, even if they alone exceed the budget.
+Returns the messages and their token count
+"""
+def fit_messages(head : List[dict], examples : List[List[dict]], tail : List[dict], budget : int) -> Tuple[List[dict], int]:
+    used = count_message_tokens(head + tail)
+    messages = list(head)
+    for example in examples:
+        cost = count_message_tokens(example) - TOKENS_PER_REPLY
+        if used + cost > budget:
+            break
+        messages.extend(example)
+        used += cost
+    return messages + tail, used
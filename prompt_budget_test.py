@@ -0,0 +1,51 @@
+import unittest
+import prompt_budget
+from langchain.schema import Document
+from prompt_budget import count_tokens, count_message_tokens, truncate_tokens, fit_doc, fit_messages
+
+
+class TestPromptBudget(unittest.TestCase):
+
+    # Counts are estimated, the tiktoken encoding can't be relied on to be downloadable where tests run
+    def setUp(self):
+        self.encoding = prompt_budget._encoding, prompt_budget._encoding_loaded
+        prompt_budget._encoding, prompt_budget._encoding_loaded = None, True
+
+    def tearDown(self):
+        prompt_budget._encoding, prompt_budget._encoding_loaded = self.encoding
+
+
+    def test_count_and_truncate(self):
+        self.assertEqual(count_tokens("def get_documents(self):"), 9)
+        self.assertEqual(truncate_tokens("def get_documents(self):", 3), "def get_docu")
+        self.assertEqual(truncate_tokens("short", 10), "short")
+        messages = [{"role" : "user", "content" : "hi"}]
+        self.assertEqual(count_message_tokens(messages), prompt_budget.TOKENS_PER_MESSAGE + 2 + prompt_budget.TOKENS_PER_REPLY)
+
+
+    def test_fit_doc(self):
+        doc = Document(page_content="word " * 100, metadata={"tokens" : 100})
+        self.assertEqual(fit_doc(doc, 200), doc.page_content)
+        self.assertEqual(count_tokens(fit_doc(doc, 10)), 10)
+        # Precomputed count is trusted over the text
+        self.assertEqual(fit_doc(Document(page_content="word " * 100, metadata={"tokens" : 5}), 10), "word " * 100)
+
+
+    def test_fit_messages(self):
+        head = [{"role" : "system", "content" : "system"}]
+        tail = [{"role" : "user", "content" : "question"}]
+        examples = [[{"role" : "user", "content" : "example " * 10}, {"role" : "assistant", "content" : "yes"}]] * 5
+        messages, tokens = fit_messages(head, examples, tail, 10_000)
+        self.assertEqual(len(messages), 12)
+        self.assertEqual(tokens, count_message_tokens(messages))
+
+        budget = count_message_tokens(head + tail + examples[0] + examples[1])
+        messages, tokens = fit_messages(head, examples, tail, budget)
+        self.assertEqual(messages, head + examples[0] + examples[1] + tail)
+        self.assertLessEqual(tokens, budget)
+        # Head and tail are kept even over budget
+        self.assertEqual(fit_messages(head, examples, tail, 0)[0], head + tail)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,293 @@
+import time
+import random
+import asyncio
+import inspect
+import threading
+import contextvars
+from concurrent.futures import ThreadPoolExecutor, Future, wait, FIRST_COMPLETED
+from typing import Callable, Awaitable, Optional, List, Any, TypeVar
+
+
+T = TypeVar("T")
+
+
+"""
+An upstream call was given up on: its circuit breaker is open, or it kept failing with transient errors
+until the retries or the deadline ran out
+"""
+class UpstreamUnavailableError(Exception):
+    pass
+
+
+class CircuitOpenError(UpstreamUnavailableError):
+    pass
+
+
+"""
+Seconds to wait before retry number attempt (from 0): "full jitter", uniform between 0 and an exponentially
+growing cap, so clients that failed together don't all come back at the same moment
+"""
+def backoff_delay(attempt : int, base : float, cap : float) -> float:
+    return random.uniform(0, min(cap, base * 2 ** attempt))
+
+
+"""
+Fails calls fast while the upstream looks unhealthy
+
+closed: calls go through, failure_threshold transient failures in a row open the breaker
+open: calls raise CircuitOpenError without being made, for reset_timeout seconds
+half_open: one trial call goes through (the others are still rejected), its success closes the breaker
+           and its failure opens it again
+
+Calls that neither succeed nor fail (cancelled, or a non transient error like a bad request) just give back
+the trial slot
+"""
+class CircuitBreaker:
+    def __init__(self, failure_threshold : int = 5, reset_timeout : float = 30., name : str = "upstream"):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.name = name
+        self._failures = 0
+        self._opened_at : Optional[float] = None
+        self._trial = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self) -> str:
+        with self._lock:
+            if self._opened_at is None:
+                return "closed"
+            return "half_open" if time.monotonic() - self._opened_at >= self.reset_timeout else "open"
+
+    def before_call(self):
+        with self._lock:
+            if self._opened_at is None:
+                return
+            retry_in = self._opened_at + self.reset_timeout - time.monotonic()
+            if retry_in > 0 or self._trial:
+                raise CircuitOpenError(f"{self.name} circuit breaker is open, " +
+                                       (f"retrying in {retry_in:.1f}s" if retry_in > 0 else "a trial call is running"))
+            self._trial = True
+
+    def record_success(self):
+        with self._lock:
+            self._failures = 0
+            self._opened_at = None
+            self._trial = False
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            if self._trial or self._failures >= self.failure_threshold:
+                self._opened_at = time.monotonic()
+            self._trial = False
+
+    def record_neutral(self):
+        with self._lock:
+            self._trial = False
+
+
+"""
+Calls fn with a deadline, retries, hedging and a circuit breaker. fn makes one attempt, it is passed the seconds
+the attempt may take (the smaller of attempt_timeout and what is left of the deadline) and is expected to
+give up by itself after them (as a request timeout)
+
+    - errors is_transient(error) says no to are raised as is, without retry
+    - transient errors are retried up to max_retries times, after backoff_delay seconds (at least what
+      retry_after(error) says, a Retry-After header), as long as the retry can start before the deadline.
+      After the last one UpstreamUnavailableError is raised, from the last error
+    - with a hedge_delay, an attempt that didn't complete after hedge_delay seconds gets a duplicate, the
+      first of the two to succeed is returned. The other is cancelled (async) or left to finish (threads),
+      either way a result it still produces is passed to discard (to close a stream)
+    - the breaker (if given) sees one trial per attempt, hedged or not
+
+on_event(event) is told about "retry", "hedge", "hedge_won", "rejected" (breaker open) and "gave_up"
+"""
+class ResilientCaller:
+    def __init__(self,
+                 is_transient : Callable[[BaseException], bool],
+                 deadline : float = 90.,
+                 attempt_timeout : float = 60.,
+                 max_retries : int = 2,
+                 backoff_base : float = 0.5,
+                 backoff_max : float = 8.,
+                 hedge_delay : float = 0.,
+                 breaker : Optional[CircuitBreaker] = None,
+                 retry_after : Optional[Callable[[BaseException], Optional[float]]] = None,
+                 on_event : Optional[Callable[[str], Any]] = None,
+                 hedge_workers : int = 32):
+        self.is_transient = is_transient
+        self.deadline = deadline
+        self.attempt_timeout = attempt_timeout
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.hedge_delay = hedge_delay
+        self.breaker = breaker
+        self.retry_after = retry_after
+        self.on_event = on_event
+        self.hedge_workers = hedge_workers
+        self._executor : Optional[ThreadPoolExecutor] = None
+        self._executor_lock = threading.Lock()
+
+    def _event(self, event : str):
+        if self.on_event is not None:
+            self.on_event(event)
+
+    def _before_attempt(self):
+        if self.breaker is not None:
+            try:
+                self.breaker.before_call()
+            except CircuitOpenError:
+                self._event("rejected")
+                raise
+
+    def _record(self, error : Optional[BaseException]):
+        if self.breaker is None:
+            return
+        if error is None:
+            self.breaker.record_success()
+        elif isinstance(error, Exception) and self.is_transient(error):
+            self.breaker.record_failure()
+        else:
+            self.breaker.record_neutral()
+
+    """
+    Seconds to wait before retrying after error, None to give up (not transient, out of retries or of time)
+    """
+    def _retry_delay(self, error : BaseException, attempt : int, deadline : float) -> Optional[float]:
+        if not isinstance(error, Exception) or not self.is_transient(error):
+            return None
+        delay = backoff_delay(attempt, self.backoff_base, self.backoff_max)
+        if self.retry_after is not None:
+            delay = max(delay, self.retry_after(error) or 0.)
+        if attempt >= self.max_retries or time.monotonic() + delay >= deadline:
+            return None
+        return delay
+
+    def _give_up(self, error : Exception, attempts : int) -> UpstreamUnavailableError:
+        self._event("gave_up")
+        return UpstreamUnavailableError(f"Gave up after {attempts} attempt(s): {type(error).__name__}: {error}")
+
+    def _hedge_executor(self) -> ThreadPoolExecutor:
+        with self._executor_lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self.hedge_workers, thread_name_prefix="hedge")
+            return self._executor
+
+    def call(self, fn : Callable[[float], T], discard : Optional[Callable[[T], Any]] = None, hedge_delay : Optional[float] = None) -> T:
+        deadline = time.monotonic() + self.deadline
+        hedge_delay = self.hedge_delay if hedge_delay is None else hedge_delay
+        attempt = 0
+        while True:
+            self._before_attempt()
+            timeout = min(self.attempt_timeout, deadline - time.monotonic())
+            try:
+                result = self._hedged(fn, timeout, discard, hedge_delay)
+            except BaseException as e:
+                self._record(e)
+                delay = self._retry_delay(e, attempt, deadline)
+                if delay is None:
+                    if isinstance(e, Exception) and self.is_transient(e):
+                        raise self._give_up(e, attempt + 1) from e
+                    raise
+                self._event("retry")
+                time.sleep(delay)
+                attempt += 1
+                continue
+            self._record(None)
+            return result
+
+    def _hedged(self, fn : Callable[[float], T], timeout : float, discard : Optional[Callable[[T], Any]], hedge_delay : float) -> T:
+        if not hedge_delay or hedge_delay >= timeout:
+            return fn(timeout)
+        executor = self._hedge_executor()
+        # Copies of the caller's context, so the attempts count towards its request
+        futures : List[Future] = [executor.submit(contextvars.copy_context().run, fn, timeout)]
+        done, _ = wait(futures, timeout=hedge_delay)
+        if not done:
+            self._event("hedge")
+            futures.append(executor.submit(contextvars.copy_context().run, fn, timeout - hedge_delay))
+        error = None
+        pending = list(futures)
+        try:
+            while pending:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in futures:
+                    if future in done and future in pending:
+                        pending.remove(future)
+                        if future.exception() is None:
+                            if future is not futures[0]:
+                                self._event("hedge_won")
+                            futures.remove(future)
+                            return future.result()
+                        error = error or future.exception()
+            raise error
+        finally:
+            for future in futures:
+                future.add_done_callback(lambda future: _discard_future(future, discard))
+
+    async def acall(self, fn : Callable[[float], Awaitable[T]], discard : Optional[Callable[[T], Any]] = None,
+                    hedge_delay : Optional[float] = None) -> T:
+        deadline = time.monotonic() + self.deadline
+        hedge_delay = self.hedge_delay if hedge_delay is None else hedge_delay
+        attempt = 0
+        while True:
+            self._before_attempt()
+            timeout = min(self.attempt_timeout, deadline - time.monotonic())
+            try:
+                result = await self._ahedged(fn, timeout, discard, hedge_delay)
+            except BaseException as e:
+                self._record(e)
+                delay = self._retry_delay(e, attempt, deadline)
+                if delay is None:
+                    if isinstance(e, Exception) and self.is_transient(e):
+                        raise self._give_up(e, attempt + 1) from e
+                    raise
+                self._event("retry")
+                await asyncio.sleep(delay)
+                attempt += 1
+                continue
+            self._record(None)
+            return result
+
+    async def _ahedged(self, fn : Callable[[float], Awaitable[T]], timeout : float, discard : Optional[Callable[[T], Any]],
+                       hedge_delay : float) -> T:
+        if not hedge_delay or hedge_delay >= timeout:
+            return await fn(timeout)
+        tasks : List[asyncio.Future] = [asyncio.ensure_future(fn(timeout))]
+        pending = list(tasks)
+        try:
+            done, _ = await asyncio.wait(tasks, timeout=hedge_delay)
+            if not done:
+                self._event("hedge")
+                tasks.append(asyncio.ensure_future(fn(timeout - hedge_delay)))
+                pending.append(tasks[-1])
+            error = None
+            while pending:
+                done, _ = await asyncio.wait(pending, return_when=FIRST_COMPLETED)
+                for task in tasks:
+                    if task in done and task in pending:
+                        pending.remove(task)
+                        if task.exception() is None:
+                            if task is not tasks[0]:
+                                self._event("hedge_won")
+                            tasks.remove(task)
+                            return task.result()
+                        error = error or task.exception()
+            raise error
+        finally:
+            for task in tasks:
+                task.cancel()
+                task.add_done_callback(lambda task: _discard_future(task, discard))
+
+
+"""
+Hand the result of a losing attempt to discard, if it has one (an async discard is scheduled on the running loop)
+"""
+def _discard_future(future : Any, discard : Optional[Callable[[Any], Any]]):
+    if discard is None or future.cancelled() or future.exception() is not None:
+        return
+    out = discard(future.result())
+    if inspect.isawaitable(out):
+        asyncio.ensure_future(out)
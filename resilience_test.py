@@ -0,0 +1,141 @@
+import time
+import asyncio
+import unittest
+from resilience import ResilientCaller, CircuitBreaker, CircuitOpenError, UpstreamUnavailableError, backoff_delay
+
+
+class Flaky(Exception):
+    pass
+
+
+class TestResilience(unittest.TestCase):
+
+    def caller(self, **kwargs) -> ResilientCaller:
+        self.events = []
+        kwargs = {"backoff_base" : 0.01, "backoff_max" : 0.01, "on_event" : self.events.append, **kwargs}
+        return ResilientCaller(lambda error: isinstance(error, Flaky), **kwargs)
+
+
+    def test_backoff_delay(self):
+        delays = [backoff_delay(attempt, 0.5, 4.) for attempt in range(10) for _ in range(20)]
+        self.assertTrue(all(0 <= delay <= 4. for delay in delays))
+        self.assertLessEqual(max(backoff_delay(0, 0.5, 4.) for _ in range(20)), 0.5)
+
+
+    def test_circuit_breaker(self):
+        breaker = CircuitBreaker(failure_threshold=2, reset_timeout=0.1)
+        breaker.before_call()
+        breaker.record_failure()
+        self.assertEqual(breaker.state, "closed")
+        breaker.record_failure()
+        self.assertEqual(breaker.state, "open")
+        with self.assertRaises(CircuitOpenError):
+            breaker.before_call()
+        time.sleep(0.1)
+        self.assertEqual(breaker.state, "half_open")
+        # One trial at a time, its failure opens the breaker again right away
+        breaker.before_call()
+        with self.assertRaises(CircuitOpenError):
+            breaker.before_call()
+        breaker.record_failure()
+        self.assertEqual(breaker.state, "open")
+        time.sleep(0.1)
+        breaker.before_call()
+        breaker.record_success()
+        self.assertEqual(breaker.state, "closed")
+
+
+    def test_retries(self):
+        attempts = []
+
+        def fn(timeout):
+            attempts.append(timeout)
+            if len(attempts) < 3:
+                raise Flaky()
+            return "ok"
+
+        self.assertEqual(self.caller(max_retries=2).call(fn), "ok")
+        self.assertEqual(self.events, ["retry", "retry"])
+
+        attempts.clear()
+        with self.assertRaises(UpstreamUnavailableError):
+            self.caller(max_retries=1).call(fn)
+        self.assertEqual(len(attempts), 2)
+        self.assertEqual(self.events[-1], "gave_up")
+
+        # Not transient
+        with self.assertRaises(ValueError):
+            self.caller().call(lambda timeout: int("x"))
+        self.assertEqual(self.events, [])
+
+
+    def test_deadline(self):
+        timeouts = []
+
+        def fn(timeout):
+            timeouts.append(timeout)
+            time.sleep(0.05)
+            raise Flaky()
+
+        with self.assertRaises(UpstreamUnavailableError):
+            self.caller(deadline=0.12, attempt_timeout=1., max_retries=10).call(fn)
+        self.assertLess(len(timeouts), 4)
+        self.assertLessEqual(timeouts[0], 0.12)
+        self.assertLess(timeouts[-1], timeouts[0])
+
+
+    def test_hedge(self):
+        discarded = []
+        calls = []
+
+        def fn(timeout):
+            calls.append(timeout)
+            if len(calls) == 1:
+                time.sleep(0.3)
+                return "slow"
+            return "fast"
+
+        start = time.perf_counter()
+        self.assertEqual(self.caller(hedge_delay=0.05).call(fn, discard=discarded.append), "fast")
+        self.assertLess(time.perf_counter() - start, 0.3)
+        self.assertEqual(self.events, ["hedge", "hedge_won"])
+        time.sleep(0.35)
+        self.assertEqual(discarded, ["slow"])
+
+
+    def test_hedge_async(self):
+        calls = []
+
+        async def fn(timeout):
+            calls.append(timeout)
+            await asyncio.sleep(1. if len(calls) == 1 else 0.)
+            return len(calls)
+
+        async def run():
+            caller = self.caller(hedge_delay=0.05)
+            out = await caller.acall(fn)
+            # Answers before the hedge delay, no duplicate
+            calls.append(None)
+            return out, await caller.acall(fn)
+
+        start = time.perf_counter()
+        self.assertEqual(asyncio.run(run()), (2, 4))
+        self.assertLess(time.perf_counter() - start, 1.)
+        self.assertEqual(self.events, ["hedge", "hedge_won"])
+
+
+    def test_breaker_rejects(self):
+        breaker = CircuitBreaker(failure_threshold=1, reset_timeout=10.)
+        caller = self.caller(max_retries=3, breaker=breaker)
+
+        def fn(timeout):
+            raise Flaky()
+
+        # The retry is rejected by the breaker the first failure opened
+        with self.assertRaises(CircuitOpenError):
+            caller.call(fn)
+        self.assertEqual(self.events, ["retry", "rejected"])
+
+
+if __name__ == '__main__':
+    unittest.main()
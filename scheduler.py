@@ -0,0 +1,242 @@
+import os
+import time
+import heapq
+import asyncio
+import itertools
+import threading
+import contextvars
+from contextlib import contextmanager
+from concurrent import futures
+from concurrent.futures import Future
+from typing import Dict, List, Tuple, Optional, Iterator
+from resilience import UpstreamUnavailableError
+from metrics import record_scheduler_wait, count_scheduler_event
+
+
+# Priority classes, lower goes first: questions being answered, then index rebuilds
+INTERACTIVE = 0
+BACKGROUND = 1
+PRIORITY_NAMES = {INTERACTIVE : "interactive", BACKGROUND : "background"}
+
+# Limits of the openai account per minute, requests and tokens, 0 is no limit. Defaults are openai's pay as you go
+# limits for gpt-3.5-turbo and text-embedding-ada-002
+OPENAI_CHAT_RPM = int(os.environ.get("OPENAI_CHAT_RPM", "3500"))
+OPENAI_CHAT_TPM = int(os.environ.get("OPENAI_CHAT_TPM", "90000"))
+OPENAI_EMBEDDING_RPM = int(os.environ.get("OPENAI_EMBEDDING_RPM", "3000"))
+OPENAI_EMBEDDING_TPM = int(os.environ.get("OPENAI_EMBEDDING_TPM", "1000000"))
+# Share of the limits background work leaves for questions, a rebuild can't use it up
+OPENAI_INTERACTIVE_RESERVE = float(os.environ.get("OPENAI_INTERACTIVE_RESERVE", "0.2"))
+# Requests waiting for their turn per priority class before new ones are shed, interactive and background
+OPENAI_QUEUE_INTERACTIVE = int(os.environ.get("OPENAI_QUEUE_INTERACTIVE", "64"))
+OPENAI_QUEUE_BACKGROUND = int(os.environ.get("OPENAI_QUEUE_BACKGROUND", "16"))
+# Seconds a question's request may wait for its turn before it is shed
+OPENAI_QUEUE_TIMEOUT = float(os.environ.get("OPENAI_QUEUE_TIMEOUT", "10"))
+
+_priority : contextvars.ContextVar = contextvars.ContextVar("openai_priority", default=INTERACTIVE)
+
+
+"""
+Too many requests are waiting for openai already, or this one waited too long, it was not sent
+"""
+class OverloadedError(UpstreamUnavailableError):
+    pass
+
+
+def current_priority() -> int:
+    return _priority.get()
+
+
+"""
+Requests to openai made in this block (and the threads and tasks it starts with a copy of its context)
+get priority, e.g. with priority(BACKGROUND) around an index rebuild
+"""
+@contextmanager
+def priority(value : int) -> Iterator[None]:
+    token = _priority.set(value)
+    try:
+        yield
+    finally:
+        _priority.reset(token)
+
+
+"""
+limit units per period seconds, refilled continuously, holding at most limit (a full period's worth) at once.
+A limit of 0 never makes anyone wait. Not thread safe, RateLimitScheduler holds its lock around it
+"""
+class TokenBucket:
+    def __init__(self, limit : float, period : float = 60.):
+        self.capacity = float(limit)
+        self.rate = limit / period
+        self.level = float(limit)
+        self.updated = time.monotonic()
+
+    def _refill(self, now : float):
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+
+    """
+    Seconds until amount can be taken without going under reserve (a share of the capacity). An amount
+    bigger than what can ever be taken waits for a full bucket instead of forever
+    """
+    def wait_time(self, amount : float, reserve : float = 0., now : Optional[float] = None) -> float:
+        if not self.capacity:
+            return 0.
+        now = time.monotonic() if now is None else now
+        self._refill(now)
+        floor = self.capacity * reserve
+        amount = min(amount, self.capacity - floor)
+        return max(0., (amount + floor - self.level) / self.rate)
+
+    def take(self, amount : float):
+        if self.capacity:
+            self._refill(time.monotonic())
+            self.level -= min(amount, self.capacity)
+
+
+"""
+Decides when requests to one openai api are sent, so the account's requests and tokens per minute are shared
+instead of raced for
+
+Every request first waits its turn in acquire: requests are granted in priority order (first come first served
+within a class), each one once the request and token buckets hold enough for it. Background requests may not
+dig into the last reserve share of either bucket, and wait as long as any interactive one is waiting, so a
+rebuild can slow down but never starve questions
+
+    - a full queue (queue_limits, per class) or a wait over the timeout sheds the request with OverloadedError
+    - backoff(seconds) holds every request after a 429, openai's usage of the account is ahead of ours
+      (another process, or requests counted differently)
+
+Tokens are counted the way openai counts them against the limit when the request arrives: prompt tokens plus
+max_tokens for chat completions, the input for embeddings
+
+Analysis:
+    - acquire is O(log n) for n waiting requests, the dispatcher thread wakes up once per grant
+"""
+class RateLimitScheduler:
+    def __init__(self,
+                 name : str,
+                 requests_per_minute : float = 0,
+                 tokens_per_minute : float = 0,
+                 reserve : float = OPENAI_INTERACTIVE_RESERVE,
+                 queue_limits : Tuple[int, int] = (OPENAI_QUEUE_INTERACTIVE, OPENAI_QUEUE_BACKGROUND),
+                 period : float = 60.):
+        self.name = name
+        self.requests = TokenBucket(requests_per_minute, period)
+        self.tokens = TokenBucket(tokens_per_minute, period)
+        self.reserve = reserve
+        self.queue_limits = queue_limits
+        # (priority, order, tokens, future, queued at)
+        self._queue : List[Tuple[int, int, float, Future, float]] = []
+        self._order = itertools.count()
+        self._paused_until = 0.
+        self._condition = threading.Condition()
+        self._dispatcher : Optional[threading.Thread] = None
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.requests.capacity or self.tokens.capacity)
+
+    """
+    Queue a request of tokens, the future is done when it may be sent. Raises OverloadedError if its class's queue is full
+    """
+    def submit(self, tokens : float, priority : Optional[int] = None) -> Future:
+        priority = current_priority() if priority is None else priority
+        future : Future = Future()
+        if not self.enabled:
+            future.set_running_or_notify_cancel()
+            future.set_result(0.)
+            return future
+        with self._condition:
+            waiting = sum(1 for entry in self._queue if entry[0] == priority and not entry[3].cancelled())
+            if waiting >= self.queue_limits[min(priority, len(self.queue_limits) - 1)]:
+                count_scheduler_event(self.name, PRIORITY_NAMES.get(priority, str(priority)), "shed_full")
+                raise OverloadedError(f"{waiting} {PRIORITY_NAMES.get(priority, priority)} requests to {self.name} are waiting already")
+            heapq.heappush(self._queue, (priority, next(self._order), tokens, future, time.monotonic()))
+            if self._dispatcher is None:
+                self._dispatcher = threading.Thread(target=self._dispatch, name=f"{self.name}-scheduler", daemon=True)
+                self._dispatcher.start()
+            self._condition.notify()
+        return future
+
+    """
+    Wait until a request of tokens may be sent, OverloadedError if that takes over timeout seconds
+    """
+    def acquire(self, tokens : float, timeout : Optional[float] = None, priority : Optional[int] = None):
+        priority = current_priority() if priority is None else priority
+        future = self.submit(tokens, priority)
+        try:
+            seconds = future.result(timeout)
+        except futures.TimeoutError:
+            seconds = self._shed(future, priority, timeout)
+        self._record_wait(priority, seconds)
+
+    async def aacquire(self, tokens : float, timeout : Optional[float] = None, priority : Optional[int] = None):
+        priority = current_priority() if priority is None else priority
+        future = self.submit(tokens, priority)
+        try:
+            # Cancelling the wrapper (a timeout, or the caller's task) cancels the request in the queue
+            seconds = await asyncio.wait_for(asyncio.wrap_future(future), timeout)
+        except asyncio.TimeoutError:
+            seconds = self._shed(future, priority, timeout)
+        self._record_wait(priority, seconds)
+
+    def _record_wait(self, priority : int, seconds : float):
+        if self.enabled:
+            record_scheduler_wait(self.name, PRIORITY_NAMES.get(priority, str(priority)), seconds)
+
+    def _shed(self, future : Future, priority : int, timeout : Optional[float]) -> float:
+        # Granted right as the wait ran out, go ahead
+        if not future.cancel():
+            return future.result()
+        count_scheduler_event(self.name, PRIORITY_NAMES.get(priority, str(priority)), "shed_timeout")
+        raise OverloadedError(f"Waited over {timeout}s for a turn at {self.name}")
+
+    """
+    Hold every request for seconds, after openai answered 429
+    """
+    def backoff(self, seconds : float):
+        with self._condition:
+            self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+            self._condition.notify()
+        count_scheduler_event(self.name, PRIORITY_NAMES.get(current_priority(), "interactive"), "rate_limited")
+
+    def get_stats(self) -> Dict[str, float]:
+        with self._condition:
+            now = time.monotonic()
+            self.requests.wait_time(0, now=now)
+            self.tokens.wait_time(0, now=now)
+            return {"waiting" : sum(1 for entry in self._queue if not entry[3].cancelled()),
+                    "requests_available" : self.requests.level, "tokens_available" : self.tokens.level,
+                    "paused" : max(0., self._paused_until - now)}
+
+    def _wait_time(self, priority : int, tokens : float) -> float:
+        now = time.monotonic()
+        reserve = self.reserve if priority > INTERACTIVE else 0.
+        return max(self._paused_until - now, self.requests.wait_time(1, reserve, now), self.tokens.wait_time(tokens, reserve, now))
+
+    def _dispatch(self):
+        while True:
+            with self._condition:
+                while True:
+                    while self._queue and self._queue[0][3].cancelled():
+                        heapq.heappop(self._queue)
+                    if not self._queue:
+                        self._condition.wait()
+                        continue
+                    priority, _, tokens, future, queued = self._queue[0]
+                    wait = self._wait_time(priority, tokens)
+                    if wait <= 0:
+                        break
+                    # Also woken up by a new request, which may come first
+                    self._condition.wait(wait)
+                heapq.heappop(self._queue)
+                if not future.set_running_or_notify_cancel():
+                    continue
+                self.requests.take(1)
+                self.tokens.take(tokens)
+            future.set_result(time.monotonic() - queued)
+
+
+# Chat completions and embeddings have their own limits at openai
+chat_scheduler = RateLimitScheduler("openai_chat", OPENAI_CHAT_RPM, OPENAI_CHAT_TPM)
+embedding_scheduler = RateLimitScheduler("openai_embeddings", OPENAI_EMBEDDING_RPM, OPENAI_EMBEDDING_TPM)
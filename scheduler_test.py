@@ -0,0 +1,87 @@
+import time
+import asyncio
+import threading
+import unittest
+from scheduler import RateLimitScheduler, TokenBucket, OverloadedError, INTERACTIVE, BACKGROUND, priority, current_priority
+
+
+class TestScheduler(unittest.TestCase):
+
+    def test_token_bucket(self):
+        bucket = TokenBucket(10, period=1.)
+        self.assertEqual(bucket.wait_time(10), 0.)
+        bucket.take(10)
+        self.assertAlmostEqual(bucket.wait_time(5), 0.5, delta=0.05)
+        # Never more than a full bucket, the reserve can't be used
+        self.assertAlmostEqual(bucket.wait_time(50), 1., delta=0.05)
+        self.assertAlmostEqual(bucket.wait_time(1, reserve=0.5), 0.6, delta=0.05)
+        self.assertEqual(TokenBucket(0).wait_time(1e9), 0.)
+
+
+    def test_priority_order(self):
+        scheduler = RateLimitScheduler("test", requests_per_minute=2, period=0.2, reserve=0.)
+        scheduler.acquire(1)
+        scheduler.acquire(1)
+        granted = []
+        futures = [(name, scheduler.submit(1, level)) for name, level in
+                   [("b1", BACKGROUND), ("i1", INTERACTIVE), ("b2", BACKGROUND), ("i2", INTERACTIVE)]]
+        for name, future in futures:
+            future.add_done_callback(lambda future, name=name: granted.append(name))
+        for _, future in futures:
+            future.result(2.)
+        self.assertEqual(granted, ["i1", "i2", "b1", "b2"])
+
+
+    def test_background_reserve(self):
+        scheduler = RateLimitScheduler("test", tokens_per_minute=100, period=1., reserve=0.5)
+        scheduler.acquire(40, priority=INTERACTIVE)
+        # 60 left, 10 above the reserve
+        start = time.perf_counter()
+        scheduler.acquire(30, priority=BACKGROUND)
+        self.assertGreater(time.perf_counter() - start, 0.15)
+        start = time.perf_counter()
+        scheduler.acquire(50, priority=INTERACTIVE)
+        self.assertLess(time.perf_counter() - start, 0.1)
+
+
+    def test_shedding(self):
+        scheduler = RateLimitScheduler("test", requests_per_minute=1, period=10., queue_limits=(1, 1))
+        scheduler.acquire(1)
+        waiting = scheduler.submit(1, INTERACTIVE)
+        with self.assertRaises(OverloadedError):
+            scheduler.submit(1, INTERACTIVE)
+        scheduler.submit(1, BACKGROUND)
+        waiting.cancel()
+        # The cancelled request gave its place back, but this one can't get a turn in time
+        start = time.perf_counter()
+        with self.assertRaises(OverloadedError):
+            scheduler.acquire(1, timeout=0.05)
+        self.assertLess(time.perf_counter() - start, 1.)
+        self.assertEqual(scheduler.get_stats()["waiting"], 1)
+
+        with self.assertRaises(OverloadedError):
+            asyncio.run(scheduler.aacquire(1, timeout=0.05, priority=INTERACTIVE))
+
+
+    def test_backoff(self):
+        scheduler = RateLimitScheduler("test", requests_per_minute=1000)
+        scheduler.backoff(0.2)
+        start = time.perf_counter()
+        asyncio.run(scheduler.aacquire(1))
+        self.assertGreater(time.perf_counter() - start, 0.15)
+
+
+    def test_priority_context(self):
+        seen = []
+        with priority(BACKGROUND):
+            thread = threading.Thread(target=lambda: seen.append(current_priority()))
+            thread.start()
+            thread.join()
+            seen.append(current_priority())
+        seen.append(current_priority())
+        # A plain thread doesn't inherit it
+        self.assertEqual(seen, [INTERACTIVE, BACKGROUND, INTERACTIVE])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,62 @@
+import os
+import re
+import sys
+import time
+import argparse
+import subprocess
+from collections import defaultdict
+from typing import Dict, List, Tuple
+
+
+"""
+Startup profile of the app: import time per package, and time until predict can answer
+
+Usage:
+    python startup_profile.py [--module predict] [--top 15]
+
+The import times come from `python -X importtime` in a fresh interpreter, with the self time of every module
+summed per top level package. The time to ready is measured in this process, with INDEX_WARMUP as configured:
+importing predict, importing gradio (what app.py does while the index warms up), and the index being loaded
+(or built if none was persisted), which is what the first question waits for
+"""
+def profile_imports(module : str) -> Tuple[float, List[Tuple[str, float]]]:
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", f"import {module}"],
+                            capture_output=True, text=True, env={**os.environ, "INDEX_WARMUP" : "lazy"})
+    packages : Dict[str, float] = defaultdict(float)
+    total = 0.
+    for line in result.stderr.splitlines():
+        match = re.match(r"import time:\s+(\d+) \|\s+(\d+) \|(\s+)(\S+)", line)
+        if not match:
+            continue
+        self_us, cumulative_us, indent, name = int(match[1]), int(match[2]), match[3], match[4]
+        packages[name.split(".")[0]] += self_us / 1e6
+        if len(indent) == 1:
+            total += cumulative_us / 1e6
+    return total, sorted(packages.items(), key=lambda item: item[1], reverse=True)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--module", default="predict")
+    parser.add_argument("--top", type=int, default=15)
+    args = parser.parse_args()
+
+    total, packages = profile_imports(args.module)
+    print(f"import {args.module}: {total:.3f}s, by package (self time)")
+    for name, seconds in packages[:args.top]:
+        print(f"    {name:<24} {seconds:8.3f}s")
+
+    start = time.perf_counter()
+    import predict
+    imported = time.perf_counter() - start
+    thread = predict.start_index_warmup()
+    import gradio
+    ui_ready = time.perf_counter() - start
+    if thread is not None:
+        thread.join()
+    predict.get_index_state()
+    ready = time.perf_counter() - start
+    print(f"INDEX_WARMUP={predict.INDEX_WARMUP}")
+    print(f"    import predict           {imported:8.3f}s")
+    print(f"    import gradio            {ui_ready:8.3f}s  (app can bind its port)")
+    print(f"    index ready              {ready:8.3f}s  (version {predict.get_index_state().version})")
@@ -0,0 +1,117 @@
+from __future__ import annotations
+import os
+import json
+import numpy as np
+from typing import List, Tuple, Iterable, TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from langchain.schema import Document
+    from langchain.embeddings.base import Embeddings
+
+
+VECTORS_FILE   = "vectors.npy"
+DOCUMENTS_FILE = "documents.jsonl"
+# Written last, a directory without it holds an interrupted build
+COMPLETE_FILE  = "COMPLETE_NUMPY"
+
+
+"""
+Exact nearest neighbour search over a small corpus, in process
+
+Normalized embeddings are kept in one contiguous float32 matrix, saved as a .npy file that is memory mapped on load,
+with the documents in a jsonl sidecar (one line per row: id, page_content, metadata).
+A query is a single matrix-vector product, a batch of queries a single matrix product.
+
+Scores are squared L2 distances between the normalized vectors (2 - 2 * cosine similarity), lower is closer,
+the same as Chroma's default space, so it is a drop-in for vectordb.similarity_search_with_score
+
+Analysis:
+    - load is reading the sidecar, the matrix pages are only read by the first query
+    - query is O(n * d) for n documents of dimension d, plus O(n) for the top k
+"""
+class NumpyVectorStore:
+    def __init__(self, directory : str, embedding_function : Embeddings):
+        from langchain.schema import Document
+        self.directory = directory
+        self.embedding_function = embedding_function
+        self.vectors : np.ndarray = np.load(os.path.join(directory, VECTORS_FILE), mmap_mode="r")
+        self.ids : List[str] = []
+        self.documents : List[Document] = []
+        with open(os.path.join(directory, DOCUMENTS_FILE), "r") as f:
+            for line in f:
+                record = json.loads(line)
+                self.ids.append(record["id"])
+                self.documents.append(Document(page_content=record["page_content"], metadata=record["metadata"] or {}))
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    """
+    Write ids, vectors and documents (in the same order) to directory, vectors are normalized on the way
+    """
+    @staticmethod
+    def save(directory : str, ids : List[str], vectors : Iterable[List[float]], documents : List[Document]):
+        os.makedirs(directory, exist_ok=True)
+        matrix = np.ascontiguousarray(np.asarray(list(vectors), dtype=np.float32))
+        if len(ids):
+            matrix /= np.linalg.norm(matrix, axis=1, keepdims=True)
+        # Write then rename, a query never sees half a matrix
+        with open(os.path.join(directory, VECTORS_FILE + ".tmp"), "wb") as f:
+            np.save(f, matrix)
+        with open(os.path.join(directory, DOCUMENTS_FILE + ".tmp"), "w") as f:
+            for key, doc in zip(ids, documents):
+                f.write(json.dumps({"id" : key, "page_content" : doc.page_content, "metadata" : doc.metadata or None}) + "\n")
+        os.replace(os.path.join(directory, VECTORS_FILE + ".tmp"), os.path.join(directory, VECTORS_FILE))
+        os.replace(os.path.join(directory, DOCUMENTS_FILE + ".tmp"), os.path.join(directory, DOCUMENTS_FILE))
+        open(os.path.join(directory, COMPLETE_FILE), "w").close()
+
+    @staticmethod
+    def exists(directory : str) -> bool:
+        return os.path.isfile(os.path.join(directory, COMPLETE_FILE))
+
+    """
+    Ids stored in directory, without loading the vectors
+    """
+    @staticmethod
+    def load_ids(directory : str) -> List[str]:
+        if not NumpyVectorStore.exists(directory):
+            return []
+        with open(os.path.join(directory, DOCUMENTS_FILE), "r") as f:
+            return [json.loads(line)["id"] for line in f]
+
+    def _top_k(self, scores : np.ndarray, k : int) -> List[Tuple[Document, float]]:
+        k = min(k, len(scores))
+        if k == 0:
+            return []
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top], kind="stable")]
+        return [(self.documents[i], float(2. - 2. * scores[i])) for i in top]
+
+    def similarity_search_by_vector_with_score(self, embedding : List[float], k : int = 4) -> List[Tuple[Document, float]]:
+        query = np.asarray(embedding, dtype=np.float32)
+        return self._top_k(self.vectors @ (query / np.linalg.norm(query)), k)
+
+    def similarity_search_with_score(self, query : str, k : int = 4) -> List[Tuple[Document, float]]:
+        return self.similarity_search_by_vector_with_score(self.embedding_function.embed_query(query), k)
+
+    def similarity_search(self, query : str, k : int = 4) -> List[Document]:
+        return [doc for doc, _ in self.similarity_search_with_score(query, k)]
+
+    """
+    Top k for every query, the queries are embedded in one request and scored with one matrix product
+    """
+    def batch_similarity_search_with_score(self, queries : List[str], k : int = 4) -> List[List[Tuple[Document, float]]]:
+        if not queries:
+            return []
+        matrix = np.asarray(self.embedding_function.embed_documents(queries), dtype=np.float32)
+        matrix /= np.linalg.norm(matrix, axis=1, keepdims=True)
+        scores = matrix @ self.vectors.T
+        return [self._top_k(row, k) for row in scores]
+
+    """
+    Same check as for Chroma: expected number of documents, and one of them is its own nearest neighbour
+    """
+    def validate(self, expected_count : int) -> bool:
+        if expected_count == 0 or len(self) != expected_count:
+            return False
+        return int(np.argmax(self.vectors @ np.asarray(self.vectors[0]))) == 0
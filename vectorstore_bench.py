@@ -0,0 +1,110 @@
+import os
+import time
+import shutil
+import tempfile
+import argparse
+import statistics
+import numpy as np
+from typing import List
+
+from langchain.schema import Document
+from langchain.embeddings.base import Embeddings
+import indexing
+from indexing import IndexBuilder, get_index_db
+from preprocess import FunctionDoc
+from pipeline import read_docs
+
+
+"""
+Compare the Chroma and numpy backends: load time and query latency
+
+Usage:
+    python vectorstore_bench.py [--docs N] [--queries N] [--dim D]
+
+The corpus is data/veryfi_python_client_doc.jsonl, repeated with a suffix up to --docs documents.
+Embeddings are random vectors of dimension --dim (1536 like text-embedding-ada-002), keyed by text,
+so no openai request is made and only the vector store is timed.
+Load is the time to get a queryable store plus its first query, a cold start for the app.
+Chroma searches an approximate hnsw index and numpy is exact, on large random corpora their top 1 can differ
+"""
+class RandomEmbeddings(Embeddings):
+    def __init__(self, dim : int):
+        self.dim = dim
+        self.vectors = {}
+
+    # Normalized like openai embeddings, and memoized so query timings don't include making them
+    def _embed(self, text : str) -> List[float]:
+        if text not in self.vectors:
+            vector = np.random.default_rng(abs(hash(text)) % (2 ** 32)).standard_normal(self.dim)
+            self.vectors[text] = (vector / np.linalg.norm(vector)).tolist()
+        return self.vectors[text]
+
+    def embed_documents(self, texts : List[str]) -> List[List[float]]:
+        return [self._embed(text) for text in texts]
+
+    def embed_query(self, text : str) -> List[float]:
+        return self._embed(text)
+
+
+def percentiles(samples : List[float]) -> str:
+    samples = sorted(samples)
+    p = lambda q: samples[min(int(q * len(samples)), len(samples) - 1)] * 1000
+    return f"p50 {p(0.5):7.3f}ms  p95 {p(0.95):7.3f}ms  mean {statistics.mean(samples) * 1000:7.3f}ms"
+
+
+def run(backend : str, documents : List[Document], queries : List[str], embeddings : Embeddings):
+    indexing.VECTOR_STORE = backend
+    builder = IndexBuilder("bench", embeddings, backend)
+    builder.add(documents)
+    start = time.perf_counter()
+    version, _ = builder.finish(lambda: documents)
+    build = time.perf_counter() - start
+
+    start = time.perf_counter()
+    vectordb = get_index_db("bench", version, embeddings)
+    vectordb.similarity_search_with_score(queries[0])
+    load = time.perf_counter() - start
+
+    latencies = []
+    for query in queries:
+        start = time.perf_counter()
+        vectordb.similarity_search_with_score(query)
+        latencies.append(time.perf_counter() - start)
+    top1 = [vectordb.similarity_search_with_score(query, k=1)[0][0].page_content for query in queries]
+    print(f"{backend:<8} build {build * 1000:9.1f}ms  load {load * 1000:8.1f}ms  query {percentiles(latencies)}")
+
+    if backend == "numpy":
+        start = time.perf_counter()
+        vectordb.batch_similarity_search_with_score(queries)
+        batch = time.perf_counter() - start
+        print(f"{'':<8} batch of {len(queries)} queries {batch * 1000:.3f}ms, {batch / len(queries) * 1e6:.1f}us per query")
+    return top1
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--docs", type=int, default=0, help="corpus size, the real corpus by default")
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--dim", type=int, default=1536)
+    args = parser.parse_args()
+
+    texts = [str(doc) for doc in read_docs("veryfi_python_client")]
+    if args.docs:
+        texts = [texts[i % len(texts)] + (f"\n#{i}" if i >= len(texts) else "") for i in range(args.docs)]
+    documents = [Document(page_content=text) for text in texts]
+    queries = [f"question {i} about {texts[i % len(texts)].split(chr(10))[0]}" for i in range(args.queries)]
+    embeddings = RandomEmbeddings(args.dim)
+    embeddings.embed_documents(queries)
+    print(f"{len(documents)} docs, {len(queries)} queries, dim {args.dim}")
+
+    cwd = os.getcwd()
+    tmp = tempfile.mkdtemp()
+    try:
+        os.chdir(tmp)
+        chroma = run("chroma", documents, queries, embeddings)
+        shutil.rmtree("bench_index")
+        numpy = run("numpy", documents, queries, embeddings)
+        print(f"same top 1 for {sum(a == b for a, b in zip(chroma, numpy))}/{len(queries)} queries")
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(tmp)
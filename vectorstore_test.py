@@ -0,0 +1,142 @@
+import os
+import shutil
+import hashlib
+import tempfile
+import unittest
+from langchain.schema import Document
+from langchain.embeddings.base import Embeddings
+import indexing
+from indexing import IndexBuilder, get_index_db, validate_index_db, set_current_version, set_embeddings, IndexState
+from vectorstore import NumpyVectorStore
+from preprocess import FunctionDoc
+
+
+"""
+Bag of words embeddings, texts sharing words are close
+"""
+class WordEmbeddings(Embeddings):
+    def __init__(self):
+        self.calls = 0
+
+    def _embed(self, text):
+        vector = [0.01] * 64
+        for word in text.lower().split():
+            vector[int(hashlib.md5(word.encode()).hexdigest(), 16) % 64] += 1.
+        return vector
+
+    def embed_documents(self, texts):
+        self.calls += 1
+        return [self._embed(text) for text in texts]
+
+    def embed_query(self, text):
+        self.calls += 1
+        return self._embed(text)
+
+
+TEXTS = ["process document from file", "process document from url", "delete document by id",
+         "get list of documents", "update document vendor and total"]
+
+
+class TestNumpyVectorStore(unittest.TestCase):
+
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.tmp = tempfile.mkdtemp()
+        os.chdir(self.tmp)
+        self.embeddings = WordEmbeddings()
+        self.vector_store, indexing.VECTOR_STORE = indexing.VECTOR_STORE, "numpy"
+
+    def tearDown(self):
+        indexing.VECTOR_STORE = self.vector_store
+        os.chdir(self.cwd)
+        shutil.rmtree(self.tmp)
+
+
+    def test_search(self):
+        docs = [Document(page_content=text) for text in TEXTS]
+        NumpyVectorStore.save("store", [str(i) for i in range(len(docs))], self.embeddings.embed_documents(TEXTS), docs)
+        store = NumpyVectorStore("store", self.embeddings)
+        results = store.similarity_search_with_score("delete a document", k=2)
+        self.assertEqual(results[0][0].page_content, "delete document by id")
+        self.assertLess(results[0][1], results[1][1])
+        self.assertAlmostEqual(store.similarity_search_with_score(TEXTS[3], k=1)[0][1], 0., places=5)
+
+        queries = ["delete a document", "document url", "vendor total"]
+        batch = store.batch_similarity_search_with_score(queries, k=3)
+        self.assertEqual([[doc.page_content for doc, _ in result] for result in batch],
+                         [[doc.page_content for doc, _ in store.similarity_search_with_score(q, k=3)] for q in queries])
+        self.assertEqual(len(store.similarity_search("document", k=10)), len(TEXTS))
+        self.assertTrue(store.validate(len(TEXTS)))
+        self.assertFalse(store.validate(len(TEXTS) + 1))
+
+
+    def test_numpy_backend_build(self):
+        builder = IndexBuilder("test", self.embeddings)
+        builder.add(Document(page_content=text) for text in TEXTS)
+        version, stats = builder.finish(lambda: (Document(page_content=text) for text in TEXTS))
+        self.assertEqual((stats["added"], stats["embedded"]), (5, 5))
+        vectordb = get_index_db("test", version, self.embeddings)
+        self.assertIsInstance(vectordb, NumpyVectorStore)
+        self.assertTrue(validate_index_db(vectordb, 5))
+        set_current_version("test", version)
+
+        texts = TEXTS[1:] + ["delete all documents"]
+        builder = IndexBuilder("test", self.embeddings)
+        builder.add(Document(page_content=text) for text in texts)
+        version, stats = builder.finish(lambda: (Document(page_content=text) for text in texts))
+        self.assertEqual((stats["added"], stats["deleted"], stats["unchanged"], stats["embedded"]), (1, 1, 4, 1))
+        self.assertEqual(get_index_db("test", version, self.embeddings).similarity_search("delete all", k=1)[0].page_content,
+                         "delete all documents")
+
+
+    def test_shared_embeddings(self):
+        set_embeddings(self.embeddings)
+        try:
+            # Chroma searches go through IndexState's lock, numpy ones don't
+            for backend in ("numpy", "chroma"):
+                indexing.VECTOR_STORE = backend
+                builder = IndexBuilder(f"test_{backend}")
+                builder.add(Document(page_content=text) for text in TEXTS)
+                version, _ = builder.finish(lambda: (Document(page_content=text) for text in TEXTS))
+                state = IndexState(get_index_db(f"test_{backend}", version), version)
+                self.assertEqual(state.similarity_search_with_score(TEXTS[2], k=1)[0][0].page_content, TEXTS[2], backend)
+            self.assertGreater(self.embeddings.calls, 0)
+        finally:
+            set_embeddings(None)
+
+
+    def test_hybrid_search(self):
+        docs = [FunctionDoc(name="Client.delete_document", definition="def delete_document(self, document_id):", docstring="Delete Document"),
+                FunctionDoc(name="Client.process_document", definition="def process_document(self, file_path):",
+                            docstring="Process a document and extract all the fields from it"),
+                FunctionDoc(name="Client.get_line_items", definition="def get_line_items(self, document_id):", docstring="Get all line items")]
+        texts = [str(doc) for doc in docs]
+        builder = IndexBuilder("test", self.embeddings)
+        builder.add(Document(page_content=text) for text in texts)
+        version, _ = builder.finish(lambda: (Document(page_content=text) for text in texts))
+        state = IndexState(get_index_db("test", version, self.embeddings), version)
+        calls = self.embeddings.calls
+
+        # Names a function, nothing is embedded
+        results, path = state.search("how do I delete a document", k=2)
+        self.assertEqual((results[0][0].page_content, path), (texts[0], "lexical"))
+        self.assertTrue(state.is_lexical_match("how do I delete a document"))
+        self.assertEqual(self.embeddings.calls, calls)
+
+        results, path = state.search("extract fields from a receipt", k=2)
+        self.assertEqual((results[0][0].page_content, path), (texts[1], "embedded"))
+        self.assertEqual(self.embeddings.calls, calls + 1)
+        results, path = state.search("extract fields", k=2, embedding=self.embeddings.embed_query("extract fields"))
+        self.assertEqual((results[0][0].page_content, path), (texts[1], "reused"))
+        self.assertEqual(self.embeddings.calls, calls + 2)
+
+        indexing.HYBRID_SEARCH = False
+        try:
+            self.assertEqual(state.search("how do I delete a document", k=1)[1], "embedded")
+            self.assertFalse(state.is_lexical_match("how do I delete a document"))
+        finally:
+            indexing.HYBRID_SEARCH = True
+
+
+if __name__ == '__main__':
+    unittest.main()